@@ -0,0 +1,74 @@
+# analytics.py
+# 分析レポート用の集計。履歴が変わらない限り再計算せず、Streamlitの再実行ごとに全履歴を集計し直さない
+import streamlit as st
+from config import ANALYSIS_SCATTER_LIMIT
+from database import get_history_version, get_analysis_frame
+
+# 評価ラベルをLINEらしく変更
+ACCURACY_LABELS = {1.0: '👍 正確!', 0.5: '🤔 まあまあ', 0.0: '👎 いまいち'}
+SCATTER_METRICS = ["bleu_score", "similarity_score", "relevance_score", "word_count"]
+STATS_COLUMNS = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _compute_analytics(version, scatter_limit):
+    """
+    分析レポートの集計を計算する（同じ version の間はキャッシュした結果を返す）
+
+    Args:
+        version (tuple): get_history_version() の値（接続プールの書き込み回数、最大ID）
+        scatter_limit (int): 散布図に使う直近の行数
+
+    Returns:
+        dict or None: 集計結果。分析できる行がない場合はNone
+    """
+    # is_correct が NaN のレコードを除外して分析
+    analysis_df = get_analysis_frame()
+    if analysis_df.empty:
+        return None
+    analysis_df['評価'] = analysis_df['is_correct'].map(ACCURACY_LABELS)
+
+    valid_metric_options = [m for m in SCATTER_METRICS if m in analysis_df.columns and analysis_df[m].notna().any()]
+    valid_stats_cols = [c for c in STATS_COLUMNS if c in analysis_df.columns and analysis_df[c].notna().any()]
+
+    group_means = None
+    group_error = None
+    if valid_stats_cols:
+        try:
+            group_means = analysis_df.groupby('評価')[valid_stats_cols].mean()
+        except Exception as e:
+            group_error = str(e)
+
+    # カスタム評価指標：効率性スコア
+    top_efficiency = None
+    # 応答時間のない行（キャッシュから返した回答）は生成時間がないため除外する
+    if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
+        timed_df = analysis_df[analysis_df['response_time'].notna()]
+        efficiency = timed_df['is_correct'] / (timed_df['response_time'] + 0.1)
+        top_efficiency = efficiency.set_axis(timed_df['id']).rename('efficiency_score').sort_values(ascending=False).head(10)
+
+    # 散布図は直近の行だけを使い、描画するデータ量を一定に保つ
+    scatter_df = analysis_df.sort_values('id', ascending=False).head(scatter_limit)
+
+    return {
+        "rows": len(analysis_df),
+        "accuracy_counts": analysis_df['評価'].value_counts(),
+        "valid_metric_options": valid_metric_options,
+        "scatter": scatter_df[['response_time', *valid_metric_options, '評価']],
+        "stats": analysis_df[valid_stats_cols].describe() if valid_stats_cols else None,
+        "group_means": group_means,
+        "group_error": group_error,
+        "top_efficiency": top_efficiency,
+    }
+
+
+def get_history_analytics(scatter_limit=ANALYSIS_SCATTER_LIMIT):
+    """
+    現在の履歴の分析レポートの集計を返す
+
+    前回から履歴への書き込みがなければ、キャッシュした集計をそのまま返す。
+
+    Returns:
+        dict or None: 集計結果（_compute_analytics を参照）
+    """
+    return _compute_analytics(get_history_version(), scatter_limit)
@@ -1,4 +1,6 @@
 # app.py
+import time
+_startup_start = time.perf_counter()  # 起動時間の確認用
 import streamlit as st
 import ui                   # UIモジュール
 import llm                  # LLMモジュール
@@ -9,13 +11,14 @@ import torch
 from transformers import pipeline
 from config import MODEL_NAME
 from huggingface_hub import HfFolder
+_import_seconds = time.perf_counter() - _startup_start
 
 # --- アプリケーション設定 ---
 st.set_page_config(page_title="AI LINE風チャット", layout="wide")
 
 # --- 初期化処理 ---
-# NLTKデータのダウンロード（初回起動時など）
-metrics.initialize_nltk()
+# NLTKとJanomeは評価指標を最初に計算する時に読み込む（metrics.py）
+_init_start = time.perf_counter()
 
 # データベースの初期化（テーブルが存在しない場合、作成）
 database.init_db()
@@ -23,6 +26,18 @@ database.init_db()
 # データベースが空ならサンプルデータを投入
 data.ensure_initial_data()
 
+# 起動時間の記録（プロセスごとに最初の1回だけ出力する）
+@st.cache_resource
+def report_startup(_import_seconds, _init_seconds):
+    """インポートと初期化にかかった時間を出力する（引数はキャッシュのキーに含めない）"""
+    metrics_report = metrics.get_startup_report()
+    lazy_init = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in metrics_report["lazy_init_seconds"].items())
+    print(f"Startup: imports {_import_seconds:.2f}s (metrics {metrics_report['import_seconds']:.3f}s), "
+          f"init {_init_seconds:.2f}s, metrics lazy init: {lazy_init or 'none'}")
+    return {"import_seconds": _import_seconds, "init_seconds": _init_seconds, "metrics": metrics_report}
+
+report_startup(_import_seconds, time.perf_counter() - _init_start)
+
 # LLMモデルのロード（キャッシュを利用）
 # モデルをキャッシュして再利用
 @st.cache_resource
@@ -1,3 +1,31 @@
 # config.py
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "rinna/gemma-2-baku-2b-it"
\ No newline at end of file
+DB_POOL_SIZE = 4  # 使い回すSQLite接続の最大数
+DB_CACHE_SIZE_MB = 64  # 接続ごとのSQLiteのページキャッシュ（MB）
+DB_WRITE_BATCH_SIZE = 32  # まとめて1回のトランザクションで保存する最大件数
+DB_WRITE_FLUSH_INTERVAL = 0.5  # 書き込みをまとめるために待つ最大時間（秒）
+BULK_INSERT_WORKERS = 0  # 一括取り込みで形態素解析を並列に行うプロセス数（0で並列化しない）
+HISTORY_PAGE_SIZE = 50  # 履歴画面で1回に読み込む件数
+ANALYSIS_SCATTER_LIMIT = 1000  # 分析レポートの散布図に使う直近の件数
+MODEL_NAME = "rinna/gemma-2-baku-2b-it"
+
+# 応答キャッシュの設定
+RESPONSE_CACHE_MAX_ENTRIES = 256  # メモリに保持する最大件数
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # 有効期間（秒）
+RESPONSE_CACHE_DB = "response_cache.db"  # 再起動後もキャッシュを残すSQLiteファイル（Noneでメモリのみ）
+
+# プレフィックスKVキャッシュの設定（共通のプロンプト先頭部分のプレフィルを省略する）
+PREFIX_CACHE_MAX_MB = 256  # KVキャッシュの上限（MB）。0で無効
+PREFIX_CACHE_BLOCK_SIZE = 16  # 先頭部分を数える単位（トークン数）
+PREFIX_CACHE_MIN_HITS = 2  # KVキャッシュを作成するまでの出現回数
+PREFIX_CACHE_MAX_ENTRY_MB = 64  # 1件のKVキャッシュの上限（MB）。ヒットごとにこのサイズまでコピーする
+
+# 生成の打ち切りの設定
+STOP_SEQUENCES = []  # 現れた時点で生成を止める文字列（その直前までを回答とする）
+MAX_GENERATION_TIME = None  # 1回の生成の制限時間（秒）。超えた場合はそれまでの出力を返す（Noneで無制限）
+
+# 評価指標の計算の設定
+TOKEN_CACHE_MAX_ENTRIES = 4096  # 形態素解析・分かち書きの結果を保持する最大件数（0でキャッシュしない）
+METRICS_OFFLINE = False  # TrueにするとNLTKのデータをダウンロードしない（データがなければ簡易的な代替関数を使う）
+METRICS_RECOMPUTE_CHUNK_SIZE = 200  # 評価指標の再計算で1回のトランザクションで更新する行数
+METRICS_RECOMPUTE_ON_STARTUP = True  # 起動時に古いバージョンの評価指標の行を再計算する
\ No newline at end of file
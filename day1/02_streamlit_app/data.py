@@ -1,7 +1,7 @@
 # data.py
 import streamlit as st
 from datetime import datetime
-from database import save_to_db, get_db_count # DB操作関数をインポート
+from database import bulk_insert_records, get_db_count # DB操作関数をインポート
 
 # サンプルデータのリスト
 SAMPLE_QUESTIONS_DATA = [
@@ -92,23 +92,10 @@ SAMPLE_QUESTIONS_DATA = [
 def create_sample_evaluation_data():
     """定義されたサンプルデータをデータベースに保存する"""
     try:
-        count_before = get_db_count()
-        added_count = 0
-        # 各サンプルをデータベースに保存
-        for item in SAMPLE_QUESTIONS_DATA:
-            # save_to_dbが必要な引数のみ渡す
-            save_to_db(
-                question=item["question"],
-                answer=item["answer"],
-                feedback=item["feedback"],
-                correct_answer=item["correct_answer"],
-                is_correct=item["is_correct"],
-                response_time=item["response_time"]
-            )
-            added_count += 1
-
+        # 全サンプルの評価指標をまとめて計算し、1回のトランザクションで保存する
+        report = bulk_insert_records(SAMPLE_QUESTIONS_DATA)
         count_after = get_db_count()
-        st.success(f"{added_count} 件のサンプル評価データが正常に追加されました。(合計: {count_after} 件)")
+        st.success(f"{report['rows']} 件のサンプル評価データが正常に追加されました。(合計: {count_after} 件、{report['rows_per_sec']:.1f} 件/秒)")
 
     except Exception as e:
         st.error(f"サンプルデータの作成中にエラーが発生しました: {e}")
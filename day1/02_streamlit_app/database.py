@@ -1,10 +1,16 @@
 # database.py
+import atexit
 import sqlite3
+import time
 import pandas as pd
 from datetime import datetime
 import streamlit as st
-from config import DB_FILE
-from metrics import calculate_metrics # metricsを計算するために必要
+from config import (DB_FILE, DB_POOL_SIZE, DB_CACHE_SIZE_MB, DB_WRITE_BATCH_SIZE, DB_WRITE_FLUSH_INTERVAL,
+                    BULK_INSERT_WORKERS, METRICS_RECOMPUTE_CHUNK_SIZE, METRICS_RECOMPUTE_ON_STARTUP)
+from metrics import calculate_metrics_batch, METRIC_COLUMNS, METRIC_COLUMN_TYPES, METRICS_VERSION, LEGACY_METRICS_VERSION # metricsを計算するために必要
+from db_connection import SQLiteConnectionPool
+from write_behind import WriteBehindQueue, WriteBehindError
+from recompute import MetricsRecomputeJob
 
 # --- スキーマ定義 ---
 TABLE_NAME = "chat_history"
@@ -22,58 +28,327 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  similarity_score REAL,
  word_count INTEGER,
  relevance_score REAL,
- specificity_score REAL)
+ specificity_score REAL,
+ metrics_version INTEGER NOT NULL DEFAULT 0)  -- 評価指標を計算した時の metrics.METRICS_VERSION
 '''
 
+# 履歴の絞り込みと日付ごとの表示で使うインデックス
+INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_timestamp ON {TABLE_NAME} (timestamp)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_is_correct ON {TABLE_NAME} (is_correct, timestamp)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_metrics_version ON {TABLE_NAME} (metrics_version)",
+]
+
+# --- 接続プール ---
+# Streamlitは操作のたびにスクリプトを再実行するため、接続はプロセス全体で使い回す
+@st.cache_resource
+def get_connection_pool():
+    """WALモードを設定したSQLite接続プールを取得する"""
+    return SQLiteConnectionPool(DB_FILE, pool_size=DB_POOL_SIZE, cache_size_mb=DB_CACHE_SIZE_MB)
+
 # --- データベース初期化 ---
+def _migrate(conn):
+    """
+    既存のテーブルに足りない列（新しい評価指標と metrics_version）を追加する
+
+    ALTER TABLE ADD COLUMN はテーブルを作り直さないため、行数が多くてもすぐに終わる。
+    metrics_version 列がなかった行は LEGACY_METRICS_VERSION の定義で計算済みとして記録し、再計算しない。
+    新しく追加した評価指標の列は NULL になるため、その行だけを未計算（metrics_version = 0）にして
+    バックグラウンドの再計算で埋める。
+    """
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+    if "metrics_version" not in existing:
+        conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN metrics_version INTEGER NOT NULL DEFAULT 0")
+        conn.execute(f"UPDATE {TABLE_NAME} SET metrics_version = ?", (LEGACY_METRICS_VERSION,))
+        print(f"Added column metrics_version to {TABLE_NAME} (existing rows: version {LEGACY_METRICS_VERSION})")
+    added = []
+    for column in METRIC_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {METRIC_COLUMN_TYPES.get(column, 'REAL')}")
+            added.append(column)
+    if added:
+        missing = " OR ".join(f"{column} IS NULL" for column in added)
+        conn.execute(f"UPDATE {TABLE_NAME} SET metrics_version = 0 WHERE {missing}")
+        print(f"Added columns to {TABLE_NAME}: {', '.join(added)}")
+
 def init_db():
-    """データベースとテーブルを初期化する"""
+    """データベースとテーブルを初期化し、古い評価指標の行があれば再計算を開始する"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(SCHEMA)
-        conn.commit()
-        conn.close()
+        with get_connection_pool().transaction() as conn:
+            conn.execute(SCHEMA)
+            _migrate(conn)
+            for index in INDEXES:
+                conn.execute(index)
         print(f"Database '{DB_FILE}' initialized successfully.")
+        if METRICS_RECOMPUTE_ON_STARTUP and count_stale_metrics() > 0:
+            start_metrics_recompute()
     except Exception as e:
         st.error(f"データベースの初期化に失敗しました: {e}")
         raise e # エラーを再発生させてアプリの起動を止めるか、適切に処理する
 
+_INSERT_COLUMNS = ["timestamp", "question", "answer", "feedback", "correct_answer", "is_correct", "response_time",
+                   *METRIC_COLUMNS, "metrics_version"]
+INSERT_SQL = f'''
+INSERT INTO {TABLE_NAME} ({", ".join(_INSERT_COLUMNS)})
+VALUES ({", ".join("?" for _ in _INSERT_COLUMNS)})
+'''
+
+def _compute_metrics(answers, correct_answers, workers=0):
+    """
+    複数の回答の評価指標をまとめて計算する
+
+    Args:
+        answers (list): 回答のリスト
+        correct_answers (list): 正解のリスト
+        workers (int): 2以上の場合は、キャッシュにない回答の形態素解析をその数のプロセスで並列に行う
+
+    Returns:
+        list: 行ごとの (bleu_score, similarity_score, word_count, relevance_score, specificity_score)
+    """
+    scores = calculate_metrics_batch(answers, correct_answers, as_frame=False, workers=workers)
+    # SQLiteに保存できるよう、numpyの値をPythonの数値に変換する
+    return list(zip(*(scores[column].tolist() for column in METRIC_COLUMNS)))
+
+def _insert_rows(rows, workers=0):
+    """
+    (timestamp, question, answer, feedback, correct_answer, is_correct, response_time) の行の評価指標を計算し、
+    1回のトランザクションでまとめて保存する
+
+    Returns:
+        tuple: (評価指標の計算にかかった秒数, 保存にかかった秒数)
+    """
+    # 書き込みロックを保持する時間を短くするため、接続を借りる前に計算する
+    start = time.perf_counter()
+    metrics = _compute_metrics([row[2] for row in rows], [row[4] for row in rows], workers)
+    records = [tuple(row) + tuple(row_metrics) + (METRICS_VERSION,) for row, row_metrics in zip(rows, metrics)]
+    metrics_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with get_connection_pool().transaction() as conn:
+        conn.executemany(INSERT_SQL, records)
+    return metrics_seconds, time.perf_counter() - start
+
+# --- 書き込みキュー ---
+def _write_rows(rows):
+    """キューに積まれた行の評価指標を計算し、1回のトランザクションでまとめて保存する（ワーカースレッドで呼ばれる）"""
+    _insert_rows(rows)
+    print(f"{len(rows)} rows saved to DB successfully.") # デバッグ用
+
+@st.cache_resource
+def get_write_queue():
+    """save_to_db の書き込みをまとめて処理するキューを取得する（プロセス終了時に残りを書き込む）"""
+    write_queue = WriteBehindQueue(
+        _write_rows, batch_size=DB_WRITE_BATCH_SIZE, flush_interval=DB_WRITE_FLUSH_INTERVAL, name="db-writer"
+    )
+    atexit.register(write_queue.close)
+    return write_queue
+
+def flush_db_writes(timeout=None):
+    """
+    キューに積まれた書き込みが全てデータベースに反映されるまで待つ（保存に失敗した行があった場合はエラーを表示する）
+
+    Args:
+        timeout (float, optional): 待つ最大時間（秒）。Noneの場合は終わるまで待つ
+
+    Returns:
+        bool: 全て反映された場合はTrue、タイムアウトした場合や保存に失敗した行があった場合はFalse
+    """
+    try:
+        return get_write_queue().flush(timeout)
+    except WriteBehindError as e:
+        # 失敗した行はキューの dead_letters に残っている（データ管理ページから再試行できる）
+        st.error(f"データベースへの保存中にエラーが発生しました: {e}")
+        return False
+
+def pending_db_writes():
+    """まだデータベースに反映されていない書き込みの件数を返す"""
+    return get_write_queue().pending()
+
+def get_db_write_stats():
+    """書き込みキューの処理状況（失敗件数や最後のエラーを含む）を返す"""
+    return get_write_queue().stats()
+
+def retry_failed_db_writes():
+    """保存に失敗して残っている行をもう一度書き込みキューに積み、再投入した件数を返す"""
+    return get_write_queue().retry_failed()
+
 # --- データ操作関数 ---
-def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time):
-    """チャット履歴と評価指標をデータベースに保存する"""
-    conn = None
+def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time, wait=False):
+    """
+    チャット履歴をデータベースへの書き込みキューに積む
+
+    評価指標の計算と保存はバックグラウンドのスレッドでまとめて行うため、通常は書き込みの完了を待たずに戻る。
+
+    Args:
+        response_time (float or None): 生成にかかった時間（秒）。キャッシュから返した回答はNone（NULLとして保存する）
+        wait (bool): Trueの場合は保存が完了するまで待つ
+
+    Returns:
+        bool: wait=Trueの場合は保存に成功したかどうか。wait=Falseの場合は常にTrue（失敗は後から通知される）
+    """
+    # 時刻はキューに積んだ時点のものを記録する
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    get_write_queue().submit((timestamp, question, answer, feedback, correct_answer, is_correct, response_time))
+    if wait:
+        return flush_db_writes()
+    return True
+
+# --- 評価指標の再計算 ---
+# 再計算に失敗した行は metrics_version を -METRICS_VERSION にして、同じバージョンの間は再試行しない
+# （METRICS_VERSION を上げると再び対象になる）
+STALE_CONDITION = "metrics_version < ? AND metrics_version > ?"
+
+def _stale_params():
+    return (METRICS_VERSION, -METRICS_VERSION)
+
+def count_stale_metrics():
+    """評価指標が古いバージョンで計算されている（または未計算の）行数を返す（再計算に失敗した行を除く）"""
+    with get_connection_pool().connection() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE {STALE_CONDITION}", _stale_params()
+        ).fetchone()[0]
+
+def count_failed_metrics():
+    """現在のバージョンの評価指標の再計算に失敗した行数を返す"""
+    with get_connection_pool().connection() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE metrics_version = ?", (-METRICS_VERSION,)
+        ).fetchone()[0]
+
+def _recompute_chunk(chunk_size):
+    """評価指標が古い行を id 順に最大 chunk_size 行再計算し、1回のトランザクションで更新する"""
+    with get_connection_pool().connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, answer, correct_answer FROM {TABLE_NAME} WHERE {STALE_CONDITION} ORDER BY id LIMIT ?",
+            (*_stale_params(), chunk_size),
+        ).fetchall()
+    if not rows:
+        return 0
+
+    failed_ids = []
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = _compute_metrics([row[1] for row in rows], [row[2] for row in rows])
+        updates = [(tuple(row_metrics), row[0]) for row, row_metrics in zip(rows, metrics)]
+    except Exception as e:
+        # まとめて計算できない場合は1行ずつ計算し、失敗した行だけを記録して先に進む
+        print(f"警告: 評価指標の一括計算に失敗したため1行ずつ計算します: {e}")
+        updates = []
+        for row in rows:
+            try:
+                updates.append((tuple(_compute_metrics([row[1]], [row[2]])[0]), row[0]))
+            except Exception as row_error:
+                print(f"エラー: id={row[0]} の評価指標を計算できませんでした: {row_error}")
+                failed_ids.append(row[0])
 
-        # 追加の評価指標を計算
-        bleu_score, similarity_score, word_count, relevance_score, specificity_score = calculate_metrics(
-            answer, correct_answer
+    assignments = ", ".join(f"{column} = ?" for column in METRIC_COLUMNS)
+    with get_connection_pool().transaction() as conn:
+        # 計算中に他の処理で更新された行は上書きしない
+        conn.executemany(
+            f"UPDATE {TABLE_NAME} SET {assignments}, metrics_version = ? WHERE id = ? AND {STALE_CONDITION}",
+            [row_metrics + (METRICS_VERSION, row_id, *_stale_params()) for row_metrics, row_id in updates],
         )
+        conn.executemany(
+            f"UPDATE {TABLE_NAME} SET metrics_version = ? WHERE id = ? AND {STALE_CONDITION}",
+            [(-METRICS_VERSION, row_id, *_stale_params()) for row_id in failed_ids],
+        )
+    return len(rows)
 
-        c.execute(f'''
-        INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score, specificity_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score, specificity_score))
-        conn.commit()
-        print("Data saved to DB successfully.") # デバッグ用
-    except sqlite3.Error as e:
-        st.error(f"データベースへの保存中にエラーが発生しました: {e}")
-    finally:
-        if conn:
-            conn.close()
+@st.cache_resource
+def get_recompute_job():
+    """評価指標の再計算ジョブを取得する（プロセス全体で1つ）"""
+    return MetricsRecomputeJob(_recompute_chunk, count_stale_metrics, chunk_size=METRICS_RECOMPUTE_CHUNK_SIZE)
+
+def start_metrics_recompute():
+    """
+    評価指標が古い行のバックグラウンドでの再計算を開始する（中断していた場合は残りの行から再開する）
+
+    Returns:
+        bool: 新しく開始した場合はTrue（既に実行中の場合はFalse）
+    """
+    started = get_recompute_job().start()
+    if started:
+        print(f"Started recomputing metrics for {count_stale_metrics()} rows (version {METRICS_VERSION}).")
+    return started
+
+# --- 一括取り込み ---
+# 取り込むレコードの列（question, answer, correct_answer は必須。timestampを省略した場合は取り込んだ時刻）
+IMPORT_COLUMNS = ["timestamp", "question", "answer", "feedback", "correct_answer", "is_correct", "response_time"]
+REQUIRED_IMPORT_COLUMNS = ["question", "answer", "correct_answer"]
+
+def load_records(source):
+    """
+    一括取り込み用のレコードをDataFrameとして読み込む
+
+    Args:
+        source: レコード（辞書）のイテラブル、DataFrame、またはCSV/JSONLファイルのパス（アップロードされたファイルも可）
+
+    Returns:
+        pd.DataFrame: 取り込むレコード
+    """
+    if isinstance(source, pd.DataFrame):
+        return source
+    path = source if isinstance(source, str) else getattr(source, "name", None)
+    if isinstance(path, str) and path.lower().endswith(".csv"):
+        return pd.read_csv(source)
+    if isinstance(path, str) and path.lower().endswith((".jsonl", ".ndjson")):
+        return pd.read_json(source, lines=True, convert_dates=False)
+    if isinstance(source, str):
+        raise ValueError(f"対応していないファイル形式です（CSVまたはJSONLを指定してください）: {source}")
+    return pd.DataFrame(list(source))
+
+def bulk_insert_records(source, workers=None):
+    """
+    複数のレコードの評価指標をまとめて計算し、1回のトランザクションで保存する
+
+    Args:
+        source: レコード（辞書）のイテラブル、DataFrame、またはCSV/JSONLファイルのパス
+        workers (int, optional): 形態素解析を並列に行うプロセス数（Noneの場合は BULK_INSERT_WORKERS）
+
+    Returns:
+        dict: 件数、処理時間、1秒あたりの件数
+    """
+    start = time.perf_counter()
+    df = load_records(source)
+    missing = [column for column in REQUIRED_IMPORT_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"必須の列がありません: {', '.join(missing)}")
+
+    df = df.reindex(columns=IMPORT_COLUMNS)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    df["timestamp"] = df["timestamp"].fillna(now).astype(str)
+    df["is_correct"] = pd.to_numeric(df["is_correct"], errors="coerce")
+    df["response_time"] = pd.to_numeric(df["response_time"], errors="coerce")
+    # SQLiteにはNaNではなくNULLとして保存する
+    rows = [
+        tuple(None if pd.isna(value) else value for value in row)
+        for row in df.itertuples(index=False, name=None)
+    ]
+
+    if rows:
+        # 書き込みキューに残っている行より後に保存されるよう、先に反映させる
+        flush_db_writes()
+        metrics_seconds, insert_seconds = _insert_rows(rows, BULK_INSERT_WORKERS if workers is None else workers)
+    else:
+        metrics_seconds, insert_seconds = 0.0, 0.0
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "rows": len(rows),
+        "seconds": elapsed,
+        "metrics_seconds": metrics_seconds,
+        "insert_seconds": insert_seconds,
+        "rows_per_sec": len(rows) / elapsed if elapsed > 0 else 0.0,
+    }
+    print(f"Bulk inserted {report['rows']} rows in {elapsed:.2f}s ({report['rows_per_sec']:.1f} rows/sec, "
+          f"metrics {metrics_seconds:.2f}s, insert {insert_seconds:.2f}s)") # デバッグ用
+    return report
 
 def get_chat_history():
     """データベースから全てのチャット履歴を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        # is_correctがREAL型なので、それに応じて読み込む
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
+        with get_connection_pool().connection() as conn:
+            # is_correctがREAL型なので、それに応じて読み込む
+            df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
         # is_correct カラムのデータ型を確認し、必要なら変換
         if 'is_correct' in df.columns:
              df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce') # 数値に変換、失敗したらNaN
@@ -81,29 +356,127 @@ def get_chat_history():
     except sqlite3.Error as e:
         st.error(f"履歴の取得中にエラーが発生しました: {e}")
         return pd.DataFrame() # 空のDataFrameを返す
-    finally:
-        if conn:
-            conn.close()
+
+def _history_filters(is_correct=None, date=None):
+    """絞り込み条件のWHERE句とパラメータを作成する（インデックスを使えるように日付は範囲で比較する）"""
+    conditions = []
+    params = []
+    if is_correct is not None:
+        conditions.append("is_correct = ?")
+        params.append(is_correct)
+    if date is not None:
+        # timestampは "YYYY-MM-DD HH:MM:SS" 形式の文字列なので、翌日の0時未満までを範囲で指定する
+        start = pd.Timestamp(date).strftime("%Y-%m-%d")
+        end = (pd.Timestamp(date) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        conditions.append("timestamp >= ? AND timestamp < ?")
+        params.extend([start, end])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+def query_chat_history(is_correct=None, date=None, limit=None, offset=0, before=None):
+    """
+    条件に一致するチャット履歴を新しい順に取得する（絞り込みとページングはSQLで行う）
+
+    Args:
+        is_correct (float, optional): 正確性の評価（1.0, 0.5, 0.0）で絞り込む
+        date (str or datetime.date, optional): この日付の履歴だけを取得する
+        limit (int, optional): 取得する最大件数
+        offset (int): 読み飛ばす件数（LIMIT/OFFSETによるページング）
+        before (tuple, optional): 前のページの最後の行の (timestamp, id)。指定するとそれより古い行を取得する（キーセットページング）
+
+    Returns:
+        pd.DataFrame: チャット履歴
+    """
+    where, params = _history_filters(is_correct, date)
+    if before is not None:
+        where += (" AND " if where else "WHERE ") + "(timestamp < ? OR (timestamp = ? AND id < ?))"
+        params.extend([before[0], before[0], before[1]])
+    sql = f"SELECT * FROM {TABLE_NAME} {where} ORDER BY timestamp DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([int(limit), int(offset)])
+    try:
+        with get_connection_pool().connection() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
+        if 'is_correct' in df.columns:
+            df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce')
+        return df
+    except sqlite3.Error as e:
+        st.error(f"履歴の取得中にエラーが発生しました: {e}")
+        return pd.DataFrame()
+
+def count_chat_history(is_correct=None, date=None):
+    """条件に一致するチャット履歴の件数を取得する"""
+    where, params = _history_filters(is_correct, date)
+    try:
+        with get_connection_pool().connection() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {TABLE_NAME} {where}", params).fetchone()[0]
+    except sqlite3.Error as e:
+        st.error(f"レコード数の取得中にエラーが発生しました: {e}")
+        return 0
+
+def get_history_dates(is_correct=None):
+    """
+    履歴が存在する日付の一覧を新しい順に取得する（日付の選択用。履歴の本文は読み込まない）
+
+    Args:
+        is_correct (float, optional): 正確性の評価で絞り込む
+
+    Returns:
+        list: "YYYY-MM-DD" 形式の日付のリスト
+    """
+    where, params = _history_filters(is_correct)
+    try:
+        with get_connection_pool().connection() as conn:
+            rows = conn.execute(
+                f"SELECT DISTINCT substr(timestamp, 1, 10) AS date FROM {TABLE_NAME} {where} ORDER BY date DESC", params
+            ).fetchall()
+        return [row[0] for row in rows if row[0]]
+    except sqlite3.Error as e:
+        st.error(f"日付の取得中にエラーが発生しました: {e}")
+        return []
+
+def get_history_version():
+    """
+    履歴が変わったかどうかを判断するための値を返す（集計のキャッシュのキー）
+
+    Streamlitの再実行ごとに呼ばれるため、テーブルを走査しない。このプロセスの書き込み（保存、再計算、
+    一括登録、削除）は接続プールの書き込み回数で、他のプロセスによる追加は主キーの最大値で検知する。
+
+    Returns:
+        tuple: (接続プールの書き込み回数, 最大ID)
+    """
+    pool = get_connection_pool()
+    with pool.connection() as conn:
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE_NAME}").fetchone()[0]
+    return pool.write_count, max_id
+
+def get_analysis_frame():
+    """分析レポートに使う列だけを、評価のある行について取得する（質問や回答の本文は読み込まない）"""
+    columns = ["id", "is_correct", "response_time", *METRIC_COLUMNS]
+    try:
+        with get_connection_pool().connection() as conn:
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(columns)} FROM {TABLE_NAME} WHERE is_correct IS NOT NULL", conn
+            )
+        df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce')
+        return df.dropna(subset=['is_correct'])
+    except sqlite3.Error as e:
+        print(f"エラー: 分析用データの取得中にエラーが発生しました: {e}")
+        return pd.DataFrame(columns=columns)
 
 def get_db_count():
     """データベース内のレコード数を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
-        count = c.fetchone()[0]
+        with get_connection_pool().connection() as conn:
+            count = conn.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}").fetchone()[0]
         return count
     except sqlite3.Error as e:
         st.error(f"レコード数の取得中にエラーが発生しました: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 def clear_db():
     """データベースの全レコードを削除する"""
-    conn = None
     confirmed = st.session_state.get("confirm_clear", False)
 
     if not confirmed:
@@ -112,17 +485,14 @@ def clear_db():
         return False # 削除は実行されなかった
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"DELETE FROM {TABLE_NAME}")
-        conn.commit()
+        # 書き込み待ちの行がクリア後に保存されないよう、先に反映させてから削除する
+        flush_db_writes()
+        with get_connection_pool().transaction() as conn:
+            conn.execute(f"DELETE FROM {TABLE_NAME}")
         st.success("データベースが正常にクリアされました。")
         st.session_state.confirm_clear = False # 確認状態をリセット
         return True # 削除成功
     except sqlite3.Error as e:
         st.error(f"データベースのクリア中にエラーが発生しました: {e}")
         st.session_state.confirm_clear = False # エラー時もリセット
-        return False # 削除失敗
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        return False # 削除失敗
\ No newline at end of file
@@ -0,0 +1,115 @@
+# db_connection.py
+# SQLiteの接続を使い回すスレッドセーフな接続プール（WALモードで読み込みと書き込みを並行させる）
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteConnectionPool:
+    """設定済みのSQLite接続を保持し、複数のスレッド（Streamlitのセッション）で使い回す接続プール
+
+    WALモードでは書き込み中も他の接続から読み込めるため、読み込みはプール内の任意の接続で並行して行う。
+    SQLiteは同時に1つしか書き込めないため、書き込みはプロセス内のロックで順番に行う。
+    """
+
+    def __init__(self, db_file, pool_size=4, cache_size_mb=64, busy_timeout_ms=5000):
+        """
+        初期化
+
+        Args:
+            db_file (str): SQLiteファイルのパス
+            pool_size (int): 保持する接続の最大数
+            cache_size_mb (int): 接続ごとのページキャッシュのサイズ（MB）
+            busy_timeout_ms (int): 他のプロセスが書き込み中の場合に待つ時間（ミリ秒）
+        """
+        self.db_file = db_file
+        self.pool_size = max(1, int(pool_size))
+        self.cache_size_mb = cache_size_mb
+        self.busy_timeout_ms = busy_timeout_ms
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.write_count = 0  # このプロセスで行を変更してコミットした回数（内容が変わったかどうかの判断に使う）
+
+    def _connect(self):
+        """新しい接続を作成し、WALモードと各種PRAGMAを設定する"""
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=self.busy_timeout_ms / 1000)
+        conn.execute("PRAGMA journal_mode=WAL")  # 書き込み中も読み込みをブロックしない
+        conn.execute("PRAGMA synchronous=NORMAL")  # WALモードではNORMALでも破損しない（電源断時に直近のコミットが失われうる）
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_mb * 1024)}")  # 負の値はKB単位
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def _acquire(self):
+        """プールから接続を取り出す。空で上限に達していない場合は新しく作成し、上限の場合は返却を待つ"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._pool.get()
+
+    def _release(self, conn):
+        """接続をプールに戻す（コミットされていない変更は取り消す）"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 壊れた接続は捨て、次回に作り直す
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """読み込み用の接続を借りる"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """書き込み用の接続を借りる。with文を抜けるとコミットし、例外の場合はロールバックする"""
+        with self._write_lock:
+            conn = self._acquire()
+            try:
+                changes_before = conn.total_changes
+                yield conn
+                conn.commit()
+                if conn.total_changes != changes_before:
+                    self.write_count += 1
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._release(conn)
+
+    def close(self):
+        """プールに戻っている接続を全て閉じる"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
@@ -1,12 +1,23 @@
 # llm.py
 import os
+import sys
 import torch
 from transformers import pipeline
 import streamlit as st
 import time
-from config import MODEL_NAME
+from transformers import StoppingCriteriaList
+from config import (MODEL_NAME, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB,
+                    PREFIX_CACHE_MAX_MB, PREFIX_CACHE_BLOCK_SIZE, PREFIX_CACHE_MIN_HITS, PREFIX_CACHE_MAX_ENTRY_MB,
+                    STOP_SEQUENCES, MAX_GENERATION_TIME)
 from huggingface_hub import login
 
+# day1/common の共通モジュールを読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.response_cache import ResponseCache, is_cacheable
+from common.prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from common.generation_controls import StopSequenceCriteria, DeadlineCriteria, truncate_at_stop, eos_token_ids
+from common.response_extraction import decode_new_tokens, extract_assistant_response
+
 # モデルをキャッシュして再利用
 @st.cache_resource
 def load_model():
@@ -31,47 +42,118 @@ def load_model():
         st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
         return None
 
-def generate_response(pipe, user_question):
-    """LLMを使用して質問に対する回答を生成する"""
+# 応答キャッシュはセッションをまたいで共有する
+@st.cache_resource
+def get_response_cache():
+    """応答キャッシュを取得する"""
+    return ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds=RESPONSE_CACHE_TTL,
+        db_path=RESPONSE_CACHE_DB,
+    )
+
+# 共通のプロンプト先頭部分のKVキャッシュもセッションをまたいで共有する
+@st.cache_resource
+def get_prefix_cache():
+    """プレフィックスKVキャッシュを取得する（無効の場合はNone）"""
+    if PREFIX_CACHE_MAX_MB <= 0:
+        return None
+    return PrefixKVCache(
+        max_memory_bytes=int(PREFIX_CACHE_MAX_MB * 1024 ** 2),
+        block_size=PREFIX_CACHE_BLOCK_SIZE,
+        min_hits=PREFIX_CACHE_MIN_HITS,
+        max_entry_bytes=int(PREFIX_CACHE_MAX_ENTRY_MB * 1024 ** 2),
+    )
+
+def generate_chat_with_prefix_cache(pipe, messages, prefix_cache, stop_sequences=None, deadline=None, **generate_kwargs):
+    """チャットテンプレートを適用したプロンプトの先頭部分のKVキャッシュを再利用して生成する
+
+    pipelineの return_full_text=False と同じ形式（生成された部分だけの文字列）で返す。
+    停止文字列が現れた場合はその直前まで、制限時刻（deadline）を過ぎた場合はそれまでの出力を返し、
+    後者の場合は出力に "truncated": True を付ける。prefix_cacheがNoneの場合は通常どおり生成する。
+    """
+    tokenizer = pipe.tokenizer
+    input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(pipe.model.device)
+    deadline_criteria = DeadlineCriteria([deadline], eos_token_ids(pipe.model, tokenizer))
+    stopping_criteria = StoppingCriteriaList([
+        StopSequenceCriteria(tokenizer, [stop_sequences], input_ids.shape[1]),
+        deadline_criteria,
+    ])
+    # パディングのIDが 0 のトークナイザーもあるため、None の場合だけ終了トークンを使う
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    with torch.inference_mode():
+        output_ids, usage = generate_with_prefix_cache(
+            pipe.model, input_ids, prefix_cache, pad_token_id=pad_token_id,
+            stopping_criteria=stopping_criteria, **generate_kwargs
+        )
+    if prefix_cache is not None:
+        stats = prefix_cache.stats()
+        print(f"Prefix cache: hit={usage['hit']}, reused={usage['reused_tokens']} tokens, "
+              f"hit_rate={stats['hit_rate']:.1%}, saved_prefill_tokens={stats['saved_prefill_tokens']}") # デバッグ用
+    content = decode_new_tokens(tokenizer, output_ids, input_ids.shape[1])[0]
+    content, stopped = truncate_at_stop(content, stop_sequences)
+    truncated = deadline_criteria.expired[0] and not stopped
+    return [{"generated_text": content, "truncated": truncated}]
+
+def generate_response(pipe, user_question, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, use_cache=None,
+                      stop_sequences=None, max_time=None):
+    """LLMを使用して質問に対する回答を生成する
+
+    use_cacheがNoneの場合、サンプリングなし（do_sample=False）の生成だけを応答キャッシュから再利用する。
+    キャッシュから返した回答は生成していないため、応答時間として None を返す（生成時間の統計に含めない）。
+    stop_sequences と max_time（秒）を省略した場合は config.py の STOP_SEQUENCES と MAX_GENERATION_TIME を使う。
+    """
+    stop_sequences = STOP_SEQUENCES if stop_sequences is None else stop_sequences
+    max_time = MAX_GENERATION_TIME if max_time is None else max_time
     if pipe is None:
         return "モデルがロードされていないため、回答を生成できません。", 0
 
     try:
         start_time = time.time()
+
+        # 同じ質問・パラメータの決定的な生成結果はキャッシュから返す
+        cache = get_response_cache()
+        cache_key = None
+        if is_cacheable(do_sample, use_cache):
+            params = {
+                "max_new_tokens": max_new_tokens,
+                "do_sample": do_sample,
+                "temperature": temperature,
+                "top_p": top_p,
+            }
+            if stop_sequences:
+                params["stop"] = list(stop_sequences)
+            cache_key = ResponseCache.make_key(MODEL_NAME, user_question, params)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print(f"Cache hit: returned response in {time.time() - start_time:.4f}s") # デバッグ用
+                return cached["answer"], None
+
         messages = [
             {"role": "user", "content": user_question},
         ]
-        # max_new_tokensを調整可能にする（例）
-        outputs = pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
-
-        # Gemmaの出力形式に合わせて調整が必要な場合がある
-        # 最後のassistantのメッセージを取得
-        assistant_response = ""
-        if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
-           if isinstance(outputs[0]["generated_text"], list) and len(outputs[0]["generated_text"]) > 0:
-               # messages形式の場合
-               last_message = outputs[0]["generated_text"][-1]
-               if last_message.get("role") == "assistant":
-                   assistant_response = last_message.get("content", "").strip()
-           elif isinstance(outputs[0]["generated_text"], str):
-               # 単純な文字列の場合（古いtransformers？） - プロンプト部分を除く処理が必要かも
-               # この部分はモデルやtransformersのバージョンによって調整が必要
-               full_text = outputs[0]["generated_text"]
-               # 簡単な方法：ユーザーの質問以降の部分を取得
-               prompt_end = user_question
-               response_start_index = full_text.find(prompt_end) + len(prompt_end)
-               # 応答部分のみを抽出（より堅牢な方法が必要な場合あり）
-               possible_response = full_text[response_start_index:].strip()
-               # 特定の開始トークンを探すなど、モデルに合わせた調整
-               if "<start_of_turn>model" in possible_response:
-                    assistant_response = possible_response.split("<start_of_turn>model\n")[-1].strip()
-               else:
-                    assistant_response = possible_response # フォールバック
+        prefix_cache = get_prefix_cache()
+        if prefix_cache is not None or stop_sequences or max_time:
+            # 制限時間は質問を受け付けた時点から数える
+            deadline = start_time + max_time if max_time else None
+            outputs = generate_chat_with_prefix_cache(pipe, messages, prefix_cache, stop_sequences=stop_sequences,
+                                                      deadline=deadline, max_new_tokens=max_new_tokens,
+                                                      do_sample=do_sample, temperature=temperature, top_p=top_p)
+        else:
+            outputs = pipe(messages, max_new_tokens=max_new_tokens, do_sample=do_sample, temperature=temperature, top_p=top_p,
+                           return_full_text=False)
+
+        # 生成された部分だけを受け取るため、プロンプトを探して取り除く必要はない
+        assistant_response = extract_assistant_response(outputs)
 
+        truncated = bool(outputs and outputs[0].get("truncated"))
         if not assistant_response:
-             # 上記で見つからない場合のフォールバックやデバッグ
-             print("Warning: Could not extract assistant response. Full output:", outputs)
-             assistant_response = "回答の抽出に失敗しました。"
+            assistant_response = "回答の抽出に失敗しました。"
+        elif truncated:
+            # 制限時間で打ち切った途中の回答はキャッシュしない
+            st.warning("制限時間に達したため、回答を途中で打ち切りました。")
+        elif cache_key is not None:
+            cache.set(cache_key, {"answer": assistant_response})
 
 
         end_time = time.time()
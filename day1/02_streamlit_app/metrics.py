@@ -1,79 +1,215 @@
 # metrics.py
+# NLTK・Janome・scikit-learnは読み込みに時間がかかるため、インポート時には読み込まず最初に使う時に初期化する
+import time
+_IMPORT_START = time.perf_counter()
+
+import functools
+import math
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import streamlit as st
-import nltk
-from janome.tokenizer import Tokenizer
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-# NLTKのヘルパー関数（エラー時フォールバック付き）
-try:
-    nltk.download('punkt', quiet=True)
-    from nltk.translate.bleu_score import sentence_bleu as nltk_sentence_bleu
-    from nltk.tokenize import word_tokenize as nltk_word_tokenize
-    print("NLTK loaded successfully.") # デバッグ用
-except Exception as e:
-    st.warning(f"NLTKの初期化中にエラーが発生しました: {e}\n簡易的な代替関数を使用します。")
-    def nltk_word_tokenize(text):
-        return text.split()
-    def nltk_sentence_bleu(references, candidate):
-        # 簡易BLEUスコア（完全一致/部分一致）
-        ref_words = set(references[0])
-        cand_words = set(candidate)
-        common_words = ref_words.intersection(cand_words)
-        precision = len(common_words) / len(cand_words) if cand_words else 0
-        recall = len(common_words) / len(ref_words) if ref_words else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        return f1 # F1スコアを返す（簡易的な代替）
-
-# Janome Tokenizerの初期化
-try:
-    janome_tokenizer = Tokenizer()
-except Exception as e:
-    st.error(f"Janome Tokenizerの初期化に失敗しました: {e}")
-    janome_tokenizer = None # エラー時はNoneにしておく
+import numpy as np
+import pandas as pd
+from config import TOKEN_CACHE_MAX_ENTRIES, METRICS_OFFLINE
+from token_cache import TokenizationCache
+
+# calculate_metrics が返す順番の列名
+METRIC_COLUMNS = ["bleu_score", "similarity_score", "word_count", "relevance_score", "specificity_score"]
+# 各列のSQLiteの型（列を追加した場合は、データベースの起動時に ALTER TABLE で追加される）
+METRIC_COLUMN_TYPES = {"word_count": "INTEGER"}  # 記載がない列はREAL
+# 評価指標の計算方法のバージョン（定義を変えたら上げると、保存済みの行がバックグラウンドで再計算される）
+METRICS_VERSION = 1
+# metrics_version 列を追加する前に保存された行の評価指標を計算した定義のバージョン（それらの行は再計算しない）
+LEGACY_METRICS_VERSION = 1
+
+# 遅延初期化にかかった時間（起動時間の確認用）
+_init_seconds = {}
+
+def _lazy_init(name):
+    """初回の呼び出し時だけ関数を実行して結果を保持し、かかった時間を _init_seconds に記録するデコレータ"""
+    def decorator(func):
+        lock = threading.Lock()
+        result = []
+
+        @functools.wraps(func)
+        def wrapper():
+            if not result:
+                with lock:
+                    # 複数のスレッドから同時に呼ばれても初期化は1回だけ行う
+                    if not result:
+                        start = time.perf_counter()
+                        result.append(func())
+                        _init_seconds[name] = time.perf_counter() - start
+            return result[0]
+        return wrapper
+    return decorator
+
+def _simple_word_tokenize(text):
+    return text.split()
+
+def _simple_sentence_bleu(references, candidate):
+    # 簡易BLEUスコア（完全一致/部分一致）
+    ref_words = set(references[0])
+    cand_words = set(candidate)
+    common_words = ref_words.intersection(cand_words)
+    precision = len(common_words) / len(cand_words) if cand_words else 0
+    recall = len(common_words) / len(ref_words) if ref_words else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    return f1 # F1スコアを返す（簡易的な代替）
+
+@_lazy_init("nltk")
+def get_nltk():
+    """
+    NLTKの分かち書きとBLEUの関数を取得する（初回のみ読み込み、Punktのデータがない場合はダウンロードする）
+
+    METRICS_OFFLINE が True の場合はダウンロードを試みず、データがなければ簡易的な代替関数を使う。
+
+    Returns:
+        tuple: (word_tokenize, sentence_bleu, NLTKを使えるかどうか)
+    """
+    try:
+        import nltk
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            if METRICS_OFFLINE:
+                raise
+            nltk.download('punkt', quiet=True)
+        from nltk.translate.bleu_score import sentence_bleu
+        from nltk.tokenize import word_tokenize
+        print("NLTK loaded successfully.") # デバッグ用
+        return word_tokenize, sentence_bleu, True
+    except Exception as e:
+        print(f"警告: NLTKの初期化中にエラーが発生しました: {e} 簡易的な代替関数を使用します。")
+        return _simple_word_tokenize, _simple_sentence_bleu, False
+
+@_lazy_init("janome")
+def get_janome_tokenizer():
+    """JanomeのTokenizerを取得する（初回のみ辞書を読み込む。失敗した場合はNone）"""
+    try:
+        from janome.tokenizer import Tokenizer
+        return Tokenizer()
+    except Exception as e:
+        print(f"エラー: Janome Tokenizerの初期化に失敗しました: {e}")
+        return None
+
+@_lazy_init("sklearn")
+def _get_count_vectorizer_class():
+    """scikit-learnのCountVectorizerを取得する（初回のみインポートする）"""
+    from sklearn.feature_extraction.text import CountVectorizer
+    return CountVectorizer
 
 def initialize_nltk():
-    """NLTKのデータダウンロードを試みる関数"""
+    """NLTKを初期化する（get_nltk と同じく、2回目以降は何もしない）"""
+    _, _, available = get_nltk()
+    if not available:
+        st.warning("NLTKを初期化できなかったため、簡易的な代替関数を使用します。")
+
+def get_startup_report():
+    """
+    metricsモジュールのインポートと遅延初期化にかかった時間を返す
+
+    Returns:
+        dict: import_seconds（モジュールのインポート時間）と、初期化済みの要素ごとの初期化時間（秒）
+    """
+    return {"import_seconds": _IMPORT_SECONDS, "lazy_init_seconds": dict(_init_seconds)}
+
+# トークン化の結果のキャッシュ（Janomeは (表層形, 品詞) のタプル、BLEU用は分かち書きした単語）
+janome_cache = TokenizationCache(TOKEN_CACHE_MAX_ENTRIES)
+word_token_cache = TokenizationCache(TOKEN_CACHE_MAX_ENTRIES)
+
+# 大量のテキストをまとめて形態素解析する場合に使い回すプロセスプール
+_tokenizer_pool = None
+_tokenizer_pool_workers = 0
+_tokenizer_pool_lock = threading.Lock()
+
+def _as_text(value):
+    """Noneや欠損値（NaN）を空文字列として扱う"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return str(value)
+
+def _janome_tokenize(text):
+    """Janomeで形態素解析し、(表層形, 品詞) のタプルを返す。失敗した場合はNone（プロセスプールからも呼ばれる）"""
     try:
-        nltk.download('punkt', quiet=True)
-        print("NLTK Punkt data checked/downloaded.") # デバッグ用
+        return tuple((token.surface, token.part_of_speech) for token in get_janome_tokenizer().tokenize(text))
     except Exception as e:
-        st.error(f"NLTKデータのダウンロードに失敗しました: {e}")
+        print(f"警告: Janomeでの形態素解析中にエラーが発生しました: {e}")
+        return None
 
-def calculate_metrics(answer, correct_answer):
-    """回答と正解から評価指標を計算する"""
-    word_count = 0
-    bleu_score = 0.0
-    similarity_score = 0.0
-    relevance_score = 0.0
-    specificity_score = 0.0  # 新しい指標：具体性スコア
-
-    if not answer: # 回答がない場合は計算しない
-        return bleu_score, similarity_score, word_count, relevance_score, specificity_score
-
-    # # 単語数のカウント
-    # tokenizer = Tokenizer()
-    # tokens = list(tokenizer.tokenize(answer))  # ← list() でイテレータをリストに変換
-    # word_count = len(tokens)
-
-    # --- Janomeを使った形態素解析 ---
+def _get_tokenizer_pool(workers):
+    """形態素解析用のプロセスプールを取得する（同じプロセス数なら使い回す）"""
+    global _tokenizer_pool, _tokenizer_pool_workers
+    with _tokenizer_pool_lock:
+        if _tokenizer_pool is None or _tokenizer_pool_workers != workers:
+            if _tokenizer_pool is not None:
+                _tokenizer_pool.shutdown(wait=False)
+            _tokenizer_pool = ProcessPoolExecutor(max_workers=workers)
+            _tokenizer_pool_workers = workers
+        return _tokenizer_pool
+
+def tokenize_japanese(texts, workers=0):
+    """
+    複数のテキストをJanomeで形態素解析する（キャッシュにあるテキストと重複するテキストは解析しない）
+
+    Args:
+        texts (list): テキストのリスト
+        workers (int): 2以上の場合は、キャッシュにないテキストをその数のプロセスで並列に解析する
+                       （Janomeの解析はGILを解放しないため、スレッドではなくプロセスで並列化する）
+
+    Returns:
+        list: テキストごとの (表層形, 品詞) のタプル。解析に失敗したテキストはNone
+    """
+    results = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        tokens = janome_cache.get(text)
+        if tokens is None:
+            missing.append(text)
+        else:
+            results[text] = tokens
+
+    if missing:
+        if workers and workers > 1 and len(missing) > 1:
+            chunksize = max(1, len(missing) // (workers * 4))
+            computed = _get_tokenizer_pool(workers).map(_janome_tokenize, missing, chunksize=chunksize)
+        else:
+            computed = map(_janome_tokenize, missing)
+        for text, tokens in zip(missing, computed):
+            if tokens is not None:
+                janome_cache.put(text, tokens)
+            results[text] = tokens
+    return [results[text] for text in texts]
+
+def _word_tokenize(text):
+    """BLEU用に分かち書きする。失敗した場合はNone"""
     try:
-        # Tokenizer().tokenize はイテレータを返すためリスト化する
-        tokens = list(janome_tokenizer.tokenize(answer))
+        return get_nltk()[0](text)
+    except Exception:
+        return None
+
+def get_token_cache_stats():
+    """トークン化キャッシュの統計を返す"""
+    return {"janome": janome_cache.stats(), "word_tokenize": word_token_cache.stats()}
+
+def _janome_scores(answer, tokens):
+    """Janomeの形態素解析の結果から単語数と具体性スコアを計算する"""
+    if tokens is not None:
         word_count = len(tokens) # 単語数（トークン数）
-    except Exception as e:
-        st.warning(f"Janomeでの形態素解析中にエラーが発生しました: {e}")
-        tokens = [] # エラー時は空リスト
+    else:
+        tokens = () # エラー時は空
         word_count = len(re.findall(r'\b\w+\b', answer)) # 代替として簡易単語数をカウント
 
     # 具体性スコア (Specificity Score) の計算
+    specificity_score = 0.0
     if word_count > 0 and tokens: # トークンがあり、単語数が0より大きい場合のみ計算
         count_proper_noun = 0
         count_numeral = 0
         try:
-            for token in tokens:
-                part_of_speech_info = token.part_of_speech.split(',')
+            for _, part_of_speech in tokens:
+                part_of_speech_info = part_of_speech.split(',')
                 # 品詞情報が十分にあるか確認
                 if len(part_of_speech_info) >= 2:
                     # 固有名詞をカウント
@@ -84,56 +220,154 @@ def calculate_metrics(answer, correct_answer):
                         count_numeral += 1
             specificity_score = (count_proper_noun + count_numeral) / word_count
         except Exception as e:
-            # st.warning(f"具体性スコア計算中にエラーが発生しました: {e}")
             specificity_score = 0.0 # エラー時は0
-    else:
-        specificity_score = 0.0
+    return word_count, specificity_score
 
-    # 正解がある場合のみBLEUと類似度を計算
-    if correct_answer:
-        answer_lower = answer.lower()
-        correct_answer_lower = correct_answer.lower()
+def _batch_bleu(candidates, references, max_n=4):
+    """
+    トークン列の組ごとの4-gram BLEU（平滑化なしのsentence_bleuと同じ定義）をまとめて計算する
 
-        # BLEU スコアの計算
-        try:
-            reference = [nltk_word_tokenize(correct_answer_lower)]
-            candidate = nltk_word_tokenize(answer_lower)
-            # ゼロ除算エラーを防ぐ
-            if candidate:
-                bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
-            else:
-                bleu_score = 0.0
-        except Exception as e:
-            # st.warning(f"BLEUスコア計算エラー: {e}")
-            bleu_score = 0.0 # エラー時は0
+    n-gramの一致数と総数を配列に集め、精度の幾何平均と短さのペナルティを配列演算で求める。
+    """
+    size = len(candidates)
+    matches = np.zeros((size, max_n))
+    totals = np.ones((size, max_n))
+    candidate_lengths = np.zeros(size)
+    reference_lengths = np.zeros(size)
+    for i, (candidate, reference) in enumerate(zip(candidates, references)):
+        candidate_lengths[i] = len(candidate)
+        reference_lengths[i] = len(reference)
+        for n in range(1, max_n + 1):
+            candidate_ngrams = Counter(zip(*[candidate[k:] for k in range(n)]))
+            reference_ngrams = Counter(zip(*[reference[k:] for k in range(n)]))
+            # 正解に現れる回数で頭打ちにした一致数（modified precision）
+            matches[i, n - 1] = sum((candidate_ngrams & reference_ngrams).values())
+            totals[i, n - 1] = max(1, len(candidate) - n + 1)
+
+    # NLTKは一致しないn-gramがあるとほぼ0を返すため、全てのnで一致がある組だけを計算する
+    valid = (candidate_lengths > 0) & (matches > 0).all(axis=1)
+    log_precision = np.log(np.where(valid[:, None], matches / totals, 1.0)).mean(axis=1)
+    brevity_penalty = np.where(
+        candidate_lengths > reference_lengths,
+        1.0,
+        np.exp(1 - reference_lengths / np.maximum(candidate_lengths, 1)),
+    )
+    return np.where(valid, brevity_penalty * np.exp(log_precision), 0.0)
+
+def _batch_similarity(answers, references):
+    """
+    回答と正解の組ごとのTF-IDFコサイン類似度をまとめて計算する
+
+    語彙は全ての組で共有して1回だけ作成し、疎行列の演算で類似度を求める。
+    組ごとに2文書でTfidfVectorizerを作る場合と同じ値になるよう、idfは組ごとに
+    「両方に現れる語は1.0、片方だけに現れる語は log(3/2)+1」とする（smooth_idf=True の場合の値）。
+    """
+    scores = np.zeros(len(answers))
+    targets = [i for i, (answer, reference) in enumerate(zip(answers, references)) if answer.strip() and reference.strip()]
+    if not targets:
+        return scores
+
+    vectorizer = _get_count_vectorizer_class()()
+    try:
+        vectorizer.fit([answers[i] for i in targets] + [references[i] for i in targets])
+    except ValueError:
+        # 全ての組で語彙が空の場合
+        return scores
+    answer_counts = vectorizer.transform([answers[i] for i in targets]).astype(np.float64)
+    reference_counts = vectorizer.transform([references[i] for i in targets]).astype(np.float64)
+
+    single_idf = math.log(3 / 2) + 1
+    answer_weights = answer_counts * single_idf + answer_counts.multiply(reference_counts > 0) * (1 - single_idf)
+    reference_weights = reference_counts * single_idf + reference_counts.multiply(answer_counts > 0) * (1 - single_idf)
+
+    dot = np.asarray(answer_weights.multiply(reference_weights).sum(axis=1)).ravel()
+    answer_norms = np.sqrt(np.asarray(answer_weights.multiply(answer_weights).sum(axis=1)).ravel())
+    reference_norms = np.sqrt(np.asarray(reference_weights.multiply(reference_weights).sum(axis=1)).ravel())
+    norms = answer_norms * reference_norms
+    scores[targets] = np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0)
+    return scores
+
+def calculate_metrics_batch(answers, correct_answers, as_frame=True, workers=0):
+    """
+    複数の回答と正解の組から評価指標をまとめて計算する
+
+    Args:
+        answers (list): 回答のリスト
+        correct_answers (list): 正解のリスト（answersと同じ長さ）
+        as_frame (bool): TrueならDataFrame、Falseなら列名をキーとするnumpy配列の辞書を返す
+        workers (int): 2以上の場合は、形態素解析をその数のプロセスで並列に行う
+
+    Returns:
+        pd.DataFrame or dict: 組ごとの評価指標（列は METRIC_COLUMNS）
+    """
+    answers = [_as_text(answer) for answer in answers]
+    correct_answers = [_as_text(correct_answer) for correct_answer in correct_answers]
+    if len(answers) != len(correct_answers):
+        raise ValueError("answers と correct_answers の長さが一致しません。")
+    size = len(answers)
+
+    word_counts = np.zeros(size, dtype=np.int64)
+    specificity_scores = np.zeros(size)
+    bleu_scores = np.zeros(size)
+    similarity_scores = np.zeros(size)
+    relevance_scores = np.zeros(size)
+
+    # 回答がない組は計算しない
+    answered = [i for i in range(size) if answers[i]]
+    # 同じ回答や過去に解析した回答の形態素解析は繰り返さない
+    answered_tokens = tokenize_japanese([answers[i] for i in answered], workers=workers)
+    for i, tokens in zip(answered, answered_tokens):
+        word_counts[i], specificity_scores[i] = _janome_scores(answers[i], tokens)
+
+    # 正解がある組のみBLEUと類似度を計算
+    paired = [i for i in answered if correct_answers[i]]
+    if paired:
+        answers_lower = [answers[i].lower() for i in paired]
+        correct_lower = [correct_answers[i].lower() for i in paired]
+
+        # BLEU スコアの計算（同じ文の分かち書きはキャッシュから再利用する）
+        candidates = [word_token_cache.get_or_compute(text, _word_tokenize) for text in answers_lower]
+        references = [word_token_cache.get_or_compute(text, _word_tokenize) for text in correct_lower]
+        _, sentence_bleu, nltk_available = get_nltk()
+        if nltk_available:
+            ok = [k for k in range(len(paired)) if candidates[k] is not None and references[k] is not None]
+            bleu_scores[[paired[k] for k in ok]] = _batch_bleu([candidates[k] for k in ok], [references[k] for k in ok])
+        else:
+            for k, i in enumerate(paired):
+                try:
+                    bleu_scores[i] = sentence_bleu([references[k]], candidates[k]) if candidates[k] else 0.0
+                except Exception:
+                    bleu_scores[i] = 0.0 # エラー時は0
 
         # コサイン類似度の計算
         try:
-            vectorizer = TfidfVectorizer()
-            # fit_transformはリストを期待するため、リストで渡す
-            if answer_lower.strip() and correct_answer_lower.strip(): # 空文字列でないことを確認
-                tfidf_matrix = vectorizer.fit_transform([answer_lower, correct_answer_lower])
-                similarity_score = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            else:
-                similarity_score = 0.0
+            similarity_scores[paired] = _batch_similarity(answers_lower, correct_lower)
         except Exception as e:
-            # st.warning(f"類似度スコア計算エラー: {e}")
-            similarity_score = 0.0 # エラー時は0
+            print(f"警告: 類似度スコア計算エラー: {e}")
 
         # 関連性スコア（キーワードの一致率などで簡易的に計算）
-        try:
-            answer_words = set(re.findall(r'\w+', answer_lower))
-            correct_words = set(re.findall(r'\w+', correct_answer_lower))
-            if len(correct_words) > 0:
-                common_words = answer_words.intersection(correct_words)
-                relevance_score = len(common_words) / len(correct_words)
-            else:
-                relevance_score = 0.0
-        except Exception as e:
-            # st.warning(f"関連性スコア計算エラー: {e}")
-            relevance_score = 0.0 # エラー時は0
+        for k, i in enumerate(paired):
+            answer_words = set(re.findall(r'\w+', answers_lower[k]))
+            correct_words = set(re.findall(r'\w+', correct_lower[k]))
+            if correct_words:
+                relevance_scores[i] = len(answer_words & correct_words) / len(correct_words)
 
-    return bleu_score, similarity_score, word_count, relevance_score, specificity_score
+    scores = {
+        "bleu_score": bleu_scores,
+        "similarity_score": similarity_scores,
+        "word_count": word_counts,
+        "relevance_score": relevance_scores,
+        "specificity_score": specificity_scores,
+    }
+    if as_frame:
+        return pd.DataFrame(scores, columns=METRIC_COLUMNS)
+    return scores
+
+def calculate_metrics(answer, correct_answer):
+    """回答と正解から評価指標を計算する（1組分の calculate_metrics_batch）"""
+    scores = calculate_metrics_batch([answer], [correct_answer], as_frame=False)
+    # SQLiteに保存できるよう、numpyの値をPythonの数値に変換する
+    return tuple(scores[column][0].item() for column in METRIC_COLUMNS)
 
 def get_metrics_descriptions():
     """評価指標の説明を返す"""
@@ -146,4 +380,6 @@ def get_metrics_descriptions():
         "関連性スコア (relevance_score)": "正解と回答の共通単語の割合。トピックの関連性を表す (0〜1の値)",
         "効率性スコア (efficiency_score)": "正確性を応答時間で割った値。高速で正確な回答ほど高スコア",
         "具体性スコア (specificity_score)": "回答に含まれる固有名詞と数（名詞）の割合。回答の具体性や詳細さを示す (0〜1の値)",  # 追加
-    }
\ No newline at end of file
+    }
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_START
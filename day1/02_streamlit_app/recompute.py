@@ -0,0 +1,100 @@
+# recompute.py
+# 評価指標の定義が変わった行だけを、バックグラウンドで少しずつ再計算するジョブ
+import threading
+import time
+
+
+class MetricsRecomputeJob:
+    """古いバージョンの評価指標を持つ行を、チャンクごとにバックグラウンドのスレッドで再計算するジョブ
+
+    どの行が再計算済みかはデータベースの metrics_version 列で判断するため、ジョブ自体は状態を持たない。
+    チャンクごとにコミットするので、途中で止めたりプロセスが終了したりしても、次に開始した時に残りの行から再開する。
+    """
+
+    def __init__(self, run_chunk, count_remaining, chunk_size=200, pause=0.0):
+        """
+        初期化
+
+        Args:
+            run_chunk (callable): 最大 chunk_size 行を再計算して保存し、処理した行数を返す関数
+            count_remaining (callable): 再計算が必要な残りの行数を返す関数
+            chunk_size (int): 1回のトランザクションで再計算する行数
+            pause (float): チャンクの間に待つ時間（秒）。チャット画面の書き込みに譲るため
+        """
+        self.run_chunk = run_chunk
+        self.count_remaining = count_remaining
+        self.chunk_size = max(1, int(chunk_size))
+        self.pause = max(0.0, float(pause))
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.processed = 0
+        self.chunks = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def is_running(self):
+        """ジョブが実行中かどうか"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        再計算を開始する（実行中の場合は何もしない）
+
+        Returns:
+            bool: 新しく開始した場合はTrue
+        """
+        with self._lock:
+            if self.is_running():
+                return False
+            self._stop_event.clear()
+            self.processed = 0
+            self.chunks = 0
+            self.error = None
+            self.started_at = time.time()
+            self.finished_at = None
+            self._thread = threading.Thread(target=self._run, name="metrics-recompute", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, timeout=None):
+        """実行中のチャンクが終わった時点でジョブを止める（残りは次の start で再開する）"""
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        """ワーカースレッドの本体"""
+        try:
+            while not self._stop_event.is_set():
+                count = self.run_chunk(self.chunk_size)
+                if count == 0:
+                    break
+                self.processed += count
+                self.chunks += 1
+                if self.pause:
+                    self._stop_event.wait(self.pause)
+        except Exception as e:
+            # 失敗したチャンクはコミットされていないため、次の start でやり直される
+            self.error = str(e)
+            print(f"エラー: 評価指標の再計算に失敗しました: {e}")
+        finally:
+            self.finished_at = time.time()
+            print(f"Metrics recompute finished: {self.processed} rows in {self.chunks} chunks.") # デバッグ用
+
+    def status(self):
+        """実行状況を返す"""
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "running": self.is_running(),
+            "processed": self.processed,
+            "remaining": self.count_remaining(),
+            "chunks": self.chunks,
+            "elapsed_seconds": elapsed,
+            "rows_per_sec": self.processed / elapsed if elapsed else 0.0,
+            "error": self.error,
+        }
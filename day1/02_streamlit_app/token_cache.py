@@ -0,0 +1,83 @@
+# token_cache.py
+# 同じテキストの形態素解析・分かち書きを繰り返さないための、件数上限付きLRUキャッシュ
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def text_key(text):
+    """テキストのハッシュ値をキャッシュのキーにする（長い回答文そのものをキーとして保持しない）"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class TokenizationCache:
+    """テキストごとのトークン化の結果を保持するスレッドセーフなLRUキャッシュ
+
+    Streamlitのセッションと書き込みキューのワーカーから同時に使われるため、ロックで保護する。
+    結果は変更されないようタプルで保持する。
+    """
+
+    def __init__(self, max_entries=4096):
+        """
+        初期化
+
+        Args:
+            max_entries (int): 保持する最大件数（0でキャッシュしない）
+        """
+        self.max_entries = max(0, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        """キャッシュされた結果を返す。なければNone"""
+        key = text_key(text)
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def put(self, text, tokens):
+        """結果を保存し、上限を超えた場合は最も古く使われたものから削除する"""
+        if self.max_entries == 0:
+            return
+        key = text_key(text)
+        with self._lock:
+            self._entries[key] = tuple(tokens)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, text, compute):
+        """キャッシュされた結果を返し、なければ compute(text) の結果を保存して返す（Noneは保存しない）"""
+        tokens = self.get(text)
+        if tokens is None:
+            tokens = compute(text)
+            if tokens is not None:
+                self.put(text, tokens)
+                tokens = tuple(tokens)
+        return tokens
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ヒット数、ミス数、ヒット率、保持件数を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
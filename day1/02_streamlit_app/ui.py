@@ -2,10 +2,12 @@
 import streamlit as st
 import pandas as pd
 import html
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+from database import save_to_db, flush_db_writes, get_db_write_stats, retry_failed_db_writes, bulk_insert_records, get_recompute_job, start_metrics_recompute, count_failed_metrics, get_db_count, clear_db, query_chat_history, count_chat_history, get_history_dates
+from config import HISTORY_PAGE_SIZE
+from llm import generate_response, get_response_cache, get_prefix_cache
 from data import create_sample_evaluation_data
-from metrics import get_metrics_descriptions
+from metrics import get_metrics_descriptions, get_token_cache_stats
+from analytics import get_history_analytics
 import datetime
 
 # --- LINE風スタイルの定義 ---
@@ -241,6 +243,11 @@ def display_chat_page(pipe):
     # LINE風スタイルを適用
     apply_line_style()
     
+    # バックグラウンドでの保存に失敗したフィードバックがあれば知らせる
+    failed_writes = get_db_write_stats()["dead_letters"]
+    if failed_writes:
+        st.error(f"{failed_writes} 件のフィードバックを保存できませんでした。「データ管理」ページから再試行できます。")
+
     # セッション状態の初期化
     if "current_question" not in st.session_state:
         st.session_state.current_question = ""
@@ -400,9 +407,12 @@ def display_history_page():
     apply_line_style()
     
     st.subheader("💬 トーク履歴")
-    history_df = get_chat_history()
 
-    if history_df.empty:
+    # 直前に送信したフィードバックも表示されるよう、書き込み待ちの行を反映させる
+    flush_db_writes()
+
+    # 件数だけを確認し、履歴の本文は表示する分だけ読み込む
+    if get_db_count() == 0:
         st.info("まだトーク履歴がありません。")
         return
 
@@ -410,12 +420,12 @@ def display_history_page():
     tab1, tab2 = st.tabs(["トーク履歴", "分析レポート"])
 
     with tab1:
-        display_history_list(history_df)
+        display_history_list()
 
     with tab2:
-        display_metrics_analysis(history_df)
+        display_metrics_analysis()
 
-def display_history_list(history_df):
+def display_history_list():
     """履歴リストをLINE風トーク画面で表示"""
     st.markdown("#### トーク履歴")
     
@@ -492,19 +502,14 @@ def display_history_list(history_df):
     display_option = st.session_state.filter_option
 
     filter_value = filter_options[display_option]
-    if filter_value is not None:
-        filtered_df = history_df[history_df["is_correct"].notna() & (history_df["is_correct"] == filter_value)]
-    else:
-        filtered_df = history_df
 
-    if filtered_df.empty:
+    # 履歴のある日付だけを取得する（絞り込みはSQLで行う）
+    unique_dates = get_history_dates(is_correct=filter_value)
+
+    if not unique_dates:
         st.info("選択した条件に一致する履歴はありません。")
         return
 
-    # グループ化して日付ごとに表示
-    filtered_df['date'] = pd.to_datetime(filtered_df['timestamp']).dt.date
-    unique_dates = filtered_df['date'].unique()
-    
     # ページネーション
     dates_per_page = 1  # 1日分ずつ表示
     total_pages = len(unique_dates)
@@ -514,8 +519,20 @@ def display_history_list(history_df):
     
     # 選択された日付のデータを表示
     if start_idx < len(unique_dates):
-        selected_date = unique_dates[start_idx]
-        date_df = filtered_df[filtered_df['date'] == selected_date]
+        selected_date = datetime.datetime.strptime(unique_dates[start_idx], "%Y-%m-%d").date()
+
+        # 1日分の件数が多い場合は、さらに HISTORY_PAGE_SIZE 件ずつに分けて読み込む
+        date_count = count_chat_history(is_correct=filter_value, date=selected_date)
+        row_pages = max(1, -(-date_count // HISTORY_PAGE_SIZE))
+        row_page = 1
+        if row_pages > 1:
+            row_page = st.number_input('この日のページ', min_value=1, max_value=row_pages, value=1, step=1)
+        date_df = query_chat_history(
+            is_correct=filter_value,
+            date=selected_date,
+            limit=HISTORY_PAGE_SIZE,
+            offset=(row_page - 1) * HISTORY_PAGE_SIZE,
+        )
         
         # LINE風のチャット表示
         st.markdown('<div class="chat-container">', unsafe_allow_html=True)
@@ -544,36 +561,33 @@ def display_history_list(history_df):
                     # 評価指標の表示
                     metrics_cols = st.columns(4)
                     metrics_cols[0].metric("正確性", f"{row['is_correct']:.1f}")
-                    metrics_cols[1].metric("応答時間", f"{row['response_time']:.2f}秒")
+                    metrics_cols[1].metric("応答時間", f"{row['response_time']:.2f}秒" if pd.notna(row['response_time']) else "キャッシュ")
                     metrics_cols[2].metric("単語数", f"{row['word_count']}")
                     metrics_cols[3].metric("BLEU", f"{row['bleu_score']:.4f}" if pd.notna(row['bleu_score']) else "-")
         
         st.markdown('</div>', unsafe_allow_html=True)
         
         st.caption(f"{total_pages}日分中 {start_idx+1}日目を表示")
+        if row_pages > 1:
+            st.caption(f"この日の{date_count}件中 {(row_page - 1) * HISTORY_PAGE_SIZE + 1}〜{(row_page - 1) * HISTORY_PAGE_SIZE + len(date_df)}件目を表示")
     else:
         st.info("表示できるデータがありません。")
 
 # 以下の関数は基本的な機能は変えずにスタイルだけLINE風に変更
 
-def display_metrics_analysis(history_df):
-    """評価指標の分析結果を表示する"""
+def display_metrics_analysis():
+    """評価指標の分析結果を表示する（集計は履歴が変わった場合のみ再計算される）"""
     # LINE風スタイルを適用済み
     st.write("#### 会話の分析レポート")
 
-    # is_correct が NaN のレコードを除外して分析
-    analysis_df = history_df.dropna(subset=['is_correct'])
-    if analysis_df.empty:
+    analytics = get_history_analytics()
+    if analytics is None:
         st.warning("分析可能なデータがありません。")
         return
 
-    # 評価ラベルをLINEらしく変更
-    accuracy_labels = {1.0: '👍 正確!', 0.5: '🤔 まあまあ', 0.0: '👎 いまいち'}
-    analysis_df['評価'] = analysis_df['is_correct'].map(accuracy_labels)
-
     # 正確性の分布
     st.write("##### フィードバック分布")
-    accuracy_counts = analysis_df['評価'].value_counts()
+    accuracy_counts = analytics["accuracy_counts"]
     if not accuracy_counts.empty:
         st.bar_chart(accuracy_counts)
     else:
@@ -582,8 +596,7 @@ def display_metrics_analysis(history_df):
     # 以下の分析部分は基本的な機能を維持
     # 応答時間と他の指標の関係
     st.write("##### 応答時間とその他の指標の関係")
-    metric_options = ["bleu_score", "similarity_score", "relevance_score", "word_count"]
-    valid_metric_options = [m for m in metric_options if m in analysis_df.columns and analysis_df[m].notna().any()]
+    valid_metric_options = analytics["valid_metric_options"]
 
     if valid_metric_options:
         metric_option = st.selectbox(
@@ -592,7 +605,7 @@ def display_metrics_analysis(history_df):
             key="metric_select"
         )
 
-        chart_data = analysis_df[['response_time', metric_option, '評価']].dropna()
+        chart_data = analytics["scatter"][['response_time', metric_option, '評価']].dropna()
         if not chart_data.empty:
              st.scatter_chart(
                 chart_data,
@@ -600,6 +613,8 @@ def display_metrics_analysis(history_df):
                 y=metric_option,
                 color='評価',
             )
+             if analytics["rows"] > len(analytics["scatter"]):
+                 st.caption(f"直近の {len(analytics['scatter'])} 件を表示しています（全 {analytics['rows']} 件）。")
         else:
             st.info(f"選択された指標 ({metric_option}) と応答時間の有効なデータがありません。")
 
@@ -608,37 +623,28 @@ def display_metrics_analysis(history_df):
 
     # 全体の評価指標の統計
     st.write("##### 評価指標の統計")
-    stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
-    valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
-    if valid_stats_cols:
-        metrics_stats = analysis_df[valid_stats_cols].describe()
-        st.dataframe(metrics_stats)
+    if analytics["stats"] is not None:
+        st.dataframe(analytics["stats"])
     else:
         st.info("統計情報を計算できる評価指標データがありません。")
 
     # 正確性レベル別の平均スコア
     st.write("##### 評価レベル別の平均スコア")
-    if valid_stats_cols and '評価' in analysis_df.columns:
-        try:
-            accuracy_groups = analysis_df.groupby('評価')[valid_stats_cols].mean()
-            st.dataframe(accuracy_groups)
-        except Exception as e:
-            st.warning(f"評価別スコアの集計中にエラーが発生しました: {e}")
+    if analytics["group_means"] is not None:
+        st.dataframe(analytics["group_means"])
+    elif analytics["group_error"]:
+        st.warning(f"評価別スコアの集計中にエラーが発生しました: {analytics['group_error']}")
     else:
          st.info("評価レベル別の平均スコアを計算できるデータがありません。")
 
     # カスタム評価指標：効率性スコア
     st.write("##### 効率性スコア (正確性 / (応答時間 + 0.1))")
-    if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
-        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'].fillna(0) + 0.1)
-        if 'id' in analysis_df.columns:
-            top_efficiency = analysis_df.sort_values('efficiency_score', ascending=False).head(10)
-            if not top_efficiency.empty:
-                st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
-            else:
-                st.info("効率性スコアデータがありません。")
+    top_efficiency = analytics["top_efficiency"]
+    if top_efficiency is not None:
+        if not top_efficiency.empty:
+            st.bar_chart(top_efficiency)
         else:
-             st.bar_chart(analysis_df.sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
+            st.info("効率性スコアデータがありません。")
     else:
         st.info("効率性スコアを計算するための応答時間データがありません。")
 
@@ -663,6 +669,87 @@ def display_data_page():
             if clear_db():
                 st.rerun()
 
+    # 評価データの一括取り込み
+    uploaded_file = st.file_uploader(
+        "評価データを取り込む（CSV / JSONL。question, answer, correct_answer 列が必須）",
+        type=["csv", "jsonl"],
+        key="import_file",
+    )
+    if uploaded_file is not None and st.button("取り込み", key="import_button"):
+        try:
+            with st.spinner("評価指標を計算して取り込んでいます..."):
+                report = bulk_insert_records(uploaded_file)
+            st.success(f"{report['rows']} 件を取り込みました（{report['seconds']:.2f}秒、{report['rows_per_sec']:.1f} 件/秒）。")
+        except Exception as e:
+            st.error(f"取り込み中にエラーが発生しました: {e}")
+
+    # 応答キャッシュの状況
+    st.subheader("応答キャッシュ")
+    cache_stats = get_response_cache().stats()
+    cache_cols = st.columns(4)
+    cache_cols[0].metric("ヒット", cache_stats["hits"])
+    cache_cols[1].metric("ミス", cache_stats["misses"])
+    cache_cols[2].metric("ヒット率", f"{cache_stats['hit_rate']:.1%}")
+    cache_cols[3].metric("保持件数", cache_stats["entries"])
+    st.caption("サンプリングなし（do_sample=False）の生成結果のみキャッシュされます。")
+    if st.button("応答キャッシュをクリア", key="clear_response_cache"):
+        get_response_cache().clear()
+        st.rerun()
+
+    # プレフィックスKVキャッシュの状況
+    prefix_cache = get_prefix_cache()
+    if prefix_cache is not None:
+        st.subheader("プレフィックスKVキャッシュ")
+        prefix_stats = prefix_cache.stats()
+        prefix_cols = st.columns(4)
+        prefix_cols[0].metric("ヒット率", f"{prefix_stats['hit_rate']:.1%}")
+        prefix_cols[1].metric("省略したプレフィル", f"{prefix_stats['saved_prefill_tokens']} トークン")
+        prefix_cols[2].metric("保持件数", prefix_stats["entries"])
+        prefix_cols[3].metric("使用メモリ", f"{prefix_stats['memory_bytes'] / 1024 ** 2:.1f} MB")
+
+    # 書き込みキューの状況
+    st.subheader("フィードバックの保存")
+    write_stats = get_db_write_stats()
+    write_cols = st.columns(4)
+    write_cols[0].metric("保存待ち", write_stats["pending"])
+    write_cols[1].metric("保存済み", write_stats["written"])
+    write_cols[2].metric("失敗（累計）", write_stats["failed"])
+    write_cols[3].metric("再試行待ち", write_stats["dead_letters"])
+    if write_stats["last_error"]:
+        st.error(f"最後の保存エラー: {write_stats['last_error']}")
+    if write_stats["dead_letters"] > 0 and st.button("失敗した保存を再試行", key="retry_failed_writes"):
+        count = retry_failed_db_writes()
+        if flush_db_writes():
+            st.success(f"{count} 件を保存しました。")
+
+    # 形態素解析キャッシュの状況
+    st.subheader("形態素解析キャッシュ")
+    janome_stats = get_token_cache_stats()["janome"]
+    token_cols = st.columns(3)
+    token_cols[0].metric("ヒット率", f"{janome_stats['hit_rate']:.1%}")
+    token_cols[1].metric("保持件数", janome_stats["entries"])
+    token_cols[2].metric("上限", janome_stats["max_entries"])
+
+    # 評価指標の再計算の状況
+    st.subheader("評価指標の再計算")
+    recompute_status = get_recompute_job().status()
+    recompute_cols = st.columns(4)
+    recompute_cols[0].metric("状態", "実行中" if recompute_status["running"] else "停止中")
+    recompute_cols[1].metric("再計算済み", recompute_status["processed"])
+    recompute_cols[2].metric("残り", recompute_status["remaining"])
+    recompute_cols[3].metric("失敗", count_failed_metrics(), help="評価指標を計算できなかった行（METRICS_VERSION を上げるまで再試行しない）")
+    if recompute_status["error"]:
+        st.error(f"再計算中にエラーが発生しました: {recompute_status['error']}")
+    st.caption("評価指標の計算方法のバージョン（metrics.METRICS_VERSION）より古い行だけを再計算します。中断しても残りの行から再開します。")
+    if recompute_status["running"]:
+        if st.button("再計算を停止", key="stop_recompute"):
+            get_recompute_job().stop()
+            st.rerun()
+    elif recompute_status["remaining"] > 0:
+        if st.button("再計算を開始", key="start_recompute"):
+            start_metrics_recompute()
+            st.rerun()
+
     # 評価指標に関する解説
     st.subheader("評価指標の説明")
     metrics_info = get_metrics_descriptions()
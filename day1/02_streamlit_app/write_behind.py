@@ -0,0 +1,187 @@
+# write_behind.py
+# 書き込みをキューに積んで即座に戻り、バックグラウンドのスレッドでまとめて処理するライトビハインドキュー
+import queue
+import threading
+import time
+from collections import deque
+
+
+class WriteBehindError(Exception):
+    """ライトビハインドキューの書き込みが再試行しても失敗した場合の例外"""
+    pass
+
+
+class WriteBehindQueue:
+    """投入された項目をバックグラウンドのワーカースレッドでまとめて処理するキュー
+
+    submit は項目をキューに積むだけなので、呼び出し元（Streamlitのスクリプト）は書き込みの完了を待たない。
+    ワーカーは最初の項目を受け取ってから flush_interval 秒以内に届いた項目を最大 batch_size 件まとめ、
+    process_batch に渡す（データベースへの書き込みなら1回のトランザクションにできる）。
+    失敗したまとまりは間隔を空けて max_retries 回まで再試行し、それでも失敗した項目は捨てずに
+    dead_letters に残す（retry_failed で再投入できる）。last_error は dead_letters が空の状態で
+    書き込みに成功した時点で消す。
+    """
+
+    def __init__(self, process_batch, batch_size=32, flush_interval=0.5, name="write-behind", max_retries=3,
+                 retry_backoff=0.5, retry_backoff_max=5.0, max_dead_letters=1000):
+        """
+        初期化
+
+        Args:
+            process_batch (callable): 項目のリストを受け取って処理する関数（ワーカースレッドで呼ばれる）
+            batch_size (int): 1回にまとめて処理する最大件数
+            flush_interval (float): 最初の項目が届いてから、続く項目を待つ最大時間（秒）
+            name (str): ワーカースレッドの名前
+            max_retries (int): 失敗したまとまりを再試行する回数
+            retry_backoff (float): 最初の再試行までの待ち時間（秒）。再試行のたびに2倍にする
+            retry_backoff_max (float): 再試行までの待ち時間の上限（秒）
+            max_dead_letters (int): 再試行しても失敗した項目を保持する最大件数
+        """
+        self.process_batch = process_batch
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.0, float(flush_interval))
+        self._queue = queue.Queue()
+        self._pending = 0  # 投入されてまだ処理が終わっていない件数
+        self._condition = threading.Condition()
+        self._closed = False
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = max(0.0, float(retry_backoff))
+        self.retry_backoff_max = max(self.retry_backoff, float(retry_backoff_max))
+        self.dead_letters = deque(maxlen=max(1, int(max_dead_letters)))
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.last_error = None
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """項目をキューに積む（処理の完了は待たない）"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("WriteBehindQueue は既に閉じられています。")
+            self._pending += 1
+        self._queue.put(item)
+
+    def pending(self):
+        """処理が終わっていない件数を返す"""
+        with self._condition:
+            return self._pending
+
+    def flush(self, timeout=None):
+        """
+        それまでに投入された項目の処理が全て終わるまで待つ
+
+        Args:
+            timeout (float, optional): 待つ最大時間（秒）。Noneの場合は終わるまで待つ
+
+        Returns:
+            bool: 全て処理し終えた場合はTrue、タイムアウトした場合はFalse
+
+        Raises:
+            WriteBehindError: 待っている間に、再試行しても書き込めなかった項目があった場合
+        """
+        with self._condition:
+            failed_before = self.failed
+            done = self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+            failed = self.failed - failed_before
+            last_error = self.last_error
+        if failed:
+            raise WriteBehindError(f"{failed} 件の書き込みに失敗しました: {last_error}")
+        return done
+
+    def retry_failed(self):
+        """
+        再試行しても失敗して dead_letters に残っている項目をキューに再投入する
+
+        Returns:
+            int: 再投入した件数
+        """
+        items = []
+        while self.dead_letters:
+            items.append(self.dead_letters.popleft())
+        for item in items:
+            self.submit(item)
+        return len(items)
+
+    def close(self, timeout=None):
+        """新しい項目の受け付けを止め、残りを処理し終えてからワーカーを終了する（終了時に呼ぶ）"""
+        with self._condition:
+            if self._closed:
+                return True
+            self._closed = True
+        self._queue.put(None)  # ワーカーへの終了の合図
+        self._worker.join(timeout)
+        flushed = not self._worker.is_alive()
+        if not flushed:
+            print(f"警告: 書き込み待ちの {self.pending()} 件を処理しきれませんでした。")
+        return flushed
+
+    def _collect_batch(self, first):
+        """最初の項目に続いて届いた項目を、件数と時間の上限までまとめる"""
+        batch = [first]
+        stop = False
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        """ワーカースレッドの本体"""
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect_batch(first)
+            error = self._process_with_retry(batch)
+            with self._condition:
+                self.batches += 1
+                if error is None:
+                    self.written += len(batch)
+                    if not self.dead_letters:
+                        # 失敗した項目が残っていなければ回復したとみなし、古いエラーを表示しない
+                        self.last_error = None
+                else:
+                    # ワーカーを止めないよう、失敗した項目は dead_letters に残して次に進む
+                    self.failed += len(batch)
+                    self.last_error = str(error)
+                    self.dead_letters.extend(batch)
+                    print(f"エラー: {len(batch)} 件の書き込みに失敗しました: {error}")
+                self._pending -= len(batch)
+                self._condition.notify_all()
+
+    def _process_with_retry(self, batch):
+        """まとまりを処理し、失敗した場合は間隔を空けて再試行する。最後まで失敗した場合はその例外を返す"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.process_batch(batch)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    return e
+                self.retries += 1
+                delay = min(self.retry_backoff * (2 ** attempt), self.retry_backoff_max)
+                print(f"警告: 書き込みに失敗したため {delay:.1f} 秒後に再試行します: {e}")
+                time.sleep(delay)
+
+    def stats(self):
+        """処理状況を返す"""
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "failed": self.failed,
+            "retries": self.retries,
+            "dead_letters": len(self.dead_letters),
+            "batches": self.batches,
+            "last_error": self.last_error,
+        }
@@ -1,25 +1,121 @@
 import os
+import json
+import asyncio
+import threading
 import torch
-from transformers import pipeline
+from transformers import pipeline, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 import time
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
+import sys
 import uvicorn
 import nest_asyncio
 from pyngrok import ngrok
+from batching import MicroBatcher
+from worker import InferenceExecutor, QueueFullError
+import server_metrics
+from cpu_profile import CPUInferenceProfile, select_dtype, apply_thread_settings, optimize_model, run_microbenchmark
+from model_registry import ModelRegistry, UnknownModelError
+from scheduler import FairScheduler, UnknownPriorityError, parse_priority_weights
+from speculative import load_draft_model
+from token_budget import AdaptiveTokenBudget
+
+# day1/common の共通モジュールを読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.response_cache import ResponseCache, is_cacheable
+from common.prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from common.generation_controls import StopSequenceCriteria, DeadlineCriteria, truncate_at_stop, eos_token_ids
+from common.response_extraction import decode_new_tokens, extract_assistant_response
 
 # --- 設定 ---
 # モデル名を設定
 MODEL_NAME = "google/gemma-2-2b-jpn-it"  # お好みのモデルに変更可能です
 print(f"モデル名を設定: {MODEL_NAME}")
 
+# リクエストで指定できるモデル（カンマ区切り）。MODEL_NAMEはデフォルトモデルとして常に利用可能
+AVAILABLE_MODELS = [name.strip() for name in os.environ.get("AVAILABLE_MODELS", "").split(",") if name.strip()]
+# 常駐させるモデルの合計メモリ量の上限（GB）。超える場合は最も古く使われたモデルから解放する（未設定の場合は無制限）
+MODEL_MEMORY_BUDGET_GB = float(os.environ["MODEL_MEMORY_BUDGET_GB"]) if os.environ.get("MODEL_MEMORY_BUDGET_GB") else None
+
+# マイクロバッチングの設定（同時に届いた /generate リクエストを1回の推論にまとめる）
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))  # 1回の推論にまとめる最大リクエスト数
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "20"))  # 追加のリクエストを待つ時間（ミリ秒）
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", "1024"))  # /generate/batch で1回に受け付ける最大プロンプト数
+
+# 推論ワーカーの設定（推論はイベントループとは別の専用スレッドで実行する）
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))  # 推論を実行するスレッド数
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "32"))  # 実行中に加えて待機できるリクエスト数
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", "5"))  # キュー満杯時に返すRetry-After
+
+# 優先度付きスケジューリングの設定（対話的なリクエストを一括処理より先に推論する）
+# 優先度は X-Priority ヘッダーまたはリクエストの priority で指定する（interactive / normal / batch）
+PRIORITY_WEIGHTS = parse_priority_weights(os.environ.get("PRIORITY_WEIGHTS", ""))  # 例: "interactive=8,normal=4,batch=1"
+SCHEDULER_CAPACITY = int(os.environ.get("SCHEDULER_CAPACITY", "0")) or INFERENCE_WORKERS * BATCH_MAX_SIZE  # 同時に推論するリクエスト数
+# 1クライアント（X-Client-Id ヘッダー、なければ接続元IP）が同時に推論できるリクエスト数（0で無制限）
+PER_CLIENT_MAX_CONCURRENCY = int(os.environ.get("PER_CLIENT_MAX_CONCURRENCY", "4")) or None
+
+# 生成トークン数の設定（max_new_tokens を省略したリクエストは、推論待ちが多いほど短く生成する）
+DEFAULT_MAX_NEW_TOKENS = int(os.environ.get("DEFAULT_MAX_NEW_TOKENS", "512"))  # 空いているときのデフォルト
+MIN_MAX_NEW_TOKENS = int(os.environ.get("MIN_MAX_NEW_TOKENS", "64"))  # 最も混雑しているときのデフォルト
+TOKEN_BUDGET_LOW_WATERMARK = int(os.environ.get("TOKEN_BUDGET_LOW_WATERMARK", str(INFERENCE_WORKERS)))  # この数まではデフォルトのまま
+TOKEN_BUDGET_HIGH_WATERMARK = int(os.environ.get("TOKEN_BUDGET_HIGH_WATERMARK", str(INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE)))  # この数で最小
+
+# 応答キャッシュの設定（サンプリングなしの生成結果を再利用する）
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256"))  # メモリに保持する最大件数
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))  # 有効期間（秒）
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB") or None  # SQLiteファイル（指定すると再起動後も残る）
+
+# プレフィックスKVキャッシュの設定（共通のプロンプト先頭部分のプレフィルを省略する）
+PREFIX_CACHE_MAX_MB = float(os.environ.get("PREFIX_CACHE_MAX_MB", "256"))  # モデルごとのKVキャッシュの上限（0で無効）
+PREFIX_CACHE_BLOCK_SIZE = int(os.environ.get("PREFIX_CACHE_BLOCK_SIZE", "16"))  # 先頭部分を数える単位（トークン数）
+PREFIX_CACHE_MIN_HITS = int(os.environ.get("PREFIX_CACHE_MIN_HITS", "2"))  # KVキャッシュを作成するまでの出現回数
+PREFIX_CACHE_MAX_ENTRY_MB = float(os.environ.get("PREFIX_CACHE_MAX_ENTRY_MB", "64"))  # 1件の上限（ヒットごとにコピーする量）
+
+# 投機的デコーディングの設定（小さいドラフトモデルが先読みしたトークンをメインモデルがまとめて検証する）
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME") or None  # ドラフトモデル（未設定の場合は無効）
+SPECULATIVE_NUM_TOKENS = int(os.environ.get("SPECULATIVE_NUM_TOKENS", "5"))  # 1回の検証で先読みするトークン数
+SPECULATIVE_MIN_ACCEPTANCE = float(os.environ.get("SPECULATIVE_MIN_ACCEPTANCE", "0.4"))  # これを下回ると通常のデコードに戻す
+SPECULATIVE_PROBE_INTERVAL = int(os.environ.get("SPECULATIVE_PROBE_INTERVAL", "20"))  # 無効にした後、再確認するまでのリクエスト数
+
+# CPUで推論する場合の設定（CPU_PRECISION, CPU_QUANTIZE_INT8, CPU_NUM_THREADS, CPU_NUM_INTEROP_THREADS,
+# CPU_TORCH_COMPILE, CPU_BENCHMARK の環境変数で変更可能）
+CPU_PROFILE = CPUInferenceProfile.from_env()
+
 # --- モデル設定クラス ---
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        self.AVAILABLE_MODELS = AVAILABLE_MODELS
+        self.MODEL_MEMORY_BUDGET_GB = MODEL_MEMORY_BUDGET_GB
+        self.BATCH_MAX_SIZE = BATCH_MAX_SIZE
+        self.BATCH_WINDOW_MS = BATCH_WINDOW_MS
+        self.MAX_BATCH_ITEMS = MAX_BATCH_ITEMS
+        self.INFERENCE_WORKERS = INFERENCE_WORKERS
+        self.INFERENCE_QUEUE_SIZE = INFERENCE_QUEUE_SIZE
+        self.RETRY_AFTER_SECONDS = RETRY_AFTER_SECONDS
+        self.PRIORITY_WEIGHTS = PRIORITY_WEIGHTS
+        self.SCHEDULER_CAPACITY = SCHEDULER_CAPACITY
+        self.PER_CLIENT_MAX_CONCURRENCY = PER_CLIENT_MAX_CONCURRENCY
+        self.DEFAULT_MAX_NEW_TOKENS = DEFAULT_MAX_NEW_TOKENS
+        self.MIN_MAX_NEW_TOKENS = MIN_MAX_NEW_TOKENS
+        self.TOKEN_BUDGET_LOW_WATERMARK = TOKEN_BUDGET_LOW_WATERMARK
+        self.TOKEN_BUDGET_HIGH_WATERMARK = TOKEN_BUDGET_HIGH_WATERMARK
+        self.RESPONSE_CACHE_MAX_ENTRIES = RESPONSE_CACHE_MAX_ENTRIES
+        self.RESPONSE_CACHE_TTL = RESPONSE_CACHE_TTL
+        self.RESPONSE_CACHE_DB = RESPONSE_CACHE_DB
+        self.PREFIX_CACHE_MAX_MB = PREFIX_CACHE_MAX_MB
+        self.PREFIX_CACHE_BLOCK_SIZE = PREFIX_CACHE_BLOCK_SIZE
+        self.PREFIX_CACHE_MIN_HITS = PREFIX_CACHE_MIN_HITS
+        self.PREFIX_CACHE_MAX_ENTRY_MB = PREFIX_CACHE_MAX_ENTRY_MB
+        self.DRAFT_MODEL_NAME = DRAFT_MODEL_NAME
+        self.SPECULATIVE_NUM_TOKENS = SPECULATIVE_NUM_TOKENS
+        self.SPECULATIVE_MIN_ACCEPTANCE = SPECULATIVE_MIN_ACCEPTANCE
+        self.SPECULATIVE_PROBE_INTERVAL = SPECULATIVE_PROBE_INTERVAL
+        self.CPU_PROFILE = CPU_PROFILE
 
 config = Config(MODEL_NAME)
 
@@ -39,6 +135,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエスト数と処理時間を記録するミドルウェア
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # ラベルにはURLではなく一致したルートのパステンプレートを使い、404やスキャナーのパスで系列が増え続けないようにする
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", None) or "unmatched"
+        # ストリーミングの場合はレスポンス開始までの時間になる
+        server_metrics.REQUEST_LATENCY.labels(endpoint=endpoint).observe(time.perf_counter() - start)
+        server_metrics.REQUESTS_TOTAL.labels(endpoint=endpoint, method=request.method, status=str(status)).inc()
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
@@ -47,98 +160,500 @@ class Message(BaseModel):
 # 直接プロンプトを使用した簡略化されたリクエスト
 class SimpleGenerationRequest(BaseModel):
     prompt: str
-    max_new_tokens: Optional[int] = 512
+    model: Optional[str] = None  # 使用するモデル名（省略時はデフォルトモデル）
+    max_new_tokens: Optional[int] = None  # 省略時はサーバーの混雑度に応じたデフォルト値（最大 DEFAULT_MAX_NEW_TOKENS）
+    stop: Optional[List[str]] = None  # 停止文字列（現れた時点で生成を止め、その直前までを返す）
+    max_time: Optional[float] = None  # 受信からの制限時間（秒）。超えた場合はそれまでの出力を truncated=True で返す
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    use_cache: Optional[bool] = None  # 応答キャッシュの利用（None: サンプリングなしの場合のみ利用）
+    priority: Optional[str] = None  # 優先度（interactive / normal / batch）。省略時は X-Priority ヘッダー
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    model: Optional[str] = None  # 生成に使用したモデル名
+    batch_size: int = 1  # このリクエストと一緒に推論されたリクエスト数
+    cached: bool = False  # 応答キャッシュから返した場合はTrue
+    prefix_cache: Optional[Dict[str, Any]] = None  # プレフィックスKVキャッシュの利用状況（ヒット、再利用したトークン数、ヒット率など）
+    speculative: Optional[Dict[str, Any]] = None  # 投機的デコーディングの受理率と速度向上（使用しなかった場合はNone）
+    max_new_tokens: Optional[int] = None  # 実際に使用した生成トークン数の上限
+    stop_reason: Optional[str] = None  # 生成が終わった理由（eos / length / stop_sequence / deadline）
+    truncated: bool = False  # 制限時間により途中で打ち切った場合はTrue
+
+# 複数のプロンプトをまとめて処理するリクエスト
+class BatchGenerationRequest(BaseModel):
+    requests: List[SimpleGenerationRequest]
+    batch_size: Optional[int] = None  # 1回の推論にまとめる件数（省略時はBATCH_MAX_SIZE）
+    priority: Optional[str] = None  # 優先度（省略時は X-Priority ヘッダー、なければ batch）
+
+class BatchItemResponse(GenerationResponse):
+    index: int  # 入力リストでの位置
+    queue_time: float = 0.0  # バッチ処理の開始から、この項目の推論が始まるまでの時間
+    error: Optional[str] = None  # この項目の生成に失敗した場合のエラー
+
+class BatchGenerationResponse(BaseModel):
+    results: List[BatchItemResponse]  # 入力と同じ順序の結果
+    total_time: float
 
 # --- モデル関連の関数 ---
-# モデルのグローバル変数
-model = None
+# 応答キャッシュ
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=config.RESPONSE_CACHE_TTL,
+    db_path=config.RESPONSE_CACHE_DB,
+)
+
+# モデルごとのプレフィックスKVキャッシュ
+prefix_caches = {}
+prefix_caches_lock = threading.Lock()
+
+def get_prefix_cache(model_name):
+    """モデルのプレフィックスKVキャッシュを取得する（無効の場合はNone）"""
+    if config.PREFIX_CACHE_MAX_MB <= 0:
+        return None
+    with prefix_caches_lock:
+        if model_name not in prefix_caches:
+            prefix_caches[model_name] = PrefixKVCache(
+                max_memory_bytes=int(config.PREFIX_CACHE_MAX_MB * 1024 ** 2),
+                block_size=config.PREFIX_CACHE_BLOCK_SIZE,
+                min_hits=config.PREFIX_CACHE_MIN_HITS,
+                max_entry_bytes=int(config.PREFIX_CACHE_MAX_ENTRY_MB * 1024 ** 2),
+            )
+        return prefix_caches[model_name]
+
+def drop_prefix_cache(model_name):
+    """モデルが解放されたときに、そのモデルのプレフィックスKVキャッシュも破棄する"""
+    with prefix_caches_lock:
+        if prefix_caches.pop(model_name, None) is not None:
+            print(f"モデル '{model_name}' のプレフィックスKVキャッシュを破棄しました。")
+
+def prefix_cache_memory_bytes(model_name):
+    """モデルのプレフィックスKVキャッシュが使用しているメモリ量（バイト）を返す"""
+    with prefix_caches_lock:
+        prefix_cache = prefix_caches.get(model_name)
+    return prefix_cache.stats()["memory_bytes"] if prefix_cache is not None else 0
 
-def load_model():
+def prefix_cache_metadata(prefix_cache, usage):
+    """レスポンスに含めるプレフィックスKVキャッシュの情報を作成する"""
+    if prefix_cache is None:
+        return None
+    stats = prefix_cache.stats()
+    return {
+        "hit": usage["hit"],
+        "reused_tokens": usage["reused_tokens"],
+        "hit_rate": stats["hit_rate"],
+        "saved_prefill_tokens": stats["saved_prefill_tokens"],
+    }
+
+def load_model(model_name=None):
     """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+    model_name = model_name or config.MODEL_NAME
     try:
+        load_start = time.time()
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
+        if device == "cpu":
+            # CPUではbf16命令がないと遅いため、設定とCPUの対応状況からdtypeを選ぶ
+            profile = config.CPU_PROFILE
+            apply_thread_settings(profile)
+            torch_dtype = select_dtype(profile)
+            print(f"CPU推論プロファイル: {profile}, dtype={torch_dtype}")
+        else:
+            torch_dtype = torch.bfloat16
         pipe = pipeline(
             "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
+            model=model_name,
+            model_kwargs={"torch_dtype": torch_dtype},
             device=device
         )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+        # バッチ推論でパディングできるようにする（デコーダモデルは左側にパディング）
+        if pipe.tokenizer.pad_token_id is None:
+            pipe.tokenizer.pad_token_id = pipe.tokenizer.eos_token_id
+        pipe.tokenizer.padding_side = "left"
+        if device == "cpu":
+            optimize_model(pipe, config.CPU_PROFILE)
+        pipe.speculative_decoder = load_speculative_decoder(model_name, pipe, device, torch_dtype)
+        load_time = time.time() - load_start
+        server_metrics.MODEL_LOAD_SECONDS.labels(model=model_name).set(load_time)
+        print(f"モデル '{model_name}' の読み込みに成功しました ({load_time:.1f}秒)")
+        if device == "cpu" and config.CPU_PROFILE.benchmark:
+            tokens_per_sec = run_microbenchmark(pipe, max_new_tokens=config.CPU_PROFILE.benchmark_tokens)
+            server_metrics.STARTUP_TOKENS_PER_SECOND.labels(model=model_name).set(tokens_per_sec)
+            if pipe.speculative_decoder is not None:
+                # 通常のデコード速度の初期値として、投機的デコーディングのspeedupの計算に使う
+                pipe.speculative_decoder.baseline_tokens_per_sec = tokens_per_sec
         return pipe
     except Exception as e:
-        error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
+        error_msg = f"モデル '{model_name}' の読み込みに失敗: {e}"
         print(error_msg)
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
-def extract_assistant_response(outputs, user_prompt):
-    """モデルの出力からアシスタントの応答を抽出する"""
-    assistant_response = ""
+def load_speculative_decoder(model_name, pipe, device, torch_dtype):
+    """ドラフトモデルが設定されていれば読み込む（失敗した場合は投機的デコーディングを使わない）"""
+    if not config.DRAFT_MODEL_NAME or config.DRAFT_MODEL_NAME == model_name:
+        return None
     try:
-        if outputs and isinstance(outputs, list) and len(outputs) > 0 and outputs[0].get("generated_text"):
-            generated_output = outputs[0]["generated_text"]
-            
-            if isinstance(generated_output, list):
-                # メッセージフォーマットの場合
-                if len(generated_output) > 0:
-                    last_message = generated_output[-1]
-                    if isinstance(last_message, dict) and last_message.get("role") == "assistant":
-                        assistant_response = last_message.get("content", "").strip()
-                    else:
-                        # 予期しないリスト形式の場合は最後の要素を文字列として試行
-                        print(f"警告: 最後のメッセージの形式が予期しないリスト形式です: {last_message}")
-                        assistant_response = str(last_message).strip()
-
-            elif isinstance(generated_output, str):
-                # 文字列形式の場合
-                full_text = generated_output
-                
-                # 単純なプロンプト入力の場合、プロンプト後の全てを抽出
-                if user_prompt:
-                    prompt_end_index = full_text.find(user_prompt)
-                    if prompt_end_index != -1:
-                        prompt_end_pos = prompt_end_index + len(user_prompt)
-                        assistant_response = full_text[prompt_end_pos:].strip()
-                    else:
-                        # 元のプロンプトが見つからない場合は、生成されたテキストをそのまま返す
-                        assistant_response = full_text
-                else:
-                    assistant_response = full_text
-            else:
-                print(f"警告: 予期しない出力タイプ: {type(generated_output)}")
-                assistant_response = str(generated_output).strip()  # 文字列に変換
-
+        return load_draft_model(
+            config.DRAFT_MODEL_NAME,
+            pipe.tokenizer,
+            device,
+            torch_dtype,
+            num_assistant_tokens=config.SPECULATIVE_NUM_TOKENS,
+            min_acceptance=config.SPECULATIVE_MIN_ACCEPTANCE,
+            probe_interval=config.SPECULATIVE_PROBE_INTERVAL,
+        )
     except Exception as e:
-        print(f"応答の抽出中にエラーが発生しました: {e}")
+        print(f"警告: ドラフトモデル '{config.DRAFT_MODEL_NAME}' を読み込めないため、投機的デコーディングを無効にします: {e}")
         traceback.print_exc()
-        assistant_response = "応答の抽出に失敗しました。"  # エラーメッセージを設定
+        return None
+
+class FirstTokenTimer(StoppingCriteria):
+    """最初のトークンが生成された時刻（プレフィルの完了時刻）を記録する"""
+
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        return False
+
+def run_generation_batch(prompts, params, options=None):
+    """同じ生成パラメータのプロンプトをまとめて1回の推論で処理する
+
+    tokenize / prefill / decode の各段階の時間を計測するため、pipelineを経由せずに
+    トークナイザとmodel.generateを直接呼び出す。
+    """
+    model_name, max_new_tokens, do_sample, temperature, top_p = params
+    model = registry.acquire(model_name)
+    if model is None:
+        raise RuntimeError(f"モデル '{model_name}' が読み込まれていません")
+    try:
+        return _run_generation_batch(model, get_prefix_cache(model_name), prompts,
+                                     max_new_tokens, do_sample, temperature, top_p, options)
+    finally:
+        registry.release(model_name)
+
+def _run_generation_batch(model, prefix_cache, prompts, max_new_tokens, do_sample, temperature, top_p, options=None):
+    """レジストリから取得したpipelineのモデルでバッチ推論を実行する
+
+    1件だけのバッチでは、ドラフトモデルがあれば投機的デコーディングを行い、
+    なければ共通の先頭部分のKVキャッシュを再利用してプレフィルを省略する。
+    （左パディングされた複数件のバッチでは位置がずれるため再利用しない）
+    options はプロンプトごとの {"stop": 停止文字列のリスト, "deadline": 制限時刻} で、行ごとに生成を打ち切る。
+    """
+    tokenizer = model.tokenizer
+    options = options or [{} for _ in prompts]
+    print(f"バッチ推論を開始: {len(prompts)}件")
+
+    with server_metrics.stage_timer("tokenize"):
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+
+    timer = FirstTokenTimer()
+    prompt_length = inputs["input_ids"].shape[1]
+    stop_criteria = StopSequenceCriteria(tokenizer, [item.get("stop") for item in options], prompt_length)
+    deadline_criteria = DeadlineCriteria([item.get("deadline") for item in options], eos_token_ids(model.model, tokenizer))
+    generate_kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        do_sample=do_sample,
+        temperature=temperature,
+        top_p=top_p,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([timer, stop_criteria, deadline_criteria]),
+    )
+    speculative_decoder = getattr(model, "speculative_decoder", None)
+    use_speculative = len(prompts) == 1 and speculative_decoder is not None and speculative_decoder.should_use()
+    speculative_info = None
+    usage = {"hit": False, "reused_tokens": 0}
+    generate_start = time.time()
+    with torch.inference_mode():
+        if use_speculative:
+            output_ids, speculative_info = speculative_decoder.generate(
+                model.model, tokenizer, inputs["input_ids"], inputs["attention_mask"], **generate_kwargs)
+        elif len(prompts) == 1 and prefix_cache is not None:
+            output_ids, usage = generate_with_prefix_cache(model.model, inputs["input_ids"], prefix_cache, **generate_kwargs)
+        else:
+            output_ids = model.model.generate(**inputs, **generate_kwargs)
+    generate_end = time.time()
+
+    # 最初のトークンが出るまでをprefill、それ以降をdecodeとして記録する
+    first_token_time = timer.first_token_time or generate_end
+    server_metrics.observe_stage("prefill", first_token_time - generate_start)
+    server_metrics.observe_stage("decode", generate_end - first_token_time)
+    new_tokens = output_ids[:, prompt_length:]
+    token_count = int((new_tokens != tokenizer.pad_token_id).sum())
+    server_metrics.observe_generation(token_count, generate_end - generate_start, batch_size=len(prompts))
+    print(f"バッチ推論が完了しました。({token_count}トークン, {generate_end - generate_start:.2f}秒)")
+    if speculative_info is not None:
+        server_metrics.SPECULATIVE_ACCEPTANCE.observe(speculative_info["acceptance_rate"])
+        print(f"投機的デコーディング: 受理率={speculative_info['acceptance_rate']:.2f}, speedup={speculative_info['speedup']}")
+    elif len(prompts) == 1 and speculative_decoder is not None:
+        # 通常のデコードの速度を記録し、投機的デコーディングのspeedupの基準にする
+        speculative_decoder.record_baseline(token_count, generate_end - generate_start)
+
+    # pipelineの return_full_text=False と同じ形式（プロンプトごとに [{"generated_text": 生成部分}]）で返す
+    # プロンプト部分はデコードせず、生成されたトークンだけをデコードする
+    with server_metrics.stage_timer("detokenize"):
+        texts = decode_new_tokens(tokenizer, output_ids, prompt_length)
+    metadata = prefix_cache_metadata(prefix_cache, usage)
+    results = []
+    for i, text in enumerate(texts):
+        text, stopped = truncate_at_stop(text, options[i].get("stop"))
+        if stopped:
+            stop_reason = "stop_sequence"
+        elif deadline_criteria.expired[i]:
+            stop_reason = "deadline"
+        elif int((new_tokens[i] != tokenizer.pad_token_id).sum()) >= max_new_tokens:
+            stop_reason = "length"
+        else:
+            stop_reason = "eos"
+        results.append([{
+            "generated_text": text,
+            "prefix_cache": metadata,
+            "speculative": speculative_info,
+            "stop_reason": stop_reason,
+            "truncated": stop_reason == "deadline",
+        }])
+    return results
+
+# モデルレジストリ（リクエストで指定されたモデルを必要になった時点で読み込む）
+registry = ModelRegistry(
+    load_model,
+    default_model=config.MODEL_NAME,
+    available_models=config.AVAILABLE_MODELS,
+    memory_budget_bytes=int(config.MODEL_MEMORY_BUDGET_GB * 1024 ** 3) if config.MODEL_MEMORY_BUDGET_GB else None,
+    on_evict=drop_prefix_cache,
+    extra_memory_fn=prefix_cache_memory_bytes,
+)
+
+# 推論専用ワーカー（イベントループをブロックしないように推論はここで実行する）
+inference_executor = InferenceExecutor(
+    max_workers=config.INFERENCE_WORKERS,
+    max_queue_size=config.INFERENCE_QUEUE_SIZE,
+    retry_after=config.RETRY_AFTER_SECONDS,
+)
+
+# リクエストをまとめて推論するバッチャー
+batcher = MicroBatcher(
+    run_generation_batch,
+    max_batch_size=config.BATCH_MAX_SIZE,
+    batch_window_ms=config.BATCH_WINDOW_MS,
+    executor=inference_executor,
+)
+
+# 推論待ちの数に応じて max_new_tokens のデフォルト値を下げる
+token_budget = AdaptiveTokenBudget(
+    inference_executor.pending,
+    default_max_new_tokens=config.DEFAULT_MAX_NEW_TOKENS,
+    min_max_new_tokens=config.MIN_MAX_NEW_TOKENS,
+    low_watermark=config.TOKEN_BUDGET_LOW_WATERMARK,
+    high_watermark=config.TOKEN_BUDGET_HIGH_WATERMARK,
+)
+
+# 優先度クラスごとの重み付き公平スケジューラ（全ての推論はここで順番を待つ）
+scheduler = FairScheduler(
+    capacity=config.SCHEDULER_CAPACITY,
+    weights=config.PRIORITY_WEIGHTS,
+    default_priority="normal",
+    per_client_limit=config.PER_CLIENT_MAX_CONCURRENCY,
+)
+
+# キューの長さを /metrics で公開する
+server_metrics.register_queue("batcher", batcher.queue_depth)
+for priority_name in config.PRIORITY_WEIGHTS:
+    server_metrics.register_queue(f"scheduler_{priority_name}", lambda name=priority_name: scheduler.waiting(name))
+server_metrics.register_queue("inference", inference_executor.pending)
+server_metrics.register_cache(response_cache.stats)
+server_metrics.register_model_memory(lambda: registry.summary()["resident_memory_bytes"])
+
+def acquire_inference_slot():
+    """推論キューの受け付け枠を確保する。満杯の場合はRetry-After付きの503を返す"""
+    try:
+        inference_executor.acquire()
+    except QueueFullError as e:
+        print(f"推論キューが満杯です (受け付け中: {inference_executor.pending()}件)")
+        raise HTTPException(
+            status_code=503,
+            detail="サーバーが混み合っています。しばらくしてから再試行してください。",
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
-    if not assistant_response:
-        print("警告: アシスタントの応答を抽出できませんでした。完全な出力:", outputs)
-        # デフォルトまたはエラー応答を返す
-        assistant_response = "応答を生成できませんでした。"
+# --- ストリーミング生成 ---
+class CountingTextStreamer(TextIteratorStreamer):
+    """生成されたトークン数と最初のトークンの時刻を記録するストリーマー"""
 
-    return assistant_response
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True, **kwargs)
+        self.token_count = 0
+        self.first_token_time = None
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+            self.token_count += value.numel()
+        super().put(value)
+
+class CancelledCriteria(StoppingCriteria):
+    """クライアントが切断したときに生成を打ち切る"""
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.cancel_event.is_set()
+
+def format_sse(data, event=None):
+    """Server-Sent Events形式の文字列を作成する"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_generation(request, model_name, model, priority, client_id, max_new_tokens, deadline=None):
+    """トークンをデコードされた順にSSEで送信する非同期ジェネレータ
+
+    modelはregistry.acquireで取得済みのpipelineで、ストリームの終了時に解放する。
+    生成を開始した後は、切断された場合も含めて生成スレッドが終わった時点で受け付け枠とモデルを解放する。
+    生成はスケジューラで優先度に応じた順番が来てから開始する。
+    停止文字列が現れた場合は、その直前までを送信して終了する。
+    """
+    loop = asyncio.get_running_loop()
+    start_time = time.time()
+    tokenizer = model.tokenizer
+    streamer = CountingTextStreamer(tokenizer)
+    cancel_event = threading.Event()
+
+    prefix_cache = get_prefix_cache(model_name)
+    with server_metrics.stage_timer("tokenize"):
+        inputs = tokenizer(request.prompt, return_tensors="pt").to(model.device)
+    stop_criteria = StopSequenceCriteria(tokenizer, [request.stop], inputs["input_ids"].shape[1])
+    deadline_criteria = DeadlineCriteria([deadline], eos_token_ids(model.model, tokenizer))
+    generate_kwargs = dict(
+        streamer=streamer,
+        max_new_tokens=max_new_tokens,
+        do_sample=request.do_sample,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([CancelledCriteria(cancel_event), stop_criteria, deadline_criteria]),
+    )
+    generation_error = []
+    generate_times = {}
+    prefix_usage = {"hit": False, "reused_tokens": 0}
+
+    def release_scheduler_slot():
+        """スケジューラはイベントループ上で操作するため、生成スレッドからはループに依頼して返却する"""
+        try:
+            loop.call_soon_threadsafe(scheduler.release, client_id)
+        except RuntimeError:
+            pass  # 終了処理でループが閉じられている場合
+
+    def generate():
+        try:
+            if not cancel_event.is_set():
+                generate_times["start"] = time.time()
+                with torch.inference_mode():
+                    _, usage = generate_with_prefix_cache(model.model, inputs["input_ids"], prefix_cache, **generate_kwargs)
+                prefix_usage.update(usage)
+                generate_times["end"] = time.time()
+            else:
+                streamer.end()  # 実行前に切断された場合は生成しない
+        except Exception as e:
+            generation_error.append(e)
+            streamer.end()  # 待機中の読み出し側を解放する
+        finally:
+            # モデルの使用が終わってから解放する（切断されても生成中のモデルは解放・退避されない）
+            release_scheduler_slot()
+            inference_executor.release()
+            registry.release(model_name)
+
+    slot_acquired = False
+    submitted = False
+    try:
+        # 優先度に応じて順番を待ってから、生成を推論専用ワーカーで実行する
+        await scheduler.acquire(priority, client_id)
+        slot_acquired = True
+        inference_executor.submit(generate)
+        submitted = True
+
+        generated_text = ""
+        sent_length = 0
+        stopped = False
+        while True:
+            # streamerの読み出しはブロックするため、スレッドで待つ
+            text = await loop.run_in_executor(None, next, streamer, None)
+            if text is None:
+                break
+            if text:
+                generated_text += text
+                visible_text, stopped = truncate_at_stop(generated_text, request.stop)
+                if len(visible_text) > sent_length:
+                    yield format_sse({"token": visible_text[sent_length:]})
+                    sent_length = len(visible_text)
+                if stopped:
+                    generated_text = visible_text
+                    break
+
+        if generation_error:
+            yield format_sse({"detail": f"応答の生成中にエラーが発生しました: {generation_error[0]}"}, event="error")
+            return
+
+        end_time = time.time()
+        response_time = end_time - start_time
+        ttft = (streamer.first_token_time - start_time) if streamer.first_token_time else None
+        decode_time = (end_time - streamer.first_token_time) if streamer.first_token_time else 0.0
+        tokens_per_sec = streamer.token_count / decode_time if decode_time > 0 else 0.0
+        if streamer.first_token_time and "start" in generate_times:
+            generate_end = generate_times.get("end", end_time)
+            server_metrics.observe_stage("prefill", streamer.first_token_time - generate_times["start"])
+            server_metrics.observe_stage("decode", generate_end - streamer.first_token_time)
+            server_metrics.observe_generation(streamer.token_count, generate_end - generate_times["start"])
+        if stopped:
+            stop_reason = "stop_sequence"
+        elif deadline_criteria.expired[0]:
+            stop_reason = "deadline"
+        elif streamer.token_count >= max_new_tokens:
+            stop_reason = "length"
+        else:
+            stop_reason = "eos"
+        print(f"ストリーミング生成完了: {streamer.token_count}トークン, TTFT={ttft}, {tokens_per_sec:.2f} tokens/s")
+        yield format_sse({
+            "generated_text": generated_text.strip(),
+            "model": model_name,
+            "response_time": response_time,
+            "time_to_first_token": ttft,
+            "tokens_generated": streamer.token_count,
+            "tokens_per_sec": tokens_per_sec,
+            "prefix_cache": prefix_cache_metadata(prefix_cache, prefix_usage),
+            "max_new_tokens": max_new_tokens,
+            "stop_reason": stop_reason,
+            "truncated": stop_reason == "deadline",
+        }, event="done")
+    finally:
+        # クライアント切断時も含め、生成スレッドに停止を依頼する。受け付け枠とモデルは生成スレッドが終了時に解放する
+        cancel_event.set()
+        if not submitted:
+            if slot_acquired:
+                scheduler.release(client_id)
+            inference_executor.release()
+            registry.release(model_name)
 
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
     """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+    batcher.start()
+    # デフォルトモデルはバックグラウンドで読み込み、読み込み中もポートは接続を受け付ける
+    registry.start_loading()
+    print("起動時にモデルの読み込みをバックグラウンドで開始しました。/health/ready で準備完了を確認できます。")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時にバッチ処理ループと推論ワーカーを停止"""
+    await batcher.stop()
+    inference_executor.shutdown()
 
 @app.get("/")
 async def root():
@@ -147,70 +662,307 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """ヘルスチェックエンドポイント"""
-    global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    """ヘルスチェックエンドポイント（常駐しているモデルとメモリ使用量も返す）"""
+    summary = {**registry.summary(), "scheduler": scheduler.stats(), "token_budget": token_budget.stats()}
+    if not registry.is_ready():
+        return {"status": "error", "message": "No model loaded", "state": registry.state(), **summary}
+
+    return {"status": "ok", "model": config.MODEL_NAME, "state": registry.state(), **summary}
+
+@app.get("/health/live")
+async def liveness_check():
+    """プロセスが応答できるかどうかを返す（モデルの読み込み状態には依存しない）"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """モデルの読み込みが完了し、推論リクエストを受け付けられるかどうかを返す"""
+    if not registry.is_ready():
+        body = {"status": "not_ready", "state": registry.state()}
+        if registry.error():
+            body["error"] = registry.error()
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+    return {"status": "ready", "model": config.MODEL_NAME}
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+@app.get("/models")
+async def list_models():
+    """利用可能なモデルと読み込み状態を返す"""
+    return registry.summary()
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクスを返す"""
+    body, content_type = server_metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/cache")
+async def cache_stats():
+    """応答キャッシュとプレフィックスKVキャッシュのヒット数・ミス数を返す"""
+    with prefix_caches_lock:
+        prefix_stats = {name: cache.stats() for name, cache in prefix_caches.items()}
+    return {**response_cache.stats(), "prefix_cache": prefix_stats}
+
+@app.delete("/cache")
+async def clear_cache():
+    """応答キャッシュを削除する"""
+    response_cache.clear()
+    return {"status": "ok"}
+
+def make_cache_key(model_name, request, max_new_tokens):
+    """リクエストの応答キャッシュのキーを作成する（キャッシュを利用しない場合はNone）"""
+    if not is_cacheable(request.do_sample, request.use_cache):
+        return None
+    params = {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+    }
+    if request.stop:
+        params["stop"] = request.stop
+    return ResponseCache.make_key(model_name, request.prompt, params)
+
+def generation_params(model_name, request, max_new_tokens):
+    """バッチにまとめられるかどうかを判定するための生成パラメータ"""
+    return (model_name, max_new_tokens, request.do_sample, request.temperature, request.top_p)
+
+def generation_options(request, start_time):
+    """同じバッチ内でプロンプトごとに異なってよい設定（停止文字列と制限時刻）"""
+    return {
+        "stop": request.stop,
+        "deadline": start_time + request.max_time if request.max_time else None,
+    }
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request):
     """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
+    model_name = resolve_model_name(request.model)
+    priority = resolve_priority(request.priority, http_request)
+    client_id = get_client_id(http_request)
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    # 同じプロンプト・パラメータの決定的な生成結果はキャッシュから返す
+    start_time = time.time()
+    max_new_tokens = token_budget.resolve(request.max_new_tokens)
+    cache_key = make_cache_key(model_name, request, max_new_tokens)
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print("応答キャッシュにヒットしました。")
+            return GenerationResponse(
+                generated_text=cached["generated_text"],
+                response_time=time.time() - start_time,
+                model=model_name,
+                batch_size=0,
+                cached=True,
+                max_new_tokens=max_new_tokens
+            )
+
+    require_model(model_name)
 
+    acquire_inference_slot()
     try:
-        start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
-
-        # プロンプトテキストで直接応答を生成
-        print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-        print("モデル推論が完了しました。")
+        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={max_new_tokens}")  # 長いプロンプトは切り捨て
+
+        # 優先度に応じて順番を待ってから、同時に届いた他のリクエストとまとめて推論する
+        async with scheduler.slot(priority, client_id):
+            outputs, batch_size = await batcher.submit(
+                request.prompt, generation_params(model_name, request, max_new_tokens), generation_options(request, start_time))
+
+        prefix_cache_info = outputs[0].get("prefix_cache") if outputs else None
+        speculative_info = outputs[0].get("speculative") if outputs else None
+        stop_reason = outputs[0].get("stop_reason") if outputs else None
+        truncated = bool(outputs[0].get("truncated")) if outputs else False
 
         # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
+        with server_metrics.stage_timer("extract_assistant_response"):
+            assistant_response = extract_assistant_response(outputs, default="応答を生成できませんでした。")
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
 
         end_time = time.time()
         response_time = end_time - start_time
         print(f"応答生成時間: {response_time:.2f}秒")
 
+        # 制限時間で打ち切った途中の出力はキャッシュしない
+        if cache_key is not None and not truncated:
+            response_cache.set(cache_key, {"generated_text": assistant_response})
+
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            model=model_name,
+            batch_size=batch_size,
+            prefix_cache=prefix_cache_info,
+            speculative=speculative_info,
+            max_new_tokens=max_new_tokens,
+            stop_reason=stop_reason,
+            truncated=truncated
         )
 
     except Exception as e:
         print(f"シンプル応答生成中にエラーが発生しました: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    finally:
+        inference_executor.release()
+
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest, http_request: Request):
+    """生成されたトークンをServer-Sent Eventsで逐次返す"""
+    model_name = resolve_model_name(request.model)
+    priority = resolve_priority(request.priority, http_request)
+    require_model(model_name)
+    start_time = time.time()
+    max_new_tokens = token_budget.resolve(request.max_new_tokens)
+    deadline = generation_options(request, start_time)["deadline"]
+
+    print(f"ストリーミングリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={max_new_tokens}")
+    # 受け付け枠とモデルはストリームの終了時に解放される
+    acquire_inference_slot()
+    model = registry.acquire(model_name)
+    if model is None:
+        inference_executor.release()
+        require_model(model_name)
+    return StreamingResponse(
+        stream_generation(request, model_name, model, priority, get_client_id(http_request), max_new_tokens, deadline),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def sort_by_prompt_length(items):
+    """
+    パディングを減らすため、プロンプトの長さが近いもの同士が同じバッチになるように並べる
+
+    バケット分けには文字数で十分なため、イベントループ上でトークナイザは使わない（トークン化は推論時に1回だけ行う）。
+    """
+    return sorted(items, key=lambda item: len(item[1].prompt))
+
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(request: BatchGenerationRequest, http_request: Request):
+    """複数のプロンプトをプロンプト長の近いものごとにまとめて生成し、入力と同じ順序で返す"""
+    start_time = time.time()
+    # 一括処理は明示的に指定されない限り最も低い優先度で実行する
+    priority = resolve_priority(request.priority, http_request, default="batch")
+    client_id = get_client_id(http_request)
+    if len(request.requests) > config.MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"1回のリクエストで処理できるプロンプトは{config.MAX_BATCH_ITEMS}件までです。")
+    bucket_size = max(1, request.batch_size or config.BATCH_MAX_SIZE)
+
+    # キャッシュにあるものは先に結果を埋め、残りを生成パラメータごとにまとめる
+    results = [None] * len(request.requests)
+    groups = {}
+    for index, item in enumerate(request.requests):
+        model_name = resolve_model_name(item.model)
+        max_new_tokens = token_budget.resolve(item.max_new_tokens)
+        cache_key = make_cache_key(model_name, item, max_new_tokens)
+        cached = response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            results[index] = BatchItemResponse(
+                index=index, generated_text=cached["generated_text"], response_time=0.0,
+                model=model_name, batch_size=0, cached=True, max_new_tokens=max_new_tokens,
+            )
+        else:
+            groups.setdefault(generation_params(model_name, item, max_new_tokens), []).append((index, item, cache_key))
+
+    if groups:
+        for model_name in {params[0] for params in groups}:
+            require_model(model_name)
+        print(f"バッチリクエストを受信: {len(request.requests)}件 (生成: {sum(len(items) for items in groups.values())}件)")
+        buckets = []
+        for params, items in groups.items():
+            items = sort_by_prompt_length(items)
+            buckets.extend((params, items[offset:offset + bucket_size]) for offset in range(0, len(items), bucket_size))
+        for bucket_number, (params, bucket) in enumerate(buckets):
+            # 受け付け枠はバケットごとに確保し、大きな一括リクエストも推論キューの上限に従わせる
+            try:
+                acquire_inference_slot()
+            except HTTPException:
+                if bucket_number == 0:
+                    raise
+                # 途中のバケットが受け付けられなかった場合は、そのバケットだけエラーとして返す
+                for index, _, _ in bucket:
+                    results[index] = BatchItemResponse(
+                        index=index, generated_text="", response_time=0.0, model=params[0], batch_size=len(bucket),
+                        error="サーバーが混み合っているため処理できませんでした。しばらくしてから再試行してください。",
+                    )
+                continue
+            try:
+                bucket_start = time.time()
+                try:
+                    # バケットごとに順番を待つため、一括処理の合間に優先度の高いリクエストが割り込める
+                    async with scheduler.slot(priority, client_id, cost=len(bucket)):
+                        bucket_start = time.time()
+                        outputs = await inference_executor.run(
+                            run_generation_batch,
+                            [item.prompt for _, item, _ in bucket],
+                            params,
+                            [generation_options(item, start_time) for _, item, _ in bucket],
+                        )
+                except Exception as e:
+                    print(f"バッチ生成中にエラーが発生しました: {e}")
+                    traceback.print_exc()
+                    for index, _, _ in bucket:
+                        results[index] = BatchItemResponse(
+                            index=index, generated_text="", response_time=time.time() - bucket_start,
+                            queue_time=bucket_start - start_time, model=params[0], batch_size=len(bucket),
+                            error=f"応答の生成中にエラーが発生しました: {str(e)}",
+                        )
+                    continue
+                bucket_time = time.time() - bucket_start
+                for (index, item, cache_key), output in zip(bucket, outputs):
+                    with server_metrics.stage_timer("extract_assistant_response"):
+                        assistant_response = extract_assistant_response(output, default="応答を生成できませんでした。")
+                    truncated = bool(output[0].get("truncated"))
+                    if cache_key is not None and not truncated:
+                        response_cache.set(cache_key, {"generated_text": assistant_response})
+                    results[index] = BatchItemResponse(
+                        index=index, generated_text=assistant_response, response_time=bucket_time,
+                        queue_time=bucket_start - start_time, model=params[0], batch_size=len(bucket),
+                        prefix_cache=output[0].get("prefix_cache"),
+                        speculative=output[0].get("speculative"),
+                        max_new_tokens=params[1],
+                        stop_reason=output[0].get("stop_reason"),
+                        truncated=truncated,
+                    )
+            finally:
+                inference_executor.release()
+
+    total_time = time.time() - start_time
+    print(f"バッチリクエストの処理が完了しました: {len(results)}件, {total_time:.2f}秒")
+    return BatchGenerationResponse(results=results, total_time=total_time)
+
+def resolve_model_name(model_name):
+    """リクエストのモデル名を解決する。利用できないモデルの場合は404を返す"""
+    try:
+        return registry.resolve(model_name)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def resolve_priority(priority, http_request, default=None):
+    """リクエストの priority、X-Priority ヘッダーの順に優先度を決める。未知の優先度の場合は400を返す"""
+    try:
+        return scheduler.resolve_priority(priority or http_request.headers.get("X-Priority") or default)
+    except UnknownPriorityError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def get_client_id(http_request):
+    """同時実行数を制限する単位となるクライアントの識別子（X-Client-Id ヘッダー、なければ接続元IP）"""
+    client_id = http_request.headers.get("X-Client-Id")
+    if client_id:
+        return client_id
+    return http_request.client.host if http_request.client else None
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+def require_model(model_name=None):
+    """モデルが利用可能か確認する。未読み込みの場合は読み込みを開始し、Retry-After付きの503を返す"""
+    if registry.is_ready(model_name):
+        return model_name
+    if registry.start_loading(model_name):
+        print(f"モデル '{model_name}' が読み込まれていないため、バックグラウンドで読み込みを開始しました。")
+    raise HTTPException(
+        status_code=503,
+        detail=f"モデルを準備中です (状態: {registry.state(model_name)})。後でもう一度お試しください。",
+        headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)},
+    )
 
 print("FastAPIエンドポイントを定義しました。")
 
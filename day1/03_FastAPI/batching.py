@@ -0,0 +1,115 @@
+# batching.py
+# /generate へのリクエストをまとめて1回の推論で処理するマイクロバッチング
+import asyncio
+import traceback
+
+
+class MicroBatcher:
+    """待機中のリクエストを一定時間または最大バッチサイズまで集め、まとめて推論するスケジューラ"""
+
+    def __init__(self, run_batch, max_batch_size=8, batch_window_ms=20, executor=None):
+        """
+        初期化
+
+        Args:
+            run_batch (callable): (prompts, params, options) を受け取り、プロンプトごとの出力リストを返す同期関数
+            max_batch_size (int): 1回の推論にまとめる最大リクエスト数
+            batch_window_ms (float): 最初のリクエストから追加のリクエストを待つ時間（ミリ秒）
+            executor (InferenceExecutor, optional): 推論を実行する専用ワーカー。省略時はデフォルトのスレッドプールを使用
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.batch_window = max(0.0, batch_window_ms / 1000.0)
+        self.executor = executor
+        self._queue = None
+        self._worker = None
+
+    def start(self):
+        """バッチ処理ループを開始する（イベントループ上で呼び出すこと）"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._batch_loop())
+            print(f"MicroBatcher: 開始しました (max_batch_size={self.max_batch_size}, window={self.batch_window * 1000:.0f}ms)")
+
+    async def stop(self):
+        """バッチ処理ループを停止する"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def queue_depth(self):
+        """推論待ちのリクエスト数を返す"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, prompt, params, options=None):
+        """
+        リクエストをキューに追加し、自分の分の推論結果を待つ
+
+        Args:
+            prompt (str): プロンプト文字列
+            params (tuple): 生成パラメータ。同じパラメータのリクエストだけが同じバッチにまとめられる
+            options (dict, optional): 停止文字列や制限時刻など、バッチ内で行ごとに異なってよい設定
+
+        Returns:
+            tuple: (モデルの出力, 実際のバッチサイズ)
+        """
+        if self._worker is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, params, options or {}, future))
+        return await future
+
+    async def _collect_batch(self):
+        """最初のリクエストを待ち、ウィンドウ内に届いたリクエストを最大バッチサイズまで集める"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                # ウィンドウ終了後も、既に届いているものは取り込む
+                if self._queue.empty():
+                    break
+                batch.append(self._queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_in_worker(self, prompts, params, options):
+        """推論をワーカースレッドで実行し、その間もイベントループが次のリクエストを受け付けられるようにする"""
+        if self.executor is not None:
+            return await self.executor.run(self.run_batch, prompts, params, options)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.run_batch, prompts, params, options)
+
+    async def _batch_loop(self):
+        """リクエストを集めてパラメータごとにまとめて推論するループ"""
+        while True:
+            batch = await self._collect_batch()
+
+            # 生成パラメータが異なるリクエストは1回のforwardにまとめられないためグループ化する
+            groups = {}
+            for prompt, params, options, future in batch:
+                groups.setdefault(params, []).append((prompt, options, future))
+
+            for params, items in groups.items():
+                prompts = [prompt for prompt, _, _ in items]
+                options = [item_options for _, item_options, _ in items]
+                try:
+                    outputs = await self._run_in_worker(prompts, params, options)
+                    for (_, _, future), output in zip(items, outputs):
+                        if not future.done():
+                            future.set_result((output, len(items)))
+                except Exception as e:
+                    print(f"MicroBatcher: バッチ推論中にエラーが発生しました: {e}")
+                    traceback.print_exc()
+                    for _, _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
@@ -0,0 +1,289 @@
+# benchmark.py
+# python-client.py の AsyncLLMClient を使ってプロンプト集を一定のレートまたは同時実行数で送信し、
+# レイテンシ（p50/p95/p99）、最初のトークンまでの時間、スループット、エラー率を計測する
+#
+# 使用例:
+#   python benchmark.py --url https://xxxx.ngrok-free.app --concurrency 4 --num-requests 100
+#   python benchmark.py --url http://localhost:8000 --rate 2 --duration 60 --output results.json
+#   python benchmark.py --stub --concurrency 8 --num-requests 50   # モデルなしでオフライン実行
+import os
+import json
+import time
+import asyncio
+import argparse
+import importlib.util
+from collections import Counter
+
+DEFAULT_PROMPTS = [
+    "AIについて100文字で教えてください",
+    "機械学習と深層学習の違いを説明してください",
+    "日本の首都はどこですか？",
+    "Pythonでリストを逆順にする方法を教えてください",
+    "大規模言語モデルの推論を高速化する方法を3つ挙げてください",
+    "おすすめの勉強方法を教えてください",
+]
+
+
+def load_client_module():
+    """ファイル名にハイフンを含む python-client.py をモジュールとして読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-client.py")
+    spec = importlib.util.spec_from_file_location("python_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_prompts(path=None):
+    """
+    プロンプト集を読み込む
+
+    Args:
+        path (str, optional): 1行1プロンプトのテキストファイル、または "prompt" キーを持つJSONLファイル。
+                              省略時は DEFAULT_PROMPTS を使用する
+
+    Returns:
+        list: プロンプト文字列のリスト
+    """
+    if not path:
+        return list(DEFAULT_PROMPTS)
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                prompts.append(json.loads(line)["prompt"])
+            else:
+                prompts.append(line)
+    if not prompts:
+        raise ValueError(f"プロンプトが見つかりません: {path}")
+    return prompts
+
+
+def percentile(values, q):
+    """線形補間でパーセンタイル値を計算する（values が空の場合はNone）"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_distribution(values):
+    """平均・p50/p95/p99・最大値をまとめる"""
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+async def send_request(client, prompt, params, stream):
+    """
+    1件のリクエストを送信し、計測結果を返す
+
+    Returns:
+        dict: {"ok", "latency", "ttft", "tokens", "error"}
+    """
+    record = {"ok": False, "latency": None, "ttft": None, "tokens": None, "error": None}
+    start = time.perf_counter()
+    try:
+        if stream:
+            async for chunk in client.generate_stream(prompt, **params):
+                if chunk["event"] == "token":
+                    if record["ttft"] is None:
+                        record["ttft"] = time.perf_counter() - start
+                elif chunk["event"] == "done":
+                    record["tokens"] = chunk.get("tokens_generated")
+        else:
+            result = await client.generate(prompt, **params)
+            record["tokens"] = result.get("tokens_generated")
+        record["ok"] = True
+    except Exception as e:
+        record["error"] = str(e)[:200]
+    record["latency"] = time.perf_counter() - start
+    return record
+
+
+def prompt_stream(prompts, num_requests, deadline):
+    """プロンプト集を繰り返し、件数または時間の上限に達するまでプロンプトを返す"""
+    i = 0
+    while (num_requests is None or i < num_requests) and (deadline is None or time.perf_counter() < deadline):
+        yield prompts[i % len(prompts)]
+        i += 1
+
+
+async def run_fixed_concurrency(client, prompts, params, stream, concurrency, num_requests, deadline):
+    """concurrency 個のワーカーが応答を待ってから次のリクエストを送る（クローズドループ）"""
+    records = []
+    source = prompt_stream(prompts, num_requests, deadline)
+
+    async def worker():
+        for prompt in source:
+            records.append(await send_request(client, prompt, params, stream))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return records
+
+
+async def run_fixed_rate(client, prompts, params, stream, rate, num_requests, deadline):
+    """応答を待たずに一定の間隔（1 / rate 秒）でリクエストを送る（オープンループ）"""
+    tasks = []
+    start = time.perf_counter()
+    for i, prompt in enumerate(prompt_stream(prompts, num_requests, deadline)):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send_request(client, prompt, params, stream)))
+    return list(await asyncio.gather(*tasks))
+
+
+def build_report(records, elapsed, config):
+    """計測結果を集計してJSONで出力できる辞書にする"""
+    succeeded = [r for r in records if r["ok"]]
+    tokens = [r["tokens"] for r in succeeded if r["tokens"] is not None]
+    total_tokens = sum(tokens) if tokens else None
+    errors = Counter(r["error"] for r in records if not r["ok"])
+    return {
+        "config": config,
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "failed": len(records) - len(succeeded),
+        "error_rate": (len(records) - len(succeeded)) / len(records) if records else 0.0,
+        "duration_seconds": elapsed,
+        "throughput": {
+            "requests_per_sec": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_sec": total_tokens / elapsed if total_tokens is not None and elapsed > 0 else None,
+            "total_tokens": total_tokens,
+        },
+        "latency_seconds": summarize_distribution([r["latency"] for r in succeeded]),
+        "time_to_first_token_seconds": summarize_distribution([r["ttft"] for r in succeeded if r["ttft"] is not None]),
+        "errors": dict(errors.most_common(10)),
+    }
+
+
+def print_report(report):
+    """集計結果を表形式で表示する"""
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    throughput = report["throughput"]
+    print(f"リクエスト数: {report['requests']} (成功 {report['succeeded']}, 失敗 {report['failed']}, "
+          f"エラー率 {report['error_rate'] * 100:.1f}%)")
+    print(f"所要時間: {report['duration_seconds']:.2f}秒")
+    print(f"スループット: {throughput['requests_per_sec']:.2f} req/s, {fmt(throughput['tokens_per_sec'])} tokens/s")
+    for title, key in (("レイテンシ(秒)", "latency_seconds"), ("TTFT(秒)", "time_to_first_token_seconds")):
+        stats = report[key] or {}
+        print(f"{title}: mean={fmt(stats.get('mean'))} p50={fmt(stats.get('p50'))} p95={fmt(stats.get('p95'))} "
+              f"p99={fmt(stats.get('p99'))} max={fmt(stats.get('max'))}")
+    for error, count in report["errors"].items():
+        print(f"  エラー x{count}: {error}")
+
+
+async def run_benchmark(args, api_url):
+    """引数で指定された条件でベンチマークを実行し、集計結果を返す"""
+    client_module = load_client_module()
+    prompts = load_prompts(args.prompts)
+    params = {
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+        "do_sample": args.do_sample,
+        "model": args.model,
+        "priority": args.priority,
+    }
+    # 同時実行数の制御はベンチマーク側で行い、クライアントのセマフォでは制限しない
+    max_in_flight = args.concurrency or args.max_in_flight
+    config = {
+        "url": api_url,
+        "mode": "rate" if args.rate else "concurrency",
+        "rate": args.rate,
+        "concurrency": args.concurrency,
+        "num_requests": args.num_requests,
+        "duration": args.duration,
+        "stream": args.stream,
+        "retries": args.retries,
+        "prompts": len(prompts),
+        **params,
+    }
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    num_requests = args.num_requests if args.num_requests or args.duration else len(prompts)
+
+    async with client_module.AsyncLLMClient(api_url, max_concurrency=max_in_flight, max_retries=args.retries,
+                                            timeout=args.timeout) as client:
+        if args.warmup:
+            await send_request(client, prompts[0], params, args.stream)
+        start = time.perf_counter()
+        if args.rate:
+            records = await run_fixed_rate(client, prompts, params, args.stream, args.rate, num_requests, deadline)
+        else:
+            records = await run_fixed_concurrency(client, prompts, params, args.stream, args.concurrency,
+                                                  num_requests, deadline)
+        elapsed = time.perf_counter() - start
+    return build_report(records, elapsed, config)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="/generate API の負荷試験")
+    parser.add_argument("--url", default=os.environ.get("LLM_API_URL", "http://localhost:8000"), help="APIのベースURL")
+    parser.add_argument("--stub", action="store_true", help="スタブモデルのサーバーを起動してオフラインで実行する")
+    parser.add_argument("--stub-prefill-ms", type=float, default=50, help="スタブモデルのプレフィル時間（ミリ秒）")
+    parser.add_argument("--stub-token-ms", type=float, default=10, help="スタブモデルの1トークンあたりの生成時間（ミリ秒）")
+    parser.add_argument("--stub-workers", type=int, default=1, help="スタブモデルが同時に生成できるリクエスト数")
+    parser.add_argument("--prompts", help="プロンプト集（1行1プロンプトのテキスト、または \"prompt\" キーを持つJSONL）")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--concurrency", type=int, default=None, help="同時に送信するリクエスト数（クローズドループ）")
+    mode.add_argument("--rate", type=float, default=None, help="1秒あたりに送信するリクエスト数（オープンループ）")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="--rate のときに同時に待機できるリクエストの上限")
+    parser.add_argument("--num-requests", type=int, default=None, help="送信するリクエスト数（省略時はプロンプト集を1周）")
+    parser.add_argument("--duration", type=float, default=None, help="計測時間（秒）。指定した場合は時間で打ち切る")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--no-sample", dest="do_sample", action="store_false", help="サンプリングせずに生成する")
+    parser.add_argument("--model", default=None, help="使用するモデル名（省略時はサーバーのデフォルトモデル）")
+    parser.add_argument("--priority", default=None, help="リクエストの優先度（interactive / normal / batch。省略時はサーバーのデフォルト）")
+    parser.add_argument("--no-stream", dest="stream", action="store_false",
+                        help="/generate を使う（TTFTとトークン数は計測されない）")
+    parser.add_argument("--retries", type=int, default=0, help="429/503 のときに再試行する回数")
+    parser.add_argument("--timeout", type=float, default=600.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--warmup", action="store_true", help="計測前に1件リクエストを送る")
+    parser.add_argument("--output", help="集計結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+    if args.concurrency is None and args.rate is None:
+        args.concurrency = 1
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = None
+    api_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        api_url, server = start_stub_server(
+            prefill_ms=args.stub_prefill_ms, token_ms=args.stub_token_ms, max_concurrency=args.stub_workers,
+        )
+        print(f"スタブサーバーを起動しました: {api_url}")
+    try:
+        report = asyncio.run(run_benchmark(args, api_url))
+    finally:
+        if server is not None:
+            server.should_exit = True
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# cpu_profile.py
+# CPUで推論する場合の最適化設定（精度の選択、int8動的量子化、スレッド数、torch.compile）
+import os
+import time
+import torch
+
+
+def _env_flag(name, default=False):
+    """環境変数を真偽値として読み込む"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name):
+    """環境変数を整数として読み込む（未設定の場合はNone）"""
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+class CPUInferenceProfile:
+    """CPU推論の設定"""
+
+    def __init__(self, precision="auto", quantize_int8=False, num_threads=None, num_interop_threads=None,
+                 use_torch_compile=False, benchmark=True, benchmark_tokens=32):
+        """
+        初期化
+
+        Args:
+            precision (str): "auto"（CPUがbf16に対応していればbf16、それ以外はfp32）、"fp32"、"bf16" のいずれか
+            quantize_int8 (bool): Linear層をint8に動的量子化するかどうか（fp32で読み込む）
+            num_threads (int, optional): 演算内の並列スレッド数（torch.set_num_threads）
+            num_interop_threads (int, optional): 演算間の並列スレッド数（torch.set_num_interop_threads）
+            use_torch_compile (bool): モデルのforwardをtorch.compileでコンパイルするかどうか
+            benchmark (bool): 読み込み後に短い生成を行い、トークン/秒をログに出力するかどうか
+            benchmark_tokens (int): ベンチマークで生成するトークン数
+        """
+        if precision not in ("auto", "fp32", "bf16"):
+            raise ValueError(f"precisionは 'auto', 'fp32', 'bf16' のいずれかを指定してください: {precision}")
+        self.precision = precision
+        self.quantize_int8 = quantize_int8
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.use_torch_compile = use_torch_compile
+        self.benchmark = benchmark
+        self.benchmark_tokens = benchmark_tokens
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込む"""
+        return cls(
+            precision=os.environ.get("CPU_PRECISION", "auto"),
+            quantize_int8=_env_flag("CPU_QUANTIZE_INT8"),
+            num_threads=_env_int("CPU_NUM_THREADS"),
+            num_interop_threads=_env_int("CPU_NUM_INTEROP_THREADS"),
+            use_torch_compile=_env_flag("CPU_TORCH_COMPILE"),
+            benchmark=_env_flag("CPU_BENCHMARK", default=True),
+            benchmark_tokens=_env_int("CPU_BENCHMARK_TOKENS") or 32,
+        )
+
+    def __repr__(self):
+        return (f"CPUInferenceProfile(precision={self.precision}, quantize_int8={self.quantize_int8}, "
+                f"num_threads={self.num_threads}, num_interop_threads={self.num_interop_threads}, "
+                f"use_torch_compile={self.use_torch_compile})")
+
+
+def cpu_supports_bf16():
+    """CPUがbf16演算命令（AVX512_BF16 / AMX）に対応しているかどうかを返す"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    return bool(flags & {"avx512_bf16", "amx_bf16"})
+    except OSError:
+        pass
+    return False
+
+
+def select_dtype(profile):
+    """CPU推論で使用するtorchのdtypeを選択する"""
+    if profile.quantize_int8:
+        # 動的量子化はfp32のモデルに対して行う
+        return torch.float32
+    if profile.precision == "bf16":
+        return torch.bfloat16
+    if profile.precision == "fp32":
+        return torch.float32
+    return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+
+
+def apply_thread_settings(profile):
+    """スレッド数を設定する（モデルの読み込み前に呼び出すこと）"""
+    if profile.num_threads:
+        torch.set_num_threads(profile.num_threads)
+    if profile.num_interop_threads:
+        try:
+            torch.set_num_interop_threads(profile.num_interop_threads)
+        except RuntimeError as e:
+            # 並列処理が一度でも始まった後は変更できない
+            print(f"警告: interopスレッド数を変更できませんでした: {e}")
+    print(f"CPUスレッド数: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+def optimize_model(pipe, profile):
+    """読み込み済みのpipelineのモデルに量子化とtorch.compileを適用する"""
+    if profile.quantize_int8:
+        pipe.model = torch.ao.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8)
+        print("Linear層をint8に動的量子化しました。")
+    if profile.use_torch_compile:
+        # generateはforwardを繰り返し呼び出すため、forwardだけをコンパイルする
+        pipe.model.forward = torch.compile(pipe.model.forward)
+        print("モデルのforwardをtorch.compileでコンパイルしました（初回の推論は遅くなります）。")
+    return pipe
+
+
+def run_microbenchmark(pipe, max_new_tokens=32, prompt="日本の首都はどこですか？"):
+    """短い生成を行い、選択した設定で得られるトークン/秒を計測する"""
+    tokenizer = pipe.tokenizer
+    inputs = tokenizer(prompt, return_tensors="pt").to(pipe.device)
+    start = time.time()
+    with torch.inference_mode():
+        output_ids = pipe.model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    elapsed = time.time() - start
+    token_count = output_ids.shape[1] - inputs["input_ids"].shape[1]
+    tokens_per_sec = token_count / elapsed if elapsed > 0 else 0.0
+    print(f"起動時ベンチマーク: {token_count}トークンを{elapsed:.2f}秒で生成 ({tokens_per_sec:.2f} tokens/s)")
+    return tokens_per_sec
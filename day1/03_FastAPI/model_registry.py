@@ -0,0 +1,231 @@
+# model_registry.py
+# 複数のモデルを必要になった時点で読み込み、メモリ上限を超える場合は最も古く使われたモデルから解放するレジストリ
+import gc
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import torch
+
+
+class UnknownModelError(Exception):
+    """利用可能なモデルとして登録されていないモデル名が指定されたときのエラー"""
+
+
+def _module_memory_bytes(module):
+    """モデルのパラメータとバッファが使用しているメモリ量（バイト）を返す"""
+    try:
+        return int(module.get_memory_footprint())
+    except Exception:
+        total = 0
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+        return total
+
+
+def model_memory_footprint(pipe):
+    """pipelineのモデル（投機的デコーディング用のドラフトモデルを含む）が使用しているメモリ量（バイト）を返す"""
+    total = _module_memory_bytes(pipe.model)
+    speculative_decoder = getattr(pipe, "speculative_decoder", None)
+    if speculative_decoder is not None:
+        total += _module_memory_bytes(speculative_decoder.draft_model)
+    return total
+
+
+class ModelEntry:
+    """レジストリで管理する1つのモデルの状態"""
+
+    def __init__(self, name):
+        self.name = name
+        self.pipe = None
+        self.state = "not_loaded"  # not_loaded / loading / ready / failed / evicted
+        self.error = None
+        self.load_thread = None
+        self.memory_bytes = 0
+        self.load_seconds = None
+        self.last_used = None
+        self.in_use = 0  # 推論中のリクエスト数（推論中のモデルは解放しない）
+
+
+class ModelRegistry:
+    """リクエストで指定されたモデルを遅延読み込みし、メモリ上限に応じてLRUで解放するレジストリ"""
+
+    def __init__(self, loader, default_model, available_models=None, memory_budget_bytes=None, on_evict=None,
+                 extra_memory_fn=None):
+        """
+        初期化
+
+        Args:
+            loader (callable): モデル名を受け取り、読み込んだpipelineを返す関数（失敗時はNone）
+            default_model (str): リクエストでモデルが指定されなかった場合に使用するモデル名
+            available_models (list, optional): 利用を許可するモデル名のリスト。省略時はdefault_modelのみ
+            memory_budget_bytes (int, optional): 常駐させるモデルの合計メモリ量の上限。Noneの場合は無制限
+            on_evict (callable, optional): モデルを解放するときにモデル名を渡して呼ぶ関数（モデルに付随するキャッシュの解放用）
+            extra_memory_fn (callable, optional): モデル名を受け取り、モデルに付随するメモリ量（KVキャッシュなど）を返す関数。
+                                                  メモリ上限の計算に含める
+        """
+        self.loader = loader
+        self.default_model = default_model
+        self.available_models = list(dict.fromkeys([default_model] + list(available_models or [])))
+        self.memory_budget_bytes = memory_budget_bytes
+        self.on_evict = on_evict
+        self.extra_memory_fn = extra_memory_fn
+        self._entries = OrderedDict((name, ModelEntry(name)) for name in self.available_models)
+        self._lock = threading.Lock()
+
+    def resolve(self, model_name=None):
+        """リクエストのモデル名を解決する（Noneの場合はデフォルトモデル）"""
+        name = model_name or self.default_model
+        if name not in self._entries:
+            raise UnknownModelError(f"モデル '{name}' は利用できません。利用可能なモデル: {self.available_models}")
+        return name
+
+    def state(self, model_name=None):
+        """モデルの読み込み状態を返す"""
+        return self._entries[self.resolve(model_name)].state
+
+    def error(self, model_name=None):
+        """モデルの読み込みに失敗した場合のエラーメッセージを返す"""
+        return self._entries[self.resolve(model_name)].error
+
+    def is_ready(self, model_name=None):
+        """モデルが読み込み済みで推論に使用できるかどうかを返す"""
+        return self._entries[self.resolve(model_name)].pipe is not None
+
+    def start_loading(self, model_name=None):
+        """
+        モデルの読み込みをバックグラウンドスレッドで開始する
+
+        読み込み済み、または読み込み中の場合は何もしない（同時に呼ばれても読み込みは1回だけ行われる）。
+
+        Returns:
+            bool: 新しく読み込みを開始した場合はTrue
+        """
+        name = self.resolve(model_name)
+        with self._lock:
+            entry = self._entries[name]
+            if entry.pipe is not None or (entry.load_thread is not None and entry.load_thread.is_alive()):
+                return False
+            # 以前に読み込んだことがあればそのサイズで、先に他のモデルを解放しておく
+            if entry.memory_bytes:
+                self._evict_for(entry.memory_bytes, keep=name)
+            entry.state = "loading"
+            entry.error = None
+            entry.load_thread = threading.Thread(target=self._load, args=(name,), name=f"model-loader-{name}", daemon=True)
+            entry.load_thread.start()
+            return True
+
+    def _load(self, name):
+        """モデルを読み込むバックグラウンドタスク"""
+        entry = self._entries[name]
+        print(f"ModelRegistry: モデル '{name}' の読み込みを開始...")
+        start = time.time()
+        try:
+            pipe = self.loader(name)
+        except Exception as e:
+            traceback.print_exc()
+            pipe = None
+            entry.error = str(e)
+        with self._lock:
+            if pipe is None:
+                entry.state = "failed"
+                entry.error = entry.error or f"モデル '{name}' の読み込みに失敗しました"
+                print(f"ModelRegistry: モデル '{name}' の読み込みに失敗しました。")
+                return
+            entry.pipe = pipe
+            entry.state = "ready"
+            entry.memory_bytes = model_memory_footprint(pipe)
+            entry.load_seconds = time.time() - start
+            entry.last_used = time.time()
+            self._entries.move_to_end(name)
+            print(f"ModelRegistry: モデル '{name}' の読み込みが完了しました ({entry.memory_bytes / 1024 ** 3:.2f} GB)")
+            # 読み込み後のサイズで上限を超えた場合は、他のモデルを古い順に解放する
+            self._evict_for(0, keep=name)
+
+    def _extra_bytes(self, name):
+        """モデルに付随するメモリ量（プレフィックスKVキャッシュなど）を返す"""
+        if self.extra_memory_fn is None:
+            return 0
+        try:
+            return int(self.extra_memory_fn(name) or 0)
+        except Exception:
+            traceback.print_exc()
+            return 0
+
+    def _resident_bytes(self):
+        return sum(entry.memory_bytes + self._extra_bytes(entry.name)
+                   for entry in self._entries.values() if entry.pipe is not None)
+
+    def _evict_for(self, required_bytes, keep):
+        """required_bytes を追加で読み込めるように、最も古く使われたモデルから解放する（ロックを保持して呼び出すこと）"""
+        if self.memory_budget_bytes is None:
+            return
+        candidates = sorted(
+            (entry for entry in self._entries.values()
+             if entry.pipe is not None and entry.name != keep and entry.in_use == 0),
+            key=lambda entry: entry.last_used or 0,
+        )
+        for entry in candidates:
+            if self._resident_bytes() + required_bytes <= self.memory_budget_bytes:
+                break
+            print(f"ModelRegistry: メモリ上限のためモデル '{entry.name}' を解放します。")
+            entry.pipe = None
+            entry.state = "evicted"
+            # モデルに付随するキャッシュ（KVテンソル）も解放しないと、メモリ上限が守られない
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(entry.name)
+                except Exception:
+                    traceback.print_exc()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def acquire(self, model_name=None):
+        """推論に使うpipelineを取得する（使用中は解放されない）。未読み込みの場合はNoneを返す"""
+        name = self.resolve(model_name)
+        with self._lock:
+            entry = self._entries[name]
+            if entry.pipe is None:
+                return None
+            entry.in_use += 1
+            entry.last_used = time.time()
+            self._entries.move_to_end(name)
+            return entry.pipe
+
+    def release(self, model_name=None):
+        """acquireで取得したpipelineの使用を終える"""
+        name = self.resolve(model_name)
+        with self._lock:
+            entry = self._entries[name]
+            entry.in_use = max(0, entry.in_use - 1)
+
+    def resident_models(self):
+        """メモリ上に読み込まれているモデルの一覧とメモリ使用量を返す"""
+        with self._lock:
+            return [
+                {
+                    "model": entry.name,
+                    "memory_bytes": entry.memory_bytes,
+                    "memory_gb": round(entry.memory_bytes / 1024 ** 3, 3),
+                    "extra_memory_bytes": self._extra_bytes(entry.name),
+                    "load_seconds": entry.load_seconds,
+                    "last_used": entry.last_used,
+                    "in_use": entry.in_use,
+                }
+                for entry in self._entries.values() if entry.pipe is not None
+            ]
+
+    def summary(self):
+        """全モデルの状態とメモリ使用量の概要を返す"""
+        with self._lock:
+            states = {entry.name: entry.state for entry in self._entries.values()}
+            resident_bytes = self._resident_bytes()
+        return {
+            "default_model": self.default_model,
+            "models": states,
+            "resident": self.resident_models(),
+            "resident_memory_bytes": resident_bytes,
+            "memory_budget_bytes": self.memory_budget_bytes,
+        }
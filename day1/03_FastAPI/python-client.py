@@ -4,20 +4,54 @@
 import requests
 import json
 import time
+import asyncio
+import random
+import httpx
+
+
+def generation_params(max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True, model=None, stop=None,
+                      max_time=None, priority=None):
+    """
+    生成パラメータをリクエストのJSONに変換する（Noneのパラメータは含めず、サーバーのデフォルト値を使わせる）
+
+    max_new_tokens を省略すると、サーバーは混雑度に応じて生成トークン数を決める。
+    priority を省略すると、サーバーは X-Priority ヘッダーまたはエンドポイントのデフォルトの優先度を使う。
+    """
+    params = {
+        "max_new_tokens": max_new_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "do_sample": do_sample,
+        "model": model,
+        "stop": stop,
+        "max_time": max_time,
+        "priority": priority,
+    }
+    return {key: value for key, value in params.items() if value is not None}
+
+def client_headers(client_id=None):
+    """同時実行数の制限の単位となるクライアントの識別子をヘッダーにする（省略時はサーバーが接続元IPを使う）"""
+    return {"X-Client-Id": client_id} if client_id else {}
 
 class LLMClient:
     """LLM API クライアントクラス"""
     
-    def __init__(self, api_url):
+    def __init__(self, api_url, client_id=None):
         """
         初期化
         
         Args:
             api_url (str): API のベース URL（ngrok URL）
+            client_id (str, optional): リクエストごとに省略した場合に X-Client-Id ヘッダーで送るクライアントの識別子
         """
         self.api_url = api_url.rstrip('/')
+        self.client_id = client_id
         self.session = requests.Session()
     
+    def _headers(self, client_id=None):
+        """リクエストのヘッダー（client_id を省略した場合はクライアントのデフォルトを使う）"""
+        return client_headers(client_id or self.client_id)
+    
     def health_check(self):
         """
         ヘルスチェック
@@ -28,33 +62,246 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True, model=None, stop=None,
+                 max_time=None, priority=None, client_id=None):
         """
         テキスト生成
         
         Args:
             prompt (str): プロンプト文字列
-            max_new_tokens (int, optional): 生成する最大トークン数
+            max_new_tokens (int, optional): 生成する最大トークン数（省略時はサーバーが混雑度に応じて決める）
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            stop (list, optional): 停止文字列のリスト（現れた時点で生成を止め、その直前までを返す）
+            max_time (float, optional): サーバーでの制限時間（秒）。超えた場合はそれまでの出力が truncated=True で返る
+            priority (str, optional): 優先度（interactive / normal / batch）。省略時はサーバーのデフォルト
+            client_id (str, optional): X-Client-Id ヘッダーで送るクライアントの識別子（省略時はクライアントのデフォルト）
         
         Returns:
             dict: 生成結果
         """
-        payload = {
-            "prompt": prompt,
-            "max_new_tokens": max_new_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "do_sample": do_sample
-        }
+        payload = {"prompt": prompt}
+        payload.update(generation_params(max_new_tokens, temperature, top_p, do_sample, model, stop, max_time, priority))
         
         start_time = time.time()
         response = self.session.post(
             f"{self.api_url}/generate",
-            json=payload
+            json=payload,
+            headers=self._headers(client_id)
+        )
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise Exception(f"API error: {response.status_code} - {response.text}")
+
+    def generate_batch(self, prompts, max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True, model=None,
+                       batch_size=None, stop=None, max_time=None, priority=None, client_id=None):
+        """
+        複数のプロンプトをまとめてテキスト生成
+        
+        Args:
+            prompts (list): プロンプト文字列、またはプロンプトごとのパラメータを指定したdictのリスト
+                            （dictで指定しなかったパラメータには引数の値が使われる）
+            max_new_tokens (int, optional): 生成する最大トークン数（省略時はサーバーが混雑度に応じて決める）
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            stop (list, optional): 停止文字列のリスト（現れた時点で生成を止め、その直前までを返す）
+            max_time (float, optional): サーバーでの制限時間（秒）。超えた場合はそれまでの出力が truncated=True で返る
+            priority (str, optional): 優先度（interactive / normal / batch）。省略時はサーバーのデフォルト
+            client_id (str, optional): X-Client-Id ヘッダーで送るクライアントの識別子（省略時はクライアントのデフォルト）
+            batch_size (int, optional): サーバーで1回の推論にまとめる件数
+        
+        Returns:
+            dict: 生成結果（"results" に入力と同じ順序で各プロンプトの結果が入る）
+        """
+        defaults = generation_params(max_new_tokens, temperature, top_p, do_sample, model, stop, max_time)
+        
+        requests_payload = []
+        for prompt in prompts:
+            item = dict(defaults)
+            item.update(prompt if isinstance(prompt, dict) else {"prompt": prompt})
+            requests_payload.append(item)
+        payload = {"requests": requests_payload}
+        if batch_size:
+            payload["batch_size"] = batch_size
+        if priority:
+            # バッチの優先度はリクエスト全体で1つ（省略時はサーバーが batch として扱う）
+            payload["priority"] = priority
+        
+        start_time = time.time()
+        response = self.session.post(
+            f"{self.api_url}/generate/batch",
+            json=payload,
+            headers=self._headers(client_id)
+        )
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise Exception(f"API error: {response.status_code} - {response.text}")
+
+    def generate_stream(self, prompt, max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True, model=None,
+                        stop=None, max_time=None, priority=None, client_id=None):
+        """
+        ストリーミングでのテキスト生成（Server-Sent Events）
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数（省略時はサーバーが混雑度に応じて決める）
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            stop (list, optional): 停止文字列のリスト（現れた時点で生成を止め、その直前までを返す）
+            max_time (float, optional): サーバーでの制限時間（秒）。超えた場合はそれまでの出力が truncated=True で返る
+            priority (str, optional): 優先度（interactive / normal / batch）。省略時はサーバーのデフォルト
+            client_id (str, optional): X-Client-Id ヘッダーで送るクライアントの識別子（省略時はクライアントのデフォルト）
+        
+        Yields:
+            dict: {"event": "token", "token": ...} をトークンごとに返し、
+                  最後に {"event": "done", "time_to_first_token": ..., "tokens_per_sec": ...} を返す
+        """
+        payload = {"prompt": prompt}
+        payload.update(generation_params(max_new_tokens, temperature, top_p, do_sample, model, stop, max_time, priority))
+        
+        start_time = time.time()
+        with self.session.post(f"{self.api_url}/generate/stream", json=payload, headers=self._headers(client_id),
+                               stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"API error: {response.status_code} - {response.text}")
+            
+            event = "token"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    # 空行でイベントが区切られる
+                    event = "token"
+                    continue
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):].strip())
+                    if event == "error":
+                        raise Exception(f"API error: {data.get('detail')}")
+                    data["event"] = event
+                    if event == "done":
+                        data["total_request_time"] = time.time() - start_time
+                    yield data
+
+class AsyncLLMClient:
+    """asyncio版 LLM API クライアントクラス（コネクションプール・同時実行数の制限・リトライ付き）"""
+    
+    # 再試行するステータスコード（サーバーが混み合っている、またはモデルを準備中）
+    RETRY_STATUS_CODES = (429, 503)
+    
+    def __init__(self, api_url, max_concurrency=8, pool_size=None, max_retries=5,
+                 backoff_base=0.5, backoff_max=30.0, timeout=600.0, client_id=None):
+        """
+        初期化
+        
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            max_concurrency (int, optional): 同時に送信するリクエストの最大数
+            pool_size (int, optional): コネクションプールのサイズ（省略時は max_concurrency と同じ）
+            max_retries (int, optional): 429/503 のときに再試行する最大回数
+            backoff_base (float, optional): 再試行の待ち時間の基準（秒）。再試行ごとに2倍になる
+            backoff_max (float, optional): 再試行の待ち時間の上限（秒）
+            timeout (float, optional): 1リクエストのタイムアウト（秒）
+            client_id (str, optional): リクエストごとに省略した場合に X-Client-Id ヘッダーで送るクライアントの識別子
+        """
+        self.api_url = api_url.rstrip('/')
+        self.client_id = client_id
+        pool_size = pool_size or max_concurrency
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
         )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+    
+    def _headers(self, client_id=None):
+        """リクエストのヘッダー（client_id を省略した場合はクライアントのデフォルトを使う）"""
+        return client_headers(client_id or self.client_id)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    async def close(self):
+        """コネクションプールを閉じる"""
+        await self.client.aclose()
+    
+    def _backoff(self, attempt, retry_after=None):
+        """再試行までの待ち時間（指数バックオフ + ジッター。Retry-Afterがあればそれ以上待つ）"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(0, delay)  # full jitter
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+    
+    async def _request(self, method, path, **kwargs):
+        """同時実行数を制限してリクエストを送信し、429/503 の場合は待ってから再試行する"""
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                response = await self.client.request(method, f"{self.api_url}{path}", **kwargs)
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response
+                delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                print(f"API {response.status_code}: {delay:.1f}秒後に再試行します ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+    
+    async def health_check(self):
+        """
+        ヘルスチェック
+        
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        response = await self._request("GET", "/health")
+        return response.json()
+    
+    async def generate(self, prompt, max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True, model=None,
+                       stop=None, max_time=None, priority=None, client_id=None):
+        """
+        テキスト生成
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数（省略時はサーバーが混雑度に応じて決める）
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            stop (list, optional): 停止文字列のリスト（現れた時点で生成を止め、その直前までを返す）
+            max_time (float, optional): サーバーでの制限時間（秒）。超えた場合はそれまでの出力が truncated=True で返る
+            priority (str, optional): 優先度（interactive / normal / batch）。省略時はサーバーのデフォルト
+            client_id (str, optional): X-Client-Id ヘッダーで送るクライアントの識別子（省略時はクライアントのデフォルト）
+        
+        Returns:
+            dict: 生成結果
+        """
+        payload = {"prompt": prompt}
+        payload.update(generation_params(max_new_tokens, temperature, top_p, do_sample, model, stop, max_time, priority))
+        
+        start_time = time.time()
+        response = await self._request("POST", "/generate", json=payload, headers=self._headers(client_id))
         total_time = time.time() - start_time
         
         if response.status_code == 200:
@@ -63,6 +310,102 @@ class LLMClient:
             return result
         else:
             raise Exception(f"API error: {response.status_code} - {response.text}")
+    
+    async def generate_stream(self, prompt, max_new_tokens=None, temperature=0.7, top_p=0.9, do_sample=True,
+                              model=None, stop=None, max_time=None, priority=None, client_id=None):
+        """
+        ストリーミングでのテキスト生成（Server-Sent Events）
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数（省略時はサーバーが混雑度に応じて決める）
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            stop (list, optional): 停止文字列のリスト（現れた時点で生成を止め、その直前までを返す）
+            max_time (float, optional): サーバーでの制限時間（秒）。超えた場合はそれまでの出力が truncated=True で返る
+            priority (str, optional): 優先度（interactive / normal / batch）。省略時はサーバーのデフォルト
+            client_id (str, optional): X-Client-Id ヘッダーで送るクライアントの識別子（省略時はクライアントのデフォルト）
+        
+        Yields:
+            dict: LLMClient.generate_stream と同じ形式のイベント
+        """
+        payload = {"prompt": prompt}
+        payload.update(generation_params(max_new_tokens, temperature, top_p, do_sample, model, stop, max_time, priority))
+        
+        start_time = time.time()
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                async with self.client.stream("POST", f"{self.api_url}/generate/stream", json=payload,
+                                              headers=self._headers(client_id)) as response:
+                    if response.status_code == 200:
+                        event = "token"
+                        async for line in response.aiter_lines():
+                            if not line:
+                                # 空行でイベントが区切られる
+                                event = "token"
+                                continue
+                            if line.startswith("event:"):
+                                event = line[len("event:"):].strip()
+                            elif line.startswith("data:"):
+                                data = json.loads(line[len("data:"):].strip())
+                                if event == "error":
+                                    raise Exception(f"API error: {data.get('detail')}")
+                                data["event"] = event
+                                if event == "done":
+                                    data["total_request_time"] = time.time() - start_time
+                                yield data
+                        return
+                    await response.aread()
+                    if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.max_retries:
+                        raise Exception(f"API error: {response.status_code} - {response.text}")
+                    delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                # ストリームが始まる前に拒否された場合だけ再試行する
+                print(f"API {response.status_code}: {delay:.1f}秒後に再試行します ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+    
+    async def map(self, prompts, return_exceptions=False, **kwargs):
+        """
+        複数のプロンプトを並行して生成し、完了した順に結果を返す
+        
+        Args:
+            prompts (list): プロンプト文字列、またはプロンプトごとのパラメータを指定したdictのリスト
+            return_exceptions (bool, optional): Trueの場合、失敗したプロンプトは例外を結果として返す
+            **kwargs: generate に渡す共通のパラメータ
+        
+        Yields:
+            tuple: (入力リストでの位置, 生成結果または例外)
+        """
+        async def run(index, prompt):
+            params = dict(kwargs)
+            params.update(prompt if isinstance(prompt, dict) else {"prompt": prompt})
+            try:
+                return index, await self.generate(**params)
+            except Exception as e:
+                if return_exceptions:
+                    return index, e
+                raise
+        
+        tasks = [asyncio.ensure_future(run(index, prompt)) for index, prompt in enumerate(prompts)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            # 途中で中断された場合は残りのリクエストを取り消す
+            for task in tasks:
+                task.cancel()
+
+async def async_example(api_url):
+    """AsyncLLMClient の使用例"""
+    async with AsyncLLMClient(api_url, max_concurrency=4) as client:
+        print(await client.health_check())
+        prompts = [f"{topic}について50文字で教えてください" for topic in ["AI", "機械学習", "深層学習", "強化学習"]]
+        async for index, result in client.map(prompts, return_exceptions=True, stop=["\n\n"], priority="batch"):
+            if isinstance(result, Exception):
+                print(f"[{index}] Error: {result}")
+            else:
+                print(f"[{index}] {result['generated_text']} ({result['total_request_time']:.2f}s)")
 
 # 使用例
 if __name__ == "__main__":
@@ -84,4 +427,31 @@ if __name__ == "__main__":
     ])
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 複数の質問をまとめて生成
+    print("Batch:")
+    batch_result = client.generate_batch([
+        "AIについて50文字で教えてください",
+        "機械学習について50文字で教えてください",
+    ])
+    for item in batch_result["results"]:
+        print(f"[{item['index']}] {item['generated_text']} ({item['response_time']:.2f}s)")
+    print(f"Total request time: {batch_result['total_request_time']:.2f}s")
+    print()
+    
+    # ストリーミング
+    print("Streaming:")
+    for chunk in client.generate_stream("AIについて100文字で教えてください"):
+        if chunk["event"] == "token":
+            print(chunk["token"], end="", flush=True)
+        else:
+            print()
+            print(f"Time to first token: {chunk['time_to_first_token'] or 0:.2f}s")
+            print(f"Tokens/sec: {chunk['tokens_per_sec']:.2f}")    
+    print()
+    
+    # asyncio版クライアントで並行して生成
+    print("Async:")
+    asyncio.run(async_example(NGROK_URL))
\ No newline at end of file
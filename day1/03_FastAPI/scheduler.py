@@ -0,0 +1,185 @@
+# scheduler.py
+# 優先度クラスごとの重み付き公平スケジューラ（対話的なリクエストを一括処理より先に推論する）
+import asyncio
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+
+# 優先度クラスと重み（重みの比率で推論の順番が割り当てられる）
+DEFAULT_PRIORITY_WEIGHTS = {"interactive": 8, "normal": 4, "batch": 1}
+
+# ヘッダーやリクエストで指定できる別名
+PRIORITY_ALIASES = {"high": "interactive", "chat": "interactive", "default": "normal", "low": "batch", "bulk": "batch"}
+
+
+class UnknownPriorityError(Exception):
+    """登録されていない優先度クラスが指定されたときのエラー"""
+
+
+def parse_priority_weights(value):
+    """
+    "interactive=8,normal=4,batch=1" 形式の文字列から優先度クラスの重みを読み込む
+
+    Args:
+        value (str): 環境変数などで指定された文字列。空の場合はデフォルトの重み
+
+    Returns:
+        dict: 優先度クラス名 -> 重み
+    """
+    if not value:
+        return dict(DEFAULT_PRIORITY_WEIGHTS)
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip().lower()] = max(1e-3, float(weight))
+    return weights
+
+
+class _Waiter:
+    """推論の順番を待っているリクエスト"""
+
+    def __init__(self, client_id, cost, future):
+        self.client_id = client_id
+        self.cost = cost
+        self.future = future
+
+
+class FairScheduler:
+    """優先度クラス間は重み付き公平キューイング、クラス内は到着順で推論の枠を割り当てるスケジューラ
+
+    各クラスは仮想時間を持ち、枠を割り当てるたびに cost / 重み だけ進める。待機中のリクエストがあるクラスのうち
+    仮想時間が最も小さいクラスを選ぶため、重みの大きいクラスが先に進みつつ、重みの小さいクラスも飢餓状態にならない。
+    1つのクライアントが同時に使える枠は per_client_limit までに制限する。
+    イベントループ上からのみ呼び出すこと（スレッドセーフではない）。
+    """
+
+    def __init__(self, capacity, weights=None, default_priority="normal", per_client_limit=None):
+        """
+        初期化
+
+        Args:
+            capacity (int): 同時に推論できるリクエスト数（推論ワーカー数 × 最大バッチサイズ）
+            weights (dict, optional): 優先度クラス名 -> 重み。省略時は DEFAULT_PRIORITY_WEIGHTS
+            default_priority (str): 優先度が指定されなかった場合のクラス
+            per_client_limit (int, optional): 1クライアントが同時に使える枠の数。Noneの場合は無制限
+        """
+        self.capacity = max(1, int(capacity))
+        self.weights = dict(weights or DEFAULT_PRIORITY_WEIGHTS)
+        if default_priority not in self.weights:
+            raise UnknownPriorityError(f"デフォルトの優先度 '{default_priority}' が重みに含まれていません")
+        self.default_priority = default_priority
+        self.per_client_limit = per_client_limit
+        # 重みの大きいクラスから順に調べる（仮想時間が同じ場合は重みの大きいクラスを優先する）
+        self._priorities = sorted(self.weights, key=lambda name: -self.weights[name])
+        self._waiters = {name: deque() for name in self._priorities}
+        self._virtual_time = {name: 0.0 for name in self._priorities}
+        self._clock = 0.0
+        self._in_use = 0
+        self._client_in_use = Counter()
+        self.dispatched = Counter()
+
+    def resolve_priority(self, priority=None):
+        """優先度の指定を正規化する。未知の優先度の場合はUnknownPriorityErrorを送出する"""
+        if not priority:
+            return self.default_priority
+        name = str(priority).strip().lower()
+        name = PRIORITY_ALIASES.get(name, name)
+        if name not in self.weights:
+            raise UnknownPriorityError(f"優先度 '{priority}' は利用できません。利用可能な優先度: {self._priorities}")
+        return name
+
+    def waiting(self, priority=None):
+        """待機中のリクエスト数を返す（priorityを省略した場合は全クラスの合計）"""
+        if priority is None:
+            return sum(len(queue) for queue in self._waiters.values())
+        return len(self._waiters[priority])
+
+    async def acquire(self, priority=None, client_id=None, cost=1):
+        """
+        推論の枠が割り当てられるまで待つ
+
+        Args:
+            priority (str, optional): 優先度クラス
+            client_id (str, optional): 同時実行数を制限するためのクライアントの識別子
+            cost (int): 使用する枠の数（まとめて推論するプロンプト数）。capacityを超える場合はcapacityとして扱う
+        """
+        priority = self.resolve_priority(priority)
+        cost = min(max(1, int(cost)), self.capacity)
+        queue = self._waiters[priority]
+        if not queue:
+            # しばらく待機がなかったクラスが、溜まった仮想時間の差で他のクラスを独占しないようにする
+            self._virtual_time[priority] = max(self._virtual_time[priority], self._clock)
+        waiter = _Waiter(client_id, cost, asyncio.get_running_loop().create_future())
+        queue.append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 枠が割り当てられた直後に取り消された場合は返却する
+                self.release(client_id, cost)
+            elif waiter in queue:
+                queue.remove(waiter)
+                self._dispatch()
+            raise
+        return cost
+
+    def release(self, client_id=None, cost=1):
+        """acquireで割り当てられた枠を返却し、待機中のリクエストに割り当てる"""
+        cost = min(max(1, int(cost)), self.capacity)
+        self._in_use = max(0, self._in_use - cost)
+        self._client_in_use[client_id] -= cost
+        if self._client_in_use[client_id] <= 0:
+            del self._client_in_use[client_id]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority=None, client_id=None, cost=1):
+        """with文の間だけ推論の枠を確保する"""
+        cost = await self.acquire(priority, client_id, cost)
+        try:
+            yield
+        finally:
+            self.release(client_id, cost)
+
+    def _client_allowed(self, waiter):
+        """クライアントの同時実行数の上限に達していないかどうか（何も実行していないクライアントは常に許可する）"""
+        if self.per_client_limit is None or waiter.client_id is None:
+            return True
+        in_use = self._client_in_use[waiter.client_id]
+        return in_use == 0 or in_use + waiter.cost <= self.per_client_limit
+
+    def _dispatch(self):
+        """空いている枠を仮想時間の小さいクラスのリクエストから順に割り当てる"""
+        while self._in_use < self.capacity:
+            selected = None
+            for priority in self._priorities:
+                waiter = next((w for w in self._waiters[priority]
+                               if not w.future.done() and self._client_allowed(w)), None)
+                if waiter is not None and (selected is None or self._virtual_time[priority] < self._virtual_time[selected[0]]):
+                    selected = (priority, waiter)
+            if selected is None:
+                return
+            priority, waiter = selected
+            if self._in_use + waiter.cost > self.capacity:
+                # 順番が来たリクエストの分の枠が空くまで、後続のリクエストに追い越させない
+                return
+            self._waiters[priority].remove(waiter)
+            self._in_use += waiter.cost
+            self._client_in_use[waiter.client_id] += waiter.cost
+            self._clock = self._virtual_time[priority]
+            self._virtual_time[priority] += waiter.cost / self.weights[priority]
+            self.dispatched[priority] += 1
+            waiter.future.set_result(None)
+
+    def stats(self):
+        """優先度クラスごとの待機数と割り当て回数を返す"""
+        return {
+            "capacity": self.capacity,
+            "in_use": self._in_use,
+            "per_client_limit": self.per_client_limit,
+            "active_clients": len(self._client_in_use),
+            "priorities": {
+                name: {"weight": self.weights[name], "waiting": len(self._waiters[name]), "dispatched": self.dispatched[name]}
+                for name in self._priorities
+            },
+        }
@@ -0,0 +1,113 @@
+# server_metrics.py
+# /metrics エンドポイントで公開するPrometheus形式のメトリクス定義
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# 推論の各段階（tokenize, prefill, decode, detokenize, extract）の処理時間のバケット（秒）
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUESTS_TOTAL = Counter(
+    "llm_requests_total",
+    "エンドポイントごとのHTTPリクエスト数",
+    ["endpoint", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "llm_request_duration_seconds",
+    "エンドポイントごとのHTTPリクエストの処理時間",
+    ["endpoint"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "llm_stage_duration_seconds",
+    "推論の段階ごとの処理時間",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "llm_queue_depth",
+    "推論待ちのリクエスト数",
+    ["queue"],
+)
+TOKENS_GENERATED = Counter(
+    "llm_tokens_generated_total",
+    "生成されたトークンの総数",
+)
+TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second",
+    "推論1回あたりの生成速度（トークン/秒）",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+BATCH_SIZE = Histogram(
+    "llm_batch_size",
+    "1回の推論にまとめられたリクエスト数",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+RESPONSE_CACHE = Gauge(
+    "llm_response_cache",
+    "応答キャッシュのヒット数・ミス数・保持件数",
+    ["stat"],
+)
+MODEL_LOAD_SECONDS = Gauge(
+    "llm_model_load_seconds",
+    "モデルの読み込みにかかった時間",
+    ["model"],
+)
+MODEL_MEMORY_BYTES = Gauge(
+    "llm_resident_model_memory_bytes",
+    "メモリ上に読み込まれているモデルの合計サイズ",
+)
+STARTUP_TOKENS_PER_SECOND = Gauge(
+    "llm_startup_benchmark_tokens_per_second",
+    "起動時ベンチマークで計測した生成速度（トークン/秒）",
+    ["model"],
+)
+SPECULATIVE_ACCEPTANCE = Histogram(
+    "llm_speculative_acceptance_rate",
+    "投機的デコーディングでドラフトモデルのトークンが受理された割合",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+
+
+def observe_stage(stage, seconds):
+    """推論の段階の処理時間を記録する"""
+    STAGE_LATENCY.labels(stage=stage).observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage):
+    """with文で囲んだ処理の時間を推論の段階として記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_generation(tokens, seconds, batch_size=1):
+    """生成したトークン数と生成速度を記録する"""
+    TOKENS_GENERATED.inc(tokens)
+    BATCH_SIZE.observe(batch_size)
+    if seconds > 0:
+        TOKENS_PER_SECOND.observe(tokens / seconds)
+
+
+def register_queue(name, depth_fn):
+    """キューの長さを返す関数を登録する（/metrics の取得時に呼び出される）"""
+    QUEUE_DEPTH.labels(queue=name).set_function(depth_fn)
+
+
+def register_cache(stats_fn):
+    """応答キャッシュの統計を返す関数を登録する"""
+    for stat in ("hits", "misses", "entries"):
+        RESPONSE_CACHE.labels(stat=stat).set_function(lambda stat=stat: stats_fn()[stat])
+
+
+def register_model_memory(memory_fn):
+    """常駐モデルの合計メモリ量を返す関数を登録する"""
+    MODEL_MEMORY_BYTES.set_function(memory_fn)
+
+
+def render():
+    """Prometheusのテキスト形式でメトリクスを出力する"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,189 @@
+# speculative.py
+# 小さいドラフトモデルが先読みしたトークンをメインモデルがまとめて検証する投機的デコーディング（assisted generation）
+import threading
+import time
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+class _ForwardCounter:
+    """with文の間に、with文に入ったスレッドでモデルのforwardが呼ばれた回数を数える
+
+    メインモデルは他の推論ワーカーと共有されているため、同時に実行されている通常の生成
+    （別のスレッドでのforward）は数えない。model.generate は呼び出したスレッドでforwardを実行する。
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.count = 0
+        self._handle = None
+        self._thread_id = None
+
+    def _hook(self, module, args, output):
+        if threading.get_ident() == self._thread_id:
+            self.count += 1
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._handle = self.module.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._handle.remove()
+
+
+class SpeculativeDecoder:
+    """ドラフトモデルを保持し、受理率に応じて投機的デコーディングを使うかどうかを切り替えるクラス
+
+    受理率の移動平均が min_acceptance を下回った場合は通常のデコードに戻し、
+    probe_interval 件ごとに1件だけ投機的デコーディングを試して、受理率が回復していれば再び有効にする。
+    """
+
+    def __init__(self, draft_model, draft_tokenizer=None, num_assistant_tokens=5, min_acceptance=0.4,
+                 warmup_requests=3, probe_interval=20, ema_alpha=0.2):
+        """
+        初期化
+
+        Args:
+            draft_model: 先読みに使う小さいtransformersのモデル
+            draft_tokenizer (optional): メインモデルとトークナイザが異なる場合のドラフトモデルのトークナイザ
+            num_assistant_tokens (int): 1回の検証で先読みするトークン数の初期値
+            min_acceptance (float): 投機的デコーディングを続ける受理率の下限
+            warmup_requests (int): 受理率による切り替えを始めるまでのリクエスト数
+            probe_interval (int): 無効にした後、受理率を再確認するまでのリクエスト数
+            ema_alpha (float): 受理率の移動平均の係数
+        """
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self.min_acceptance = min_acceptance
+        self.warmup_requests = warmup_requests
+        self.probe_interval = max(1, int(probe_interval))
+        self.ema_alpha = ema_alpha
+        self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        self.acceptance_ema = None
+        self.baseline_tokens_per_sec = None  # 通常のデコードの速度（移動平均）
+        self.requests = 0
+        self.fallback = False
+        self._skipped = 0
+        self._state_lock = threading.Lock()
+        # ドラフトモデルは先読みするトークン数を生成中に書き換えるため、投機的デコーディングは1件ずつ実行する
+        self._generate_lock = threading.Lock()
+
+    def should_use(self):
+        """このリクエストで投機的デコーディングを使うかどうかを返す"""
+        with self._state_lock:
+            if not self.fallback:
+                return True
+            self._skipped += 1
+            if self._skipped >= self.probe_interval:
+                self._skipped = 0
+                return True
+            return False
+
+    def record_baseline(self, tokens, seconds):
+        """通常のデコード（バッチサイズ1）の速度を記録する。speedupの計算に使う"""
+        if tokens <= 0 or seconds <= 0:
+            return
+        tokens_per_sec = tokens / seconds
+        with self._state_lock:
+            if self.baseline_tokens_per_sec is None:
+                self.baseline_tokens_per_sec = tokens_per_sec
+            else:
+                self.baseline_tokens_per_sec += self.ema_alpha * (tokens_per_sec - self.baseline_tokens_per_sec)
+
+    def generate(self, model, tokenizer, input_ids, attention_mask=None, **generate_kwargs):
+        """
+        ドラフトモデルを使ってmodel.generateを実行する（バッチサイズ1のみ）
+
+        Args:
+            model: メインのtransformersのモデル
+            tokenizer: メインモデルのトークナイザ
+            input_ids (torch.Tensor): 形状 (1, プロンプト長) のトークンID
+            attention_mask (torch.Tensor, optional): アテンションマスク
+            **generate_kwargs: model.generateに渡す引数
+
+        Returns:
+            tuple: (生成結果のトークンID, 受理率やspeedupなどの情報)
+        """
+        generate_kwargs["assistant_model"] = self.draft_model
+        if self.draft_tokenizer is not None:
+            # トークナイザが異なる場合は、テキストを介してトークンを変換する
+            generate_kwargs.update(tokenizer=tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        with self._generate_lock:
+            with _ForwardCounter(model) as verify_steps, _ForwardCounter(self.draft_model) as draft_steps:
+                start = time.time()
+                output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+                elapsed = time.time() - start
+
+        # メインモデルは1回の検証で「受理されたトークン + 1トークン」を確定させる
+        new_tokens = output_ids.shape[1] - input_ids.shape[1]
+        proposed = draft_steps.count
+        accepted = min(proposed, max(0, new_tokens - verify_steps.count))
+        acceptance = accepted / proposed if proposed else 0.0
+        tokens_per_sec = new_tokens / elapsed if elapsed > 0 else 0.0
+        with self._state_lock:
+            baseline = self.baseline_tokens_per_sec
+        self._update(acceptance)
+        return output_ids, {
+            "used": True,
+            "acceptance_rate": acceptance,
+            "proposed_tokens": proposed,
+            "accepted_tokens": accepted,
+            "verify_steps": verify_steps.count,
+            "tokens_per_sec": tokens_per_sec,
+            "speedup": tokens_per_sec / baseline if baseline else None,
+            "fallback": self.fallback,
+        }
+
+    def _update(self, acceptance):
+        """受理率の移動平均を更新し、低すぎる場合は通常のデコードに切り替える"""
+        with self._state_lock:
+            self.requests += 1
+            if self.fallback:
+                # 再確認の結果、受理率が回復していれば投機的デコーディングに戻す
+                if acceptance >= self.min_acceptance:
+                    self.fallback = False
+                    self.acceptance_ema = acceptance
+                    print(f"SpeculativeDecoder: 受理率が回復したため再び有効にします ({acceptance:.2f})")
+                return
+            if self.acceptance_ema is None:
+                self.acceptance_ema = acceptance
+            else:
+                self.acceptance_ema += self.ema_alpha * (acceptance - self.acceptance_ema)
+            if self.requests >= self.warmup_requests and self.acceptance_ema < self.min_acceptance:
+                self.fallback = True
+                self._skipped = 0
+                print(f"SpeculativeDecoder: 受理率が低いため通常のデコードに戻します "
+                      f"({self.acceptance_ema:.2f} < {self.min_acceptance:.2f})")
+
+    def stats(self):
+        """受理率の移動平均と切り替えの状態を返す"""
+        with self._state_lock:
+            return {
+                "fallback": self.fallback,
+                "acceptance_ema": self.acceptance_ema,
+                "requests": self.requests,
+                "baseline_tokens_per_sec": self.baseline_tokens_per_sec,
+            }
+
+
+def load_draft_model(draft_model_name, tokenizer, device, torch_dtype, **kwargs):
+    """
+    ドラフトモデルを読み込み、SpeculativeDecoderを作成する
+
+    Args:
+        draft_model_name (str): ドラフトモデルの名前
+        tokenizer: メインモデルのトークナイザ（ドラフトモデルと同じ語彙かどうかの判定に使う）
+        device (str): モデルを配置するデバイス
+        torch_dtype (torch.dtype): ドラフトモデルのdtype
+        **kwargs: SpeculativeDecoderに渡す設定
+
+    Returns:
+        SpeculativeDecoder: 作成したデコーダ
+    """
+    draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_name)
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_model_name, torch_dtype=torch_dtype).to(device)
+    draft_model.eval()
+    same_vocab = draft_tokenizer.get_vocab() == tokenizer.get_vocab()
+    print(f"ドラフトモデル '{draft_model_name}' を読み込みました (語彙: {'共通' if same_vocab else '異なる'})")
+    return SpeculativeDecoder(draft_model, draft_tokenizer=None if same_vocab else draft_tokenizer, **kwargs)
+
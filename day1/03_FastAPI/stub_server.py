@@ -0,0 +1,145 @@
+# stub_server.py
+# モデルをダウンロードせずにベンチマークを動かすためのスタブサーバー
+# app.py と同じエンドポイント（/health, /generate, /generate/stream）とレスポンス形式を持ち、
+# 1トークンごとに一定時間待つだけの疑似モデルで応答する
+import os
+import json
+import time
+import asyncio
+import socket
+import threading
+from typing import Optional
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+STUB_MODEL_NAME = "stub-model"
+
+
+class StubModel:
+    """プレフィル時間とトークンごとの生成時間を模擬する疑似モデル"""
+
+    def __init__(self, prefill_ms=50, token_ms=10, max_concurrency=1):
+        """
+        初期化
+
+        Args:
+            prefill_ms (float): 最初のトークンを返すまでの時間（ミリ秒）
+            token_ms (float): 2トークン目以降の1トークンあたりの生成時間（ミリ秒）
+            max_concurrency (int): 同時に生成できるリクエスト数（app.py の推論ワーカー数に相当）
+        """
+        self.prefill_seconds = prefill_ms / 1000
+        self.token_seconds = token_ms / 1000
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        # イベントループ上で作成する必要があるため、最初の呼び出し時に作成する
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def generate(self, prompt, max_new_tokens):
+        """プロンプトの文字を繰り返してトークンとして1つずつ返す"""
+        async with self._get_semaphore():
+            await asyncio.sleep(self.prefill_seconds)
+            source = prompt or "stub"
+            for i in range(max_new_tokens):
+                if i > 0:
+                    await asyncio.sleep(self.token_seconds)
+                yield source[i % len(source)]
+
+
+class SimpleGenerationRequest(BaseModel):
+    prompt: str
+    model: Optional[str] = None
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+
+
+def create_app(stub_model):
+    """スタブモデルで応答するFastAPIアプリケーションを作成する"""
+    app = FastAPI(title="Stub LLM API")
+
+    @app.get("/health")
+    async def health_check():
+        return {"status": "ok", "model": STUB_MODEL_NAME}
+
+    @app.post("/generate")
+    async def generate_simple(request: SimpleGenerationRequest):
+        start_time = time.time()
+        tokens = [token async for token in stub_model.generate(request.prompt, request.max_new_tokens)]
+        return {
+            "generated_text": "".join(tokens),
+            "response_time": time.time() - start_time,
+            "model": STUB_MODEL_NAME,
+            "batch_size": 1,
+            "cached": False,
+            "prefix_cache": None,
+        }
+
+    @app.post("/generate/stream")
+    async def generate_stream(request: SimpleGenerationRequest):
+        async def events():
+            start_time = time.time()
+            first_token_time = None
+            tokens = []
+            async for token in stub_model.generate(request.prompt, request.max_new_tokens):
+                if first_token_time is None:
+                    first_token_time = time.time()
+                tokens.append(token)
+                yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+            response_time = time.time() - start_time
+            done = {
+                "generated_text": "".join(tokens),
+                "model": STUB_MODEL_NAME,
+                "response_time": response_time,
+                "time_to_first_token": first_token_time - start_time if first_token_time else None,
+                "tokens_generated": len(tokens),
+                "tokens_per_sec": len(tokens) / response_time if response_time > 0 else 0.0,
+                "prefix_cache": None,
+            }
+            yield f"event: done\ndata: {json.dumps(done, ensure_ascii=False)}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_server(prefill_ms=50, token_ms=10, max_concurrency=1, port=None):
+    """
+    スタブサーバーをバックグラウンドスレッドで起動する
+
+    Returns:
+        tuple: (ベースURL, uvicorn.Server)。終了するには server.should_exit = True を設定する
+    """
+    port = port or _free_port()
+    app = create_app(StubModel(prefill_ms=prefill_ms, token_ms=token_ms, max_concurrency=max_concurrency))
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="stub-server", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("スタブサーバーの起動に失敗しました")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("STUB_PORT", "8000"))
+    model = StubModel(
+        prefill_ms=float(os.environ.get("STUB_PREFILL_MS", "50")),
+        token_ms=float(os.environ.get("STUB_TOKEN_MS", "10")),
+        max_concurrency=int(os.environ.get("STUB_MAX_CONCURRENCY", "1")),
+    )
+    print(f"スタブサーバーをポート {port} で起動します")
+    uvicorn.run(create_app(model), host="0.0.0.0", port=port)
@@ -0,0 +1,59 @@
+# token_budget.py
+# 推論待ちのリクエスト数に応じて、max_new_tokens のデフォルト値を下げる適応的な上限
+
+
+class AdaptiveTokenBudget:
+    """リクエストで max_new_tokens が指定されなかった場合の生成トークン数を、サーバーの混雑度から決めるクラス
+
+    推論待ちが low_watermark 以下なら default_max_new_tokens、high_watermark 以上なら min_max_new_tokens とし、
+    その間は線形に減らす。混雑時に1件あたりの生成時間を短くし、待ち時間の裾（p99）が伸び続けないようにする。
+    値は step の倍数に丸め、混雑度が少し変わっただけでマイクロバッチにまとめられなくならないようにする。
+    """
+
+    def __init__(self, load_fn, default_max_new_tokens=512, min_max_new_tokens=64, low_watermark=1, high_watermark=32,
+                 step=32):
+        """
+        初期化
+
+        Args:
+            load_fn (callable): 現在の推論待ちのリクエスト数を返す関数
+            default_max_new_tokens (int): 空いているときのデフォルトの生成トークン数
+            min_max_new_tokens (int): 最も混雑しているときの生成トークン数
+            low_watermark (int): デフォルトの生成トークン数のまま処理する推論待ちの数
+            high_watermark (int): 生成トークン数を最小にする推論待ちの数
+            step (int): 生成トークン数を丸める単位
+        """
+        self.load_fn = load_fn
+        self.default_max_new_tokens = max(1, int(default_max_new_tokens))
+        self.min_max_new_tokens = max(1, min(int(min_max_new_tokens), self.default_max_new_tokens))
+        self.low_watermark = max(0, int(low_watermark))
+        self.high_watermark = max(self.low_watermark + 1, int(high_watermark))
+        self.step = max(1, int(step))
+
+    def current(self):
+        """現在の混雑度でのデフォルトの生成トークン数を返す"""
+        load = self.load_fn()
+        if load <= self.low_watermark:
+            return self.default_max_new_tokens
+        if load >= self.high_watermark:
+            return self.min_max_new_tokens
+        ratio = (load - self.low_watermark) / (self.high_watermark - self.low_watermark)
+        budget = self.default_max_new_tokens - ratio * (self.default_max_new_tokens - self.min_max_new_tokens)
+        return max(self.min_max_new_tokens, int(budget) // self.step * self.step)
+
+    def resolve(self, requested=None):
+        """リクエストで指定された値があればそれを、なければ現在のデフォルト値を返す"""
+        if requested is not None:
+            return requested
+        return self.current()
+
+    def stats(self):
+        """現在のデフォルト値と設定を返す"""
+        return {
+            "current_max_new_tokens": self.current(),
+            "default_max_new_tokens": self.default_max_new_tokens,
+            "min_max_new_tokens": self.min_max_new_tokens,
+            "low_watermark": self.low_watermark,
+            "high_watermark": self.high_watermark,
+            "load": self.load_fn(),
+        }
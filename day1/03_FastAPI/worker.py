@@ -0,0 +1,67 @@
+# worker.py
+# モデル推論をイベントループから切り離して実行する専用ワーカー
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """推論キューが満杯で新しいリクエストを受け付けられないときのエラー"""
+
+    def __init__(self, retry_after):
+        super().__init__("推論キューが満杯です")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """推論専用のスレッドプールと、受け付けるリクエスト数の上限を管理するクラス"""
+
+    def __init__(self, max_workers=1, max_queue_size=32, retry_after=5):
+        """
+        初期化
+
+        Args:
+            max_workers (int): 推論を実行するワーカースレッド数
+            max_queue_size (int): 実行中のものに加えて待機できるリクエスト数
+            retry_after (int): キューが満杯のときにクライアントへ返す再試行までの秒数
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_size = max(0, int(max_queue_size))
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def capacity(self):
+        """同時に受け付けられるリクエスト数（実行中 + 待機中）"""
+        return self.max_workers + self.max_queue_size
+
+    def pending(self):
+        """受け付け済みで完了していないリクエスト数を返す"""
+        return self._pending
+
+    def acquire(self):
+        """リクエストの受け付け枠を確保する。満杯の場合はQueueFullErrorを送出する"""
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise QueueFullError(self.retry_after)
+            self._pending += 1
+
+    def release(self):
+        """acquireで確保した受け付け枠を解放する"""
+        with self._lock:
+            self._pending = max(0, self._pending - 1)
+
+    async def run(self, fn, *args):
+        """推論用スレッドで関数を実行し、結果を待つ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def submit(self, fn, *args, **kwargs):
+        """推論用スレッドで関数を実行する（結果を待たない）"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        """ワーカースレッドを停止する"""
+        self._executor.shutdown(wait=False)
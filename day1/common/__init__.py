@@ -0,0 +1,2 @@
+# common
+# 02_streamlit_app と 03_FastAPI の両方から利用する共通モジュール
@@ -0,0 +1,97 @@
+# generation_controls.py
+# 停止文字列と制限時間で生成を途中で打ち切るためのStoppingCriteria（バッチの行ごとに判定する）
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """生成されたテキストに停止文字列が現れた行の生成を止める"""
+
+    def __init__(self, tokenizer, stop_sequences, prompt_length):
+        """
+        初期化
+
+        Args:
+            tokenizer: 生成されたトークンをデコードするトークナイザ
+            stop_sequences (list): 行ごとの停止文字列のリスト（停止文字列がない行は空リストまたはNone）
+            prompt_length (int): プロンプトのトークン数（これより後ろのトークンだけを調べる）
+        """
+        self.tokenizer = tokenizer
+        # 空文字列はどのテキストにも含まれるため、truncate_at_stop と同じく無視する
+        self.stop_sequences = [[stop for stop in stops or [] if stop] for stops in stop_sequences]
+        self.prompt_length = prompt_length
+        # 停止文字列をまたぐトークンを含めるため、最長の停止文字列の文字数より少し多いトークンだけをデコードする
+        longest = max((len(stop) for stops in self.stop_sequences for stop in stops), default=0)
+        self.window = longest + 8
+        self.stopped = [False] * len(self.stop_sequences)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for i, stops in enumerate(self.stop_sequences):
+            if not stops or self.stopped[i]:
+                continue
+            start = max(self.prompt_length, input_ids.shape[1] - self.window)
+            tail = self.tokenizer.decode(input_ids[i, start:], skip_special_tokens=True)
+            if any(stop in tail for stop in stops):
+                self.stopped[i] = True
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class DeadlineCriteria(StoppingCriteria):
+    """制限時刻を過ぎた行の生成を止める（それまでに生成したトークンは返す）"""
+
+    def __init__(self, deadlines, finished_token_ids=()):
+        """
+        初期化
+
+        Args:
+            deadlines (list): 行ごとの制限時刻（time.time()の値。制限しない行はNone）
+            finished_token_ids (iterable): 生成が終わった行の末尾に現れるトークンID（EOSとパディング）
+        """
+        self.deadlines = list(deadlines)
+        self.finished_token_ids = set(finished_token_ids)
+        self.expired = [False] * len(self.deadlines)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.time()
+        for i, deadline in enumerate(self.deadlines):
+            if deadline is None or self.expired[i] or now < deadline:
+                continue
+            # EOSで既に終わっている行は打ち切りとして扱わない
+            if int(input_ids[i, -1]) not in self.finished_token_ids:
+                self.expired[i] = True
+        return torch.tensor(self.expired, dtype=torch.bool, device=input_ids.device)
+
+
+def truncate_at_stop(text, stop_sequences, start=0):
+    """
+    テキストを最初に現れた停止文字列の直前で切り詰める
+
+    Args:
+        text (str): 生成されたテキスト
+        stop_sequences (list): 停止文字列のリスト
+        start (int): 停止文字列を探し始める位置（プロンプト部分を除くため）
+
+    Returns:
+        tuple: (切り詰めたテキスト, 停止文字列が見つかったかどうか)
+    """
+    positions = [text.find(stop, start) for stop in stop_sequences or [] if stop]
+    positions = [position for position in positions if position != -1]
+    if not positions:
+        return text, False
+    return text[:min(positions)], True
+
+
+def eos_token_ids(model, tokenizer):
+    """生成の終了を表すトークンID（generation_configのEOSとパディング）の集合を返す"""
+    ids = set()
+    eos = getattr(model.generation_config, "eos_token_id", None)
+    if isinstance(eos, int):
+        ids.add(eos)
+    elif eos:
+        ids.update(eos)
+    for token_id in (tokenizer.eos_token_id, tokenizer.pad_token_id):
+        if token_id is not None:
+            ids.add(token_id)
+    return ids
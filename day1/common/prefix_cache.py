@@ -0,0 +1,211 @@
+# prefix_cache.py
+# 共通のプロンプト先頭部分（システムプロンプトやチャットテンプレート）のKVキャッシュを保存して再利用する
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+def _cache_nbytes(past_key_values):
+    """KVキャッシュのテンソルが使用しているメモリ量（バイト）を返す"""
+    total = 0
+    for layer in past_key_values:  # レイヤーごとに (key, value) が返る
+        for tensor in layer:
+            if torch.is_tensor(tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class PrefixKVCache:
+    """よく使われるプロンプトの先頭トークン列に対するpast_key_valuesを保存し、プレフィルを省略するキャッシュ
+
+    先頭トークン列は block_size の倍数の長さで数え、min_hits 回以上現れたものだけを保存する。
+    保存したKVキャッシュの合計サイズが max_memory_bytes を超える場合は、最も古く使われたものから削除する。
+    ヒットのたびにKVキャッシュをコピーするため、1件のサイズは max_entry_bytes までに制限する。
+    """
+
+    def __init__(self, max_memory_bytes=256 * 1024 ** 2, block_size=16, min_hits=2, max_tracked_prefixes=4096,
+                 max_entry_bytes=64 * 1024 ** 2):
+        """
+        初期化
+
+        Args:
+            max_memory_bytes (int): 保存するKVキャッシュの合計サイズの上限（バイト）
+            block_size (int): 先頭トークン列を数える単位（トークン数）
+            min_hits (int): KVキャッシュを作成するまでに同じ先頭トークン列が現れる回数
+            max_tracked_prefixes (int): 出現回数を数える先頭トークン列の最大数
+            max_entry_bytes (int): 1件のKVキャッシュのサイズの上限（バイト）。ヒットごとのコピーの量を抑える
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_memory_bytes)
+        self.block_size = max(1, int(block_size))
+        self.min_hits = max(1, int(min_hits))
+        self.max_tracked_prefixes = max_tracked_prefixes
+        self.enabled = True
+        self.disabled_reason = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_prefill_tokens = 0
+        self.copied_bytes = 0  # ヒット時にコピーしたKVキャッシュの合計サイズ
+        self.copy_seconds = 0.0  # ヒット時のコピーにかかった合計時間
+        self._entries = OrderedDict()  # 先頭トークン列(tuple) -> (KVキャッシュ, サイズ)
+        self._counts = OrderedDict()  # 先頭トークン列(tuple) -> 出現回数
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, token_ids):
+        """
+        token_ids の先頭と一致する最長のKVキャッシュを探す
+
+        Args:
+            token_ids (list): プロンプトのトークンID列
+
+        Returns:
+            tuple: (再利用できるトークン数, KVキャッシュのコピー)。見つからない場合は (0, None)
+        """
+        if not self.enabled:
+            return 0, None
+        with self._lock:
+            best = None
+            for prefix in self._entries:
+                # 最後のトークンはgenerateで計算する必要があるため、プロンプトより短いものだけを使う
+                if len(prefix) < len(token_ids) and (best is None or len(prefix) > len(best)):
+                    if tuple(token_ids[:len(prefix)]) == prefix:
+                        best = prefix
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            self.saved_prefill_tokens += len(best)
+            past_key_values, nbytes = self._entries[best]
+        # generateがキャッシュを書き換えるため、保存しているものはコピーして渡す
+        start = time.perf_counter()
+        past_key_values = copy.deepcopy(past_key_values)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.copied_bytes += nbytes
+            self.copy_seconds += elapsed
+        return len(best), past_key_values
+
+    def record(self, model, token_ids):
+        """
+        プロンプトの先頭トークン列の出現回数を数え、min_hits 回に達したものはKVキャッシュを作成して保存する
+
+        Args:
+            model: transformersのモデル（KVキャッシュの作成に使用する）
+            token_ids (list): プロンプトのトークンID列
+        """
+        if not self.enabled:
+            return
+        # 最後のトークンは必ずgenerateで計算するため、それより短いブロック境界までを対象にする
+        max_len = ((len(token_ids) - 1) // self.block_size) * self.block_size
+        candidate = None
+        with self._lock:
+            for length in range(self.block_size, max_len + 1, self.block_size):
+                prefix = tuple(token_ids[:length])
+                count = self._counts.pop(prefix, 0) + 1
+                self._counts[prefix] = count
+                if count >= self.min_hits and prefix not in self._entries:
+                    candidate = prefix  # 条件を満たす最長の先頭トークン列を保存する
+            while len(self._counts) > self.max_tracked_prefixes:
+                self._counts.popitem(last=False)
+        if candidate is not None:
+            self._store(model, candidate)
+
+    def _store(self, model, prefix):
+        """先頭トークン列のKVキャッシュを作成して保存する"""
+        try:
+            input_ids = torch.tensor([prefix], device=model.device)
+            with torch.inference_mode():
+                outputs = model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True)
+            past_key_values = outputs.past_key_values
+            nbytes = _cache_nbytes(past_key_values)
+        except Exception as e:
+            # KVキャッシュの形式に対応していないモデルでは無効にする
+            self.disable(f"KVキャッシュを作成できません: {e}")
+            return
+        if nbytes > self.max_entry_bytes:
+            return
+        with self._lock:
+            if prefix in self._entries:
+                return
+            self._entries[prefix] = (past_key_values, nbytes)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_memory_bytes and self._entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._memory_bytes -= evicted_bytes
+        print(f"PrefixKVCache: {len(prefix)}トークンの先頭部分を保存しました ({nbytes / 1024 ** 2:.1f} MB)")
+
+    def disable(self, reason):
+        """キャッシュを無効にし、保存しているKVキャッシュを破棄する（モデルが対応していない場合に使う）"""
+        print(f"PrefixKVCache: 無効にします: {reason}")
+        with self._lock:
+            self.enabled = False
+            self.disabled_reason = str(reason)
+            self._entries.clear()
+            self._counts.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        """ヒット率や省略したプレフィルのトークン数などの統計情報を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "disabled_reason": self.disabled_reason,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_prefill_tokens": self.saved_prefill_tokens,
+                "entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "copied_bytes": self.copied_bytes,
+                "avg_copy_ms": self.copy_seconds / self.hits * 1000 if self.hits else 0.0,
+            }
+
+
+def generate_with_prefix_cache(model, input_ids, prefix_cache=None, **generate_kwargs):
+    """
+    先頭部分のKVキャッシュを再利用してmodel.generateを実行する（バッチサイズ1のみ）
+
+    Args:
+        model: transformersのモデル
+        input_ids (torch.Tensor): 形状 (1, プロンプト長) のトークンID
+        prefix_cache (PrefixKVCache, optional): 使用するキャッシュ。Noneの場合は通常どおり生成する
+        **generate_kwargs: model.generateに渡す引数
+
+    Returns:
+        tuple: (生成結果のトークンID, {"hit": bool, "reused_tokens": int})
+    """
+    if prefix_cache is None or input_ids.shape[0] != 1:
+        return model.generate(input_ids=input_ids, **generate_kwargs), {"hit": False, "reused_tokens": 0}
+
+    token_ids = input_ids[0].tolist()
+    reused_tokens, past_key_values = prefix_cache.lookup(token_ids)
+    attention_mask = torch.ones_like(input_ids)
+    if past_key_values is None:
+        output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+    else:
+        try:
+            output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                        past_key_values=past_key_values, **generate_kwargs)
+        except Exception as e:
+            # 保存したKVキャッシュの形式を受け付けないモデル（スライディングウィンドウのキャッシュを使うものなど）では
+            # キャッシュを無効にし、通常どおり生成し直す
+            prefix_cache.disable(f"保存したKVキャッシュで生成できません: {e}")
+            streamer = generate_kwargs.get("streamer")
+            if streamer is not None and hasattr(streamer, "next_tokens_are_prompt"):
+                # 失敗した generate に渡されたプロンプトを、やり直しでも出力しないようにする
+                streamer.next_tokens_are_prompt = True
+            output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+            return output_ids, {"hit": False, "reused_tokens": 0}
+
+    # 次回以降のために先頭部分の出現回数を記録する（KVキャッシュの作成は先頭部分ごとに1回だけ行われる）
+    prefix_cache.record(model, token_ids)
+    return output_ids, {"hit": past_key_values is not None, "reused_tokens": reused_tokens}
@@ -0,0 +1,152 @@
+# response_cache.py
+# 決定的な生成結果を再利用するための応答キャッシュ（LRU + TTL、SQLiteによる永続化は任意）
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def is_cacheable(do_sample, use_cache=None):
+    """
+    キャッシュを利用するかどうかを判定する
+
+    Args:
+        do_sample (bool): サンプリングを行うかどうか
+        use_cache (bool, optional): 明示的な指定。Noneの場合はサンプリングなしの生成のみキャッシュする
+
+    Returns:
+        bool: キャッシュを利用する場合はTrue
+    """
+    if use_cache is not None:
+        return bool(use_cache)
+    return not do_sample
+
+
+class ResponseCache:
+    """(モデル名, プロンプト, 生成パラメータ) をキーに生成結果を保存するLRU + TTLキャッシュ"""
+
+    def __init__(self, max_entries=256, ttl_seconds=3600, db_path=None, max_disk_entries=10000):
+        """
+        初期化
+
+        Args:
+            max_entries (int): メモリ上に保持する最大エントリ数（超えると最も古く使われたものから削除）
+            ttl_seconds (float): エントリの有効期間（秒）。Noneまたは0以下の場合は期限なし
+            db_path (str, optional): SQLiteファイルのパス。指定すると再起動後もキャッシュが残る
+            max_disk_entries (int): SQLiteに保持する最大エントリ数
+        """
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = ttl_seconds if ttl_seconds and ttl_seconds > 0 else None
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (作成時刻, 値)
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, value TEXT, created_at REAL, last_access REAL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name, prompt, params):
+        """キャッシュキーを作成する（パラメータの順序に依存しないようにJSON化してハッシュする）"""
+        raw = json.dumps(
+            {"model": model_name, "prompt": prompt, "params": params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """キャッシュから値を取得する。存在しないか期限切れの場合はNoneを返す"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._is_expired(created_at, now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            # メモリにない場合はSQLiteを確認し、見つかればメモリに戻す
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = json.loads(row[0]), row[1]
+                    if not self._is_expired(created_at, now):
+                        self._conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+                        self._conn.commit()
+                        self._store_in_memory(key, created_at, value)
+                        self.hits += 1
+                        return value
+                    self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """値をキャッシュに保存する（値はJSONに変換できる必要がある）"""
+        now = time.time()
+        with self._lock:
+            self._store_in_memory(key, now, value)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now, now),
+                )
+                self._prune_disk(now)
+                self._conn.commit()
+
+    def _store_in_memory(self, key, created_at, value):
+        self._entries[key] = (created_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self, now):
+        """期限切れのエントリと、上限を超えた古いエントリをSQLiteから削除する"""
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._conn.execute(
+            "DELETE FROM response_cache WHERE key NOT IN "
+            "(SELECT key FROM response_cache ORDER BY last_access DESC LIMIT ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        """キャッシュを全て削除する（ヒット数・ミス数もリセットする）"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM response_cache")
+                self._conn.commit()
+
+    def stats(self):
+        """ヒット数・ミス数などの統計情報を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self._conn is not None,
+            }
@@ -0,0 +1,53 @@
+# response_extraction.py
+# 生成結果からアシスタントの応答（新しく生成された部分）だけを取り出す
+# プロンプトを含む全文をデコードして文字列検索するのではなく、プロンプトのトークン数の位置で切り出す
+
+
+def decode_new_tokens(tokenizer, output_ids, prompt_length, skip_special_tokens=True):
+    """
+    generateの出力のうち、プロンプトより後ろのトークンだけをデコードする
+
+    Args:
+        tokenizer: トークナイザ
+        output_ids (torch.Tensor): 形状 (バッチサイズ, プロンプト長 + 生成長) のトークンID
+        prompt_length (int): 入力したプロンプトのトークン数（左パディングを含む）
+        skip_special_tokens (bool): 特殊トークン（パディングやEOS）を除くかどうか
+
+    Returns:
+        list: 行ごとの生成テキスト
+    """
+    return tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens=skip_special_tokens)
+
+
+def extract_assistant_response(outputs, default=""):
+    """
+    pipeline形式の出力（[{"generated_text": ...}]）からアシスタントの応答を取り出す
+
+    generated_text は、return_full_text=False や decode_new_tokens で得た生成部分だけの文字列か、
+    チャット形式のメッセージのリスト（最後がassistantのメッセージ）であること。
+
+    Args:
+        outputs (list): pipeline形式の出力
+        default (str): 応答を取り出せなかった場合に返す文字列
+
+    Returns:
+        str: アシスタントの応答
+    """
+    text = ""
+    generated = outputs[0].get("generated_text") if outputs and isinstance(outputs[0], dict) else None
+    if isinstance(generated, str):
+        text = generated
+    elif isinstance(generated, list) and generated:
+        last_message = generated[-1]
+        if isinstance(last_message, dict) and last_message.get("role") == "assistant":
+            text = last_message.get("content", "")
+        else:
+            print(f"警告: 最後のメッセージの形式が予期しない形式です: {last_message}")
+    elif generated is not None:
+        print(f"警告: 予期しない出力タイプ: {type(generated)}")
+
+    text = text.strip()
+    if not text:
+        print("警告: アシスタントの応答を抽出できませんでした。完全な出力:", outputs)
+        return default
+    return text
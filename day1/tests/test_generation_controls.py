@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+# day1 直下の common パッケージを読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from common.generation_controls import StopSequenceCriteria, truncate_at_stop
+
+
+class CharTokenizer:
+    """トークンIDを文字コードとしてデコードするテスト用のトークナイザ"""
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(int(i)) for i in ids)
+
+
+def encode(text):
+    return torch.tensor([[ord(c) for c in text]])
+
+
+def test_empty_stop_sequence_does_not_stop():
+    """空の停止文字列では生成を止めないことを確認"""
+    criteria = StopSequenceCriteria(CharTokenizer(), [[""]], prompt_length=2)
+    stopped = criteria(encode("Q:a"), None)
+    assert not stopped[0], "空の停止文字列で生成が止まっています"
+    assert truncate_at_stop("a", [""]) == ("a", False)
+
+
+def test_stop_sequence_stops_row():
+    """停止文字列が現れた行だけ生成を止めることを確認"""
+    criteria = StopSequenceCriteria(CharTokenizer(), [["", "END"], None], prompt_length=2)
+    input_ids = torch.cat([encode("Q:aEND"), encode("Q:abcd")])
+    stopped = criteria(input_ids, None)
+    assert stopped.tolist() == [True, False]